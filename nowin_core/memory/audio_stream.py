@@ -155,6 +155,59 @@ class AudioStream(object):
             if delta > self.bufferSize:
                 self._base = self.size - self.bufferSize
 
+    def resize(self, blockCount):
+        """Resize the buffer to `blockCount` blocks, the latest blocks are kept,
+        and the base moves forward if there is no room for old ones
+
+        @param blockCount: new count of blocks
+        """
+        blockSize = self._blockSize
+        bufferSize = blockSize * blockCount
+        keep = min(blockCount, (self._size - self._base) / blockSize)
+        base = self._size - keep * blockSize
+        bytes = bytearray(bufferSize)
+        for offset in xrange(base, self._size, blockSize):
+            begin = offset % self._bufferSize
+            new_begin = offset % bufferSize
+            bytes[new_begin:new_begin + blockSize] = \
+                self._bytes[begin:begin + blockSize]
+        self._blockCount = blockCount
+        self._bufferSize = bufferSize
+        self._bytes = bytes
+        self._base = base
+
+    def getState(self):
+        """Get state of this audio stream as a dict, it can be dumped and
+        loaded by setState in another process
+
+        """
+        return dict(
+            blockSize=self._blockSize,
+            blockCount=self._blockCount,
+            base=self._base,
+            size=self._size,
+            bytes=str(self._bytes),
+            pieces=''.join(self._pieces),
+        )
+
+    def setState(self, state):
+        """Load state from getState, it replaces all data in this stream
+
+        """
+        self._blockSize = state['blockSize']
+        self._blockCount = state['blockCount']
+        self._bufferSize = self._blockSize * self._blockCount
+        self._base = state['base']
+        self._size = state['size']
+        assert len(state['bytes']) == self._bufferSize, \
+            "size of bytes doesn't match the buffer size"
+        self._bytes = bytearray(state['bytes'])
+        self._pieces = []
+        self._pieceSize = 0
+        if state['pieces']:
+            self._pieces.append(state['pieces'])
+            self._pieceSize = len(state['pieces'])
+
     def read(self, offset, no_copy=False):
         """Read a block from audio stream
 
@@ -0,0 +1,189 @@
+import logging
+
+from nowin_core.patterns import observer
+
+
+class MemoryLimitError(Exception):
+
+    """Raised when there is no memory for a new audio stream
+
+    """
+
+
+class _Entry(object):
+
+    __slots__ = ('stream', 'listener_offsets', 'blockCount')
+
+    def __init__(self, stream, listener_offsets, blockCount):
+        self.stream = stream
+        self.listener_offsets = listener_offsets
+        #: count of blocks the stream was registered with
+        self.blockCount = blockCount
+
+
+class MemoryGovernor(object):
+
+    """Governor for buffer memory of all audio streams in a process
+
+    Every audio stream registers with the governor, if total size of buffers
+    exceeds `budget` bytes, the governor shrinks windows of streams which have
+    zero or fewer listeners first. A stream is never shrunk below `min_blocks`
+    blocks, nor to where its slowest listener would be out of the window. A
+    new stream is refused if total size still exceeds `hard_limit` bytes
+    with it. When streams are unregistered, shrunk windows grow back as
+    the budget allows, busiest first.
+
+    One governor should be shared by all StreamFactory of a process.
+
+    """
+
+    def __init__(self, budget, hard_limit=None, min_blocks=8, logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        #: soft limit of total buffer size in bytes
+        self.budget = budget
+        #: hard limit of total buffer size in bytes
+        self.hard_limit = hard_limit
+        if self.hard_limit is None:
+            self.hard_limit = budget
+        assert self.hard_limit >= self.budget, \
+            'hard limit should not be less than budget'
+        #: minimum count of blocks of a shrunk stream
+        self.min_blocks = min_blocks
+        #: count of shrinks
+        self.shrink_count = 0
+        #: count of refused streams
+        self.refused_count = 0
+        # map id of stream to entry
+        self._entries = {}
+
+        #: called when a stream is shrunk with arguments
+        #: (stream, old block count, new block count)
+        self.shrink_event = observer.Subject()
+        #: called when a stream is refused with argument (stream)
+        self.refuse_event = observer.Subject()
+
+    @property
+    def usage(self):
+        """Total buffer size of registered streams in bytes
+
+        """
+        return sum(entry.stream.bufferSize
+                   for entry in self._entries.itervalues())
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            streams=len(self._entries),
+            usage=self.usage,
+            budget=self.budget,
+            hard_limit=self.hard_limit,
+            shrink_count=self.shrink_count,
+            refused_count=self.refused_count,
+        )
+
+    def register(self, stream, listener_offsets=None):
+        """Register an audio stream, raise MemoryLimitError if there is no
+        room for it
+
+        @param stream: the audio stream
+        @param listener_offsets: function returns offsets of all listeners
+            of the stream
+        """
+        assert id(stream) not in self._entries, 'already registered'
+        if listener_offsets is None:
+            listener_offsets = list
+        self._shrink(self.hard_limit - stream.bufferSize)
+        if self.usage + stream.bufferSize > self.hard_limit:
+            self.refused_count += 1
+            self.logger.warn('Refused stream %r of %d bytes, usage %d bytes',
+                             stream, stream.bufferSize, self.usage)
+            self.refuse_event(stream)
+            self._grow()
+            raise MemoryLimitError('Out of memory budget')
+        entry = _Entry(stream, listener_offsets, stream.blockCount)
+        self._entries[id(stream)] = entry
+        self._shrink(self.budget)
+
+    def update(self, stream):
+        """Update accounting of a registered audio stream after its buffer is
+        replaced, for example loaded by setState, it's shrunk if the usage
+        exceeds the budget, or grown back if it's smaller than before
+
+        """
+        entry = self._entries[id(stream)]
+        entry.blockCount = max(entry.blockCount, stream.blockCount)
+        self._shrink(self.budget)
+        self._grow()
+
+    def unregister(self, stream):
+        """Unregister an audio stream
+
+        """
+        del self._entries[id(stream)]
+        self._grow()
+
+    def _getMinBlocks(self, entry, offsets):
+        stream = entry.stream
+        count = self.min_blocks
+        if offsets:
+            lag = stream.size - max(min(offsets), stream.base)
+            count = max(count, -(-lag // stream.blockSize))
+        return count
+
+    def _shrink(self, limit):
+        """Shrink streams until the usage is under `limit`
+
+        """
+        excess = self.usage - limit
+        if excess <= 0:
+            return
+        entries = []
+        for entry in self._entries.itervalues():
+            offsets = list(entry.listener_offsets())
+            entries.append((len(offsets), -entry.stream.bufferSize,
+                            entry, offsets))
+        entries.sort(key=lambda item: item[:2])
+        for _, _, entry, offsets in entries:
+            if excess <= 0:
+                break
+            stream = entry.stream
+            min_count = self._getMinBlocks(entry, offsets)
+            blocks = -(-excess // stream.blockSize)
+            count = max(min_count, stream.blockCount - blocks)
+            if count >= stream.blockCount:
+                continue
+            old_count = stream.blockCount
+            stream.resize(count)
+            excess -= (old_count - count) * stream.blockSize
+            self.shrink_count += 1
+            self.logger.info('Shrunk stream %r from %d to %d blocks',
+                             stream, old_count, count)
+            self.shrink_event(stream, old_count, count)
+
+    def _grow(self):
+        """Grow shrunk streams back as the budget allows
+
+        """
+        room = self.budget - self.usage
+        if room <= 0:
+            return
+        entries = []
+        for entry in self._entries.itervalues():
+            if entry.stream.blockCount < entry.blockCount:
+                count = len(list(entry.listener_offsets()))
+                entries.append((-count, entry))
+        entries.sort(key=lambda item: item[0])
+        for _, entry in entries:
+            stream = entry.stream
+            blocks = min(entry.blockCount - stream.blockCount,
+                         room // stream.blockSize)
+            if blocks <= 0:
+                continue
+            stream.resize(stream.blockCount + blocks)
+            room -= blocks * stream.blockSize
+            self.logger.info('Grew stream %r to %d blocks',
+                             stream, stream.blockCount)
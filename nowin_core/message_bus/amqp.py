@@ -1,40 +1,154 @@
-import json
 import logging
 import os
+import random
 
 import txamqp.spec
-from twisted.internet import reactor
+from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.defer import returnValue
 from twisted.internet.protocol import ClientCreator
 from txamqp.client import TwistedDelegate
+from txamqp.connection import Frame
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
+from nowin_core.message_bus.codec import LazyPayload
+from nowin_core.message_bus.codec import default_codec
+from nowin_core.message_bus.telemetry import SENT_AT_HEADER
+
+
+class AMQPClient(AMQClient):
+
+    """AMQClient writes frames sent between beginBatch and endBatch to the
+    transport with one write
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        AMQClient.__init__(self, *args, **kwargs)
+        #: count of writes to transport
+        self.write_count = 0
+        # packed frames of current batch, None for not batching
+        self._frames = None
+
+    def beginBatch(self):
+        """Start holding frames sent
+
+        """
+        self._frames = []
+
+    def endBatch(self):
+        """Write frames held since beginBatch together
+
+        """
+        frames = self._frames
+        self._frames = None
+        if frames:
+            self.transport.write(''.join(frames))
+            self.write_count += 1
+
+    def sendFrame(self, frame):
+        if self._frames is None:
+            AMQClient.sendFrame(self, frame)
+            self.write_count += 1
+            return
+        if frame.payload.type != Frame.HEARTBEAT:
+            self.reschedule_sendHB()
+        self._frames.append(self._packFrame(frame))
+
 
 class AMQPMessageBus(object):
 
+    #: consume without acknowledging, messages are acknowledged by broker as
+    #: soon as they are delivered
+    ACK_NONE = 'none'
+
+    #: acknowledge a message after its callback returned, or after the
+    #: Deferred returned by its callback fired, reject it without requeuing
+    #: if the callback failed or it can't be decoded
+    ACK_AFTER = 'after'
+
+    #: subscribe takes `lazy` argument for callbacks called with LazyPayload
+    lazy_payloads = True
+
     def __init__(
         self,
         hosts,
         exchange_name='message_bus',
         vhost='/',
         spec_path=os.path.join('specs', 'standard', 'amqp0-8.xml'),
+        codec=None,
+        publish_channels=1,
+        consume_channels=1,
+        prefetch=None,
+        ack_mode=ACK_NONE,
+        batch_size=None,
+        telemetry=None,
+        reactor=None,
         logger=None
     ):
         """
 
+        @param publish_channels: count of channels for publishing, they are
+            used in turn
+        @param consume_channels: count of channels for consuming, every
+            subscription is assigned to one of them in turn
+        @param prefetch: max count of unacknowledged messages of a consume
+            channel, None for no limit, it only works with ACK_AFTER
+        @param ack_mode: ACK_NONE or ACK_AFTER
+        @param batch_size: publish sent messages together in next reactor
+            iteration, or once `batch_size` messages are queued, None for
+            publishing every message immediately. Frames of a batch are
+            written to the connection with one write, on the same channel,
+            with more than one publish channel, order of messages in
+            different batches is not kept
+        @param telemetry: Telemetry to record delivery latency and callback
+            time of messages into, sent messages get the sent-at header,
+            None for no telemetry
         """
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
 
         self.hosts = hosts
         self.vhost = vhost
         self.exchange_name = exchange_name
+        #: codec for encoding messages to send
+        self.codec = codec
+        if self.codec is None:
+            self.codec = default_codec
+        assert publish_channels >= 1 and consume_channels >= 1
+        self.publish_channels = publish_channels
+        self.consume_channels = consume_channels
+        self.prefetch = prefetch
+        assert ack_mode in (self.ACK_NONE, self.ACK_AFTER)
+        self.ack_mode = ack_mode
+        self.batch_size = batch_size
+        #: Telemetry to record into
+        self.telemetry = telemetry
         self.conn = None
-        # map tab to queue name
+        #: the first publish channel
+        self.channel = None
+        #: connected host
+        self.host = None
+        # map tab to (queue name, channel)
         self.queues = {}
+        # channels for publishing and consuming
+        self._publishers = []
+        self._consumers = []
+        # index of next publish and consume channel
+        self._next_publisher = 0
+        self._next_consumer = 0
+        # queued (dest, content, deferred) to publish
+        self._batch = []
+        self._flush_call = None
+        # index of next host to connect, start from a random one, so that
+        # connections of processes are spread across hosts
+        self._next_host = random.randrange(len(self.hosts))
 
         path = os.path.join(os.path.dirname(__file__), spec_path)
         self.spec = txamqp.spec.load(path)
@@ -42,41 +156,161 @@ class AMQPMessageBus(object):
 
         self.logger.info('Create message bus with hosts %s', self.hosts)
 
-    @inlineCallbacks
-    def login(self, user, password):
-        """Login message bus
+    def _connect(self, host):
+        """Connect to `host` and return a Deferred fired with AMQClient
 
         """
-        self.logger.debug('Logging in as %s ...', user)
-        host = self.hosts[0]
-
         delegate = TwistedDelegate()
-        creactor = ClientCreator(reactor, AMQClient, delegate=delegate,
+        creactor = ClientCreator(self.reactor, AMQPClient, delegate=delegate,
                                  vhost=self.vhost, spec=self.spec)
+        return creactor.connectTCP(host[0], host[1])
+
+    @inlineCallbacks
+    def _openChannel(self, id):
+        channel = yield self.conn.channel(id)
+        yield channel.channel_open()
+        returnValue(channel)
 
-        self.conn = yield creactor.connectTCP(host[0], host[1])
+    @inlineCallbacks
+    def login(self, user, password):
+        """Login message bus, try all hosts in turn until one of them
+        accepts the connection
+
+        """
+        self.logger.debug('Logging in as %s ...', user)
+        for i in xrange(len(self.hosts)):
+            host = self.hosts[self._next_host]
+            self._next_host = (self._next_host + 1) % len(self.hosts)
+            try:
+                self.conn = yield self._connect(host)
+            except Exception, e:
+                if i == len(self.hosts) - 1:
+                    raise
+                self.logger.warn('Failed to connect to %s, %s', host, e)
+                continue
+            self.host = host
+            break
         yield self.conn.authenticate(user, password)
-        self.channel = yield self.conn.channel(1)
-        yield self.channel.channel_open()
+
+        self._publishers = []
+        self._consumers = []
+        channel_id = 1
+        for _ in xrange(self.publish_channels):
+            channel = yield self._openChannel(channel_id)
+            self._publishers.append(channel)
+            channel_id += 1
+        for _ in xrange(self.consume_channels):
+            channel = yield self._openChannel(channel_id)
+            if self.prefetch is not None:
+                yield channel.basic_qos(prefetch_count=self.prefetch)
+            self._consumers.append(channel)
+            channel_id += 1
+        self.channel = self._publishers[0]
         yield self.channel.exchange_declare(exchange=self.exchange_name,
                                             type='topic')
-        self.logger.info('Login as %s', user)
+        self.logger.info('Login to %s as %s', self.host, user)
+
+    def _getPublisher(self):
+        channel = self._publishers[self._next_publisher]
+        self._next_publisher = (self._next_publisher + 1) % \
+            len(self._publishers)
+        return channel
+
+    def _getConsumer(self):
+        channel = self._consumers[self._next_consumer]
+        self._next_consumer = (self._next_consumer + 1) % \
+            len(self._consumers)
+        return channel
 
-    @inlineCallbacks
     def send(self, dest, data):
         """Send data to message bus
 
         """
         dest = str(dest)
-        data = json.dumps(data)
-        self.logger.debug('Sending %s bytes to %s ...', len(data), dest)
-        yield self.channel.basic_publish(exchange=self.exchange_name,
-                                         routing_key=dest,
-                                         content=Content(data))
-        self.logger.info('Sent %s bytes to %s', len(data), dest)
+        data = self.codec.encode(data)
+        properties = {'content type': self.codec.content_type}
+        if self.telemetry is not None:
+            properties['headers'] = {
+                SENT_AT_HEADER: self.telemetry.getSentAt()}
+        content = Content(data, properties=properties)
+        if self.batch_size is None:
+            return self._getPublisher().basic_publish(
+                exchange=self.exchange_name,
+                routing_key=dest,
+                content=content
+            )
+        d = defer.Deferred()
+        self._batch.append((dest, content, d))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """Publish all queued messages
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch = self._batch
+        self._batch = []
+        if not batch:
+            return
+        channel = self._getPublisher()
+        # connections other than AMQPClient write frames one by one
+        batching = hasattr(self.conn, 'beginBatch')
+        if batching:
+            self.conn.beginBatch()
+        try:
+            for dest, content, d in batch:
+                published = channel.basic_publish(
+                    exchange=self.exchange_name,
+                    routing_key=dest,
+                    content=content
+                )
+                published.chainDeferred(d)
+        finally:
+            if batching:
+                self.conn.endBatch()
+        self.logger.debug('Published %d messages', len(batch))
+
+    def _ack(self, result, channel, delivery_tag):
+        channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _reject(self, failure, channel, routing_key, delivery_tag):
+        self._handleCallbackError(failure, routing_key)
+        # not requeued, so that it's not redelivered forever
+        channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+
+    def _handleCallbackError(self, failure, routing_key):
+        self.logger.error('Failed to handle message of %s, %s',
+                          routing_key, failure.getErrorMessage())
+
+    def _deliver(self, callback, routing_key, payload, lazy):
+        """Call `callback` with the payload if `lazy` is True, or with
+        decoded data
+
+        """
+        if lazy:
+            return callback(routing_key, payload)
+        return callback(routing_key, payload.decode())
+
+    def _measureCallback(self, msg, callback):
+        """Record delivery latency of `msg`, return `callback` wrapped to
+        record time spent in it
+
+        """
+        headers = msg.content.properties.get('headers') or {}
+        sent_at = headers.get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self.telemetry.recordDelivery(msg.routing_key, sent_at)
+        return self.telemetry.measure(msg.routing_key, callback)
 
     @inlineCallbacks
-    def _poll_queue(self, queue_tag, callback):
+    def _poll_queue(self, queue_tag, channel, callback, lazy=False):
         self.logger.debug('Polling queue %s to %s', queue_tag, callback)
         queue = yield self.conn.queue(queue_tag)
         while True:
@@ -85,33 +319,48 @@ class AMQPMessageBus(object):
             except txamqp.queue.Closed:
                 self.logger.debug('Stop polling queue %s ', queue_tag)
                 break
-            data = json.loads(msg.content.body)
-            callback(msg.routing_key, data)
+            payload = LazyPayload(msg.content.body,
+                                  msg.content.properties.get('content type'))
+            handler = callback
+            if self.telemetry is not None:
+                handler = self._measureCallback(msg, callback)
+            # errors of decoding and callbacks don't stop polling
+            d = defer.maybeDeferred(self._deliver, handler, msg.routing_key,
+                                    payload, lazy)
+            if self.ack_mode == self.ACK_NONE:
+                d.addErrback(self._handleCallbackError, msg.routing_key)
+                continue
+            d.addCallbacks(self._ack, self._reject,
+                           callbackArgs=(channel, msg.delivery_tag),
+                           errbackArgs=(channel, msg.routing_key,
+                                        msg.delivery_tag))
 
     @inlineCallbacks
-    def subscribe(self, dest, callback):
+    def subscribe(self, dest, callback, lazy=False):
         """Subscribe to specific destination, the callback will be called when
-        the there is message in the destination
+        the there is message in the destination, with LazyPayload instead of
+        decoded data if `lazy` is True
 
         """
         dest = str(dest)
         self.logger.debug('Subscribing to %s ...', dest)
-        result = yield self.channel.queue_declare(
+        channel = self._getConsumer()
+        result = yield channel.queue_declare(
             exclusive=True,
             durable=False,
         )
         queue_name = result.queue
-        yield self.channel.queue_bind(exchange=self.exchange_name,
-                                      queue=queue_name,
-                                      routing_key=dest)
+        yield channel.queue_bind(exchange=self.exchange_name,
+                                 queue=queue_name,
+                                 routing_key=dest)
 
-        result = yield self.channel.basic_consume(
+        result = yield channel.basic_consume(
             queue=queue_name,
-            no_ack=True,
+            no_ack=self.ack_mode == self.ACK_NONE,
         )
         queue_tag = result.consumer_tag
-        self.queues[queue_tag] = queue_name
-        self._poll_queue(queue_tag, callback)
+        self.queues[queue_tag] = (queue_name, channel)
+        self._poll_queue(queue_tag, channel, callback, lazy)
         self.logger.info('Subscribed to %s with id %r', dest, queue_tag)
         returnValue(queue_tag)
 
@@ -120,11 +369,11 @@ class AMQPMessageBus(object):
         """Unsubscribe from message bus
 
         """
-        queue_name = self.queues[id]
+        queue_name, channel = self.queues[id]
         self.logger.debug('Unsubscribe... from queue %s with id %s',
                           queue_name, id)
-        yield self.channel.basic_cancel(id)
-        yield self.channel.queue_delete(queue=queue_name)
+        yield channel.basic_cancel(id)
+        yield channel.queue_delete(queue=queue_name)
         del self.queues[id]
         queue = yield self.conn.queue(id)
         queue.close()
@@ -137,5 +386,6 @@ class AMQPMessageBus(object):
 
         """
         self.logger.debug('Closing message bus ...')
+        self.flush()
         yield self.conn.close('Closed by user')
         self.logger.info('Closed message bus')
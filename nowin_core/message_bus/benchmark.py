@@ -0,0 +1,563 @@
+"""Benchmark of message bus
+
+Encode and decode heartbeat payloads of proxies, which carry listener counts
+of every radio as update_proxy_connections takes, with each codec, and
+print payload size and messages per second.
+
+Make remote calls to an echo server through an in-process broker, which
+takes a round trip time for every operation, with RemoteCall and RPCClient,
+and print latency of calls and broker operations per call.
+
+Publish through AMQPMessageBus to a sink over loopback, and print messages
+per second and writes to the connection with and without batching.
+
+Consume through AMQPMessageBus from an in-process AMQP stand-in, and print
+messages per second with different prefetch and ack modes for a slow
+asynchronous consumer.
+
+Send messages through LocalMessageBus to a subscriber in the same process,
+and print messages per second with and without copy on send.
+
+Simulate a broker restart in front of hundreds of servers supervised by
+ReconnectSupervisor, and print peak connection attempts per second and
+time until all of them are back, with fixed delay and with jittered
+exponential backoff.
+
+"""
+import logging
+import random
+import time
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+from txamqp.queue import TimeoutDeferredQueue
+
+from nowin_core.message_bus import codec
+from nowin_core.message_bus.amqp import AMQPMessageBus
+from nowin_core.message_bus.local import LocalBroker
+from nowin_core.message_bus.local import LocalMessageBus
+from nowin_core.message_bus.router import TopicTrie
+from nowin_core.message_bus.rpc import RPCClient
+from nowin_core.message_bus.rpc import RemoteCall
+from nowin_core.message_bus.supervisors import ReconnectSupervisor
+from nowin_core.patterns import observer
+
+
+def makeProxyPayload(radio_count):
+    """Make a heartbeat payload of a proxy with `radio_count` radios
+
+    """
+    radios = {}
+    for i in xrange(radio_count):
+        radios[u'user%05d' % i] = random.randint(0, 500)
+    return dict(
+        server_name='proxy%02d' % random.randint(0, 99),
+        type='proxy',
+        radios=radios,
+    )
+
+
+def measure(func, arg, duration=1.0):
+    """Call func(arg) repeatedly for about `duration` seconds, return calls
+    per second
+
+    """
+    count = 0
+    begin = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in xrange(10):
+            func(arg)
+        count += 10
+        elapsed = time.time() - begin
+    return count / elapsed
+
+
+class LatencyBus(object):
+
+    """In-process stand-in of a broker, subscribe and unsubscribe take a
+    round trip of `latency` seconds, messages are delivered in half of it,
+    and all operations are counted
+
+    """
+
+    def __init__(self, reactor, latency):
+        self.reactor = reactor
+        self.latency = latency
+        #: count of operations on broker
+        self.op_count = 0
+        self._subs = TopicTrie()
+        self._patterns = {}
+        self._next_id = 0
+
+    def subscribe(self, dest, callback):
+        self.op_count += 1
+        self._next_id += 1
+        id = self._next_id
+        d = defer.Deferred()
+
+        def done():
+            self._subs.add(dest, callback)
+            self._patterns[id] = (dest, callback)
+            d.callback(id)
+        self.reactor.callLater(self.latency, done)
+        return d
+
+    def unsubscribe(self, id):
+        self.op_count += 1
+        d = defer.Deferred()
+
+        def done():
+            dest, callback = self._patterns.pop(id)
+            self._subs.remove(dest, callback)
+            d.callback(None)
+        self.reactor.callLater(self.latency, done)
+        return d
+
+    def send(self, dest, data):
+        self.op_count += 1
+
+        def deliver():
+            for callback in self._subs.match(dest):
+                callback(dest, data)
+        self.reactor.callLater(self.latency / 2.0, deliver)
+        return defer.succeed(None)
+
+
+@defer.inlineCallbacks
+def runRPC(reactor, use_client, concurrency, count, latency):
+    """Make `count` calls in `concurrency` concurrent loops, return mean
+    latency in seconds, and broker operations per call
+
+    """
+    bus = LatencyBus(reactor, latency)
+
+    def echo(dest, data):
+        bus.send(data['reply_dest'], data['value'])
+    yield bus.subscribe('rpc.echo', echo)
+    bus.op_count = 0
+
+    client = RPCClient(bus, reactor=reactor)
+    yield client.start()
+    latencies = []
+
+    @defer.inlineCallbacks
+    def loop():
+        for i in xrange(count // concurrency):
+            begin = time.time()
+            if use_client:
+                yield client.call('rpc.echo', dict(value=i))
+            else:
+                call = RemoteCall(bus, 'rpc.echo', dict(value=i),
+                                  reactor=reactor)
+                yield call()
+            latencies.append(time.time() - begin)
+
+    yield defer.DeferredList([loop() for _ in xrange(concurrency)])
+    client.close()
+    defer.returnValue((sum(latencies) / len(latencies),
+                       bus.op_count / float(len(latencies))))
+
+
+@defer.inlineCallbacks
+def runAllRPC(reactor):
+    latency = 0.002
+    print 'remote calls with %d ms broker round trip' % (latency * 1000)
+    for concurrency in [1, 50]:
+        for name, use_client in [('RemoteCall', False),
+                                 ('RPCClient', True)]:
+            mean, ops = yield runRPC(reactor, use_client, concurrency,
+                                     1000, latency)
+            print '  %-12s concurrency=%-4d %8.2f ms/call %6.2f ops/call' % (
+                name, concurrency, mean * 1000, ops)
+
+
+class _StandInResult(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _StandInMessage(object):
+
+    def __init__(self, routing_key, content, delivery_tag):
+        self.routing_key = routing_key
+        self.content = content
+        self.delivery_tag = delivery_tag
+
+
+class _StandInConsumer(object):
+
+    def __init__(self, channel, queue_name, tag, no_ack):
+        self.channel = channel
+        self.queue_name = queue_name
+        self.tag = tag
+        self.no_ack = no_ack
+        self.backlog = []
+        self.unacked = 0
+
+
+class _StandInChannel(object):
+
+    def __init__(self, broker, id):
+        self.broker = broker
+        self.id = id
+        self.prefetch = None
+        self.consumers = []
+        self._next_tag = 0
+
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+        return defer.succeed(None)
+
+    def exchange_declare(self, exchange, type):
+        return defer.succeed(None)
+
+    def basic_publish(self, exchange, routing_key, content):
+        self.broker.publish(routing_key, content)
+        return defer.succeed(None)
+
+    def queue_declare(self, exclusive, durable):
+        return defer.succeed(_StandInResult(queue=self.broker.newQueue()))
+
+    def queue_bind(self, exchange, queue, routing_key):
+        self.broker.bindings.add(routing_key, queue)
+        return defer.succeed(None)
+
+    def basic_consume(self, queue, no_ack):
+        tag = 'tag-' + queue
+        consumer = _StandInConsumer(self, queue, tag, no_ack)
+        self.consumers.append(consumer)
+        self.broker.consumers[queue] = consumer
+        return defer.succeed(_StandInResult(consumer_tag=tag))
+
+    def basic_ack(self, delivery_tag):
+        for consumer in self.consumers:
+            if consumer.unacked:
+                consumer.unacked -= 1
+                self.broker.pump(consumer)
+                break
+
+    def basic_cancel(self, tag):
+        return defer.succeed(None)
+
+    def queue_delete(self, queue):
+        return defer.succeed(None)
+
+
+class AMQPStandIn(object):
+
+    """In-process stand-in of an AMQP connection and broker, it routes
+    published messages to queues bound with topic patterns, and delivers
+    them to consumers with respect to prefetch count of their channels
+
+    """
+
+    def __init__(self):
+        #: count of published messages
+        self.published_count = 0
+        self.bindings = TopicTrie()
+        self.consumers = {}
+        self._queues = {}
+        self._next_queue = 0
+        self._next_delivery = 0
+
+    def newQueue(self):
+        self._next_queue += 1
+        return 'q%d' % self._next_queue
+
+    def publish(self, routing_key, content):
+        self.published_count += 1
+        for queue_name in self.bindings.match(routing_key):
+            consumer = self.consumers.get(queue_name)
+            if consumer is None:
+                continue
+            self._next_delivery += 1
+            consumer.backlog.append(_StandInMessage(
+                routing_key, content, self._next_delivery))
+            self.pump(consumer)
+
+    def pump(self, consumer):
+        prefetch = consumer.channel.prefetch
+        queue = self._queues[consumer.tag]
+        while consumer.backlog:
+            if not consumer.no_ack and prefetch and \
+                    consumer.unacked >= prefetch:
+                break
+            if not consumer.no_ack:
+                consumer.unacked += 1
+            queue.put(consumer.backlog.pop(0))
+
+    def authenticate(self, user, password):
+        return defer.succeed(None)
+
+    def channel(self, id):
+        return defer.succeed(_StandInChannel(self, id))
+
+    def queue(self, tag):
+        if tag not in self._queues:
+            self._queues[tag] = TimeoutDeferredQueue()
+        return defer.succeed(self._queues[tag])
+
+    def close(self, reason):
+        return defer.succeed(None)
+
+
+@defer.inlineCallbacks
+def makeAMQPBus(**kwargs):
+    broker = AMQPStandIn()
+    bus = AMQPMessageBus([('localhost', 5672)], **kwargs)
+    bus._connect = lambda host: defer.succeed(broker)
+    yield bus.login('guest', 'guest')
+    defer.returnValue((bus, broker))
+
+
+class _Sink(Protocol):
+
+    def connectionLost(self, reason):
+        self.factory.lost.callback(None)
+
+
+class _SinkFactory(Factory):
+
+    """Factory of connections discard everything received
+
+    """
+
+    protocol = _Sink
+
+    def __init__(self):
+        self.lost = defer.Deferred()
+
+
+@defer.inlineCallbacks
+def runAMQPPublish(reactor, count, publish_channels=1, **kwargs):
+    """Publish `count` messages to a sink over loopback, return messages per
+    second until the sink got all of them, and writes to the connection
+    per message
+
+    """
+    sink = _SinkFactory()
+    port = reactor.listenTCP(0, sink, interface='127.0.0.1')
+    bus = AMQPMessageBus([('127.0.0.1', port.getHost().port)],
+                         reactor=reactor, **kwargs)
+    bus.conn = yield bus._connect(bus.hosts[0])
+    # the sink never replies, so channels are used without opening
+    bus._publishers = []
+    for id in xrange(1, publish_channels + 1):
+        channel = yield bus.conn.channel(id)
+        bus._publishers.append(channel)
+    writes = bus.conn.write_count
+    data = dict(value=1)
+    begin = time.time()
+    yield defer.DeferredList([bus.send('bench.publish', data)
+                              for _ in xrange(count)])
+    # all written data is sent before the connection is closed
+    bus.conn.transport.loseConnection()
+    yield sink.lost
+    elapsed = time.time() - begin
+    yield port.stopListening()
+    defer.returnValue((count / elapsed,
+                       (bus.conn.write_count - writes) / float(count)))
+
+
+@defer.inlineCallbacks
+def runAMQPConsume(reactor, count, work, **kwargs):
+    """Consume `count` messages with a callback takes `work` seconds
+    asynchronously, return messages per second and max count of messages
+    handled at the same time
+
+    """
+    bus, broker = yield makeAMQPBus(reactor=reactor, **kwargs)
+    state = dict(handled=0, handling=0, max_handling=0)
+    done = defer.Deferred()
+
+    def finish(_):
+        state['handling'] -= 1
+        state['handled'] += 1
+        if state['handled'] == count:
+            done.callback(None)
+
+    def callback(dest, data):
+        state['handling'] += 1
+        state['max_handling'] = max(state['max_handling'],
+                                    state['handling'])
+        d = defer.Deferred()
+        d.addCallback(finish)
+        reactor.callLater(work, d.callback, None)
+        return d
+
+    yield bus.subscribe('bench.consume', callback)
+    begin = time.time()
+    for _ in xrange(count):
+        bus.send('bench.consume', dict(value=1))
+    yield done
+    elapsed = time.time() - begin
+    defer.returnValue((count / elapsed, state['max_handling']))
+
+
+@defer.inlineCallbacks
+def runAllAMQP(reactor):
+    count = 20000
+    print 'AMQP publish of %d messages over loopback' % count
+    for channels in [1, 4]:
+        for batch_size in [None, 64]:
+            rate, writes = yield runAMQPPublish(
+                reactor, count, publish_channels=channels,
+                batch_size=batch_size)
+            print '  channels=%d batch_size=%-5s %10.0f msgs/sec ' \
+                '%6.3f writes/msg' % (channels, batch_size, rate, writes)
+
+    count = 1000
+    work = 0.001
+    print 'AMQP consume of %d messages with %d ms callbacks' % (
+        count, work * 1000)
+    for ack_mode, prefetch in [(AMQPMessageBus.ACK_NONE, None),
+                               (AMQPMessageBus.ACK_AFTER, 1),
+                               (AMQPMessageBus.ACK_AFTER, 10),
+                               (AMQPMessageBus.ACK_AFTER, 100)]:
+        rate, max_handling = yield runAMQPConsume(
+            reactor, count, work, ack_mode=ack_mode, prefetch=prefetch)
+        print '  ack_mode=%-5s prefetch=%-4s %8.0f msgs/sec ' \
+            '%5d max in flight' % (ack_mode, prefetch, rate, max_handling)
+
+
+def runLocal(reactor, count, data, copy_on_send):
+    """Send `count` messages through a local message bus and wait all of
+    them delivered, return messages per second
+
+    """
+    bus = LocalMessageBus(broker=LocalBroker(), copy_on_send=copy_on_send,
+                          reactor=reactor)
+    bus.connect()
+    done = defer.Deferred()
+    received = [0]
+
+    def callback(dest, data):
+        received[0] += 1
+        if received[0] == count:
+            done.callback(None)
+    bus.subscribe('bench.local', callback)
+    begin = time.time()
+    for _ in xrange(count):
+        bus.send('bench.local', data)
+
+    def finish(_):
+        bus.close()
+        return count / (time.time() - begin)
+    done.addCallback(finish)
+    return done
+
+
+@defer.inlineCallbacks
+def runAllLocal(reactor):
+    count = 20000
+    print 'local message bus with %d messages' % count
+    for radio_count in [10, 100]:
+        data = makeProxyPayload(radio_count)
+        for copy_on_send in [False, True]:
+            rate = yield runLocal(reactor, count, data, copy_on_send)
+            print '  radios=%-4d copy_on_send=%-5s %10.0f msgs/sec' % (
+                radio_count, copy_on_send, rate)
+
+
+@defer.inlineCallbacks
+def runAll(reactor):
+    yield runAllRPC(reactor)
+    yield runAllAMQP(reactor)
+    yield runAllLocal(reactor)
+    reactor.stop()
+
+
+class _StormBus(object):
+
+    """Message bus of a simulated server, connecting fails while the broker
+    is down
+
+    """
+
+    def __init__(self, clock, broker_state, attempts):
+        self.clock = clock
+        self.broker_state = broker_state
+        self.attempts = attempts
+        self.auth_event = observer.Subject()
+        self.conn_lost_event = observer.Subject()
+        self.conn_failed_event = observer.Subject()
+
+    def connect(self):
+        self.attempts.append(self.clock.seconds())
+        if self.clock.seconds() < self.broker_state['up_at']:
+            self.conn_failed_event()
+        else:
+            self.auth_event()
+
+
+def runReconnectStorm(servers, downtime, delay, max_delay):
+    """Drop connections of `servers` servers, and bring broker back after
+    `downtime` seconds, return total connection attempts, peak logins per
+    second the restarted broker takes, and seconds until all servers are
+    back
+
+    """
+    clock = task.Clock()
+    # thousands of retries are expected, don't log them
+    logger = logging.getLogger(__name__ + '.storm')
+    logger.setLevel(logging.ERROR)
+    broker_state = dict(up_at=downtime)
+    attempts = []
+    connected = []
+    for _ in xrange(servers):
+        bus = _StormBus(clock, broker_state, attempts)
+        ReconnectSupervisor(bus, delay=delay, max_delay=max_delay,
+                            reactor=clock, logger=logger)
+        bus.auth_event.subscribe(lambda: connected.append(clock.seconds()))
+        bus.conn_lost_event()
+    while len(connected) < servers:
+        clock.advance(0.01)
+    per_second = {}
+    for seconds in connected:
+        per_second[int(seconds)] = per_second.get(int(seconds), 0) + 1
+    return len(attempts), max(per_second.values()), max(connected)
+
+
+def main():
+    codecs = [codec.JSONCodec(), codec.DeflateCodec()]
+    for radio_count in [10, 100, 1000, 5000]:
+        data = makeProxyPayload(radio_count)
+        print '%d radios' % radio_count
+        for c in codecs:
+            body = c.encode(data)
+            assert c.decode(body) == data
+            encode_rate = measure(c.encode, data)
+            decode_rate = measure(c.decode, body)
+            print '  %-12s %8d bytes %10.0f encodes/sec %10.0f decodes/sec' % (
+                c.__class__.__name__, len(body), encode_rate, decode_rate)
+        # routing a message without inspecting it costs no decoding
+        body = codecs[0].encode(data)
+        lazy_rate = measure(lambda body: codec.LazyPayload(body), body)
+        print '  %-12s %8s       %10.0f routes/sec' % (
+            'LazyPayload', '', lazy_rate)
+
+    servers = 500
+    downtime = 10
+    print 'reconnect of %d servers after %d seconds broker restart' % (
+        servers, downtime)
+    for name, delay, max_delay in [('fixed 1s', 1, None),
+                                   ('backoff 1-10s', 1, 10),
+                                   ('backoff 1-60s', 1, 60)]:
+        attempts, peak, recovered = runReconnectStorm(
+            servers, downtime, delay, max_delay)
+        print '  %-14s %6d attempts  peak %5d logins/sec  ' \
+            'all back in %6.2f s' % (name, attempts, peak, recovered)
+
+    from twisted.internet import reactor
+    reactor.callWhenRunning(runAll, reactor)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,6 @@ def create_message_bus(type='amqp', *args, **kwargs):
     elif type.lower() == 'stomp':
         from nowin_core.message_bus.stomp import STOMPMessageBus
         return STOMPMessageBus(*args, **kwargs)
+    elif type.lower() == 'local':
+        from nowin_core.message_bus.local import LocalMessageBus
+        return LocalMessageBus(*args, **kwargs)
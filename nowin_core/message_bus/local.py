@@ -0,0 +1,234 @@
+"""In-process message bus
+
+LocalMessageBus delivers messages to subscribers in the same process
+through the reactor, without a broker and without serializing messages.
+All buses share the same LocalBroker by default, so that a publisher and
+a subscriber with their own bus still reach each other. Destinations may
+have wildcards as router does, `*` matches exactly one word and `#`
+matches zero or more words.
+
+"""
+import copy
+import itertools
+import logging
+
+from twisted.internet.defer import succeed
+
+from nowin_core.message_bus.router import TopicTrie
+from nowin_core.patterns import observer
+
+
+class _Subscription(object):
+
+    __slots__ = ('id', 'dest', 'callback', 'bus', 'active')
+
+    def __init__(self, id, dest, callback, bus):
+        self.id = id
+        self.dest = dest
+        self.callback = callback
+        self.bus = bus
+        self.active = True
+
+
+class LocalBroker(object):
+
+    """Subscriptions of local message buses in a process
+
+    """
+
+    def __init__(self):
+        self._subs = TopicTrie()
+
+    def __len__(self):
+        return len(self._subs)
+
+    def add(self, sub):
+        self._subs.add(sub.dest, sub)
+
+    def remove(self, sub):
+        self._subs.remove(sub.dest, sub)
+
+    def match(self, dest):
+        """Return subscriptions match `dest` in subscribing order
+
+        """
+        subs = self._subs.match(dest)
+        if len(subs) > 1:
+            subs.sort(key=lambda sub: sub.id)
+        return subs
+
+
+#: broker shared by local message buses by default
+default_broker = LocalBroker()
+
+# subscription ids are unique in the process, so that subscriptions of
+# different buses are ordered
+_ids = itertools.count(1)
+
+
+class LocalMessageBus(object):
+
+    """Message bus delivers messages in the process
+
+    It has the same interface and events as STOMPMessageBus, `host`, `user`
+    and `password` are accepted and ignored, so that it can be created by
+    create_message_bus with the same arguments.
+
+    """
+
+    def __init__(
+        self,
+        host=None,
+        user=None,
+        password=None,
+        copy_on_send=False,
+        broker=None,
+        reactor=None,
+        logger=None
+    ):
+        """
+
+        @param copy_on_send: send deep copy of data, so that changes made by
+            the sender after sending do not reach subscribers
+        @param broker: LocalBroker to use, None for the default one
+        """
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+
+        self.host = host
+        self.user = user
+        self.copy_on_send = copy_on_send
+        self.broker = broker
+        if self.broker is None:
+            self.broker = default_broker
+
+        # called when we are authorized
+        self.auth_event = observer.Subject()
+        # called when connection lost
+        self.conn_lost_event = observer.Subject()
+        # called when connection to host failed
+        self.conn_failed_event = observer.Subject()
+
+        #: is this bus connected
+        self.connected = False
+        #: is this connection closed
+        self.closed = False
+        #: count of sent messages
+        self.sent_count = 0
+        #: count of messages delivered to callbacks of this bus
+        self.delivered_count = 0
+
+        # map id to subscriptions of this bus
+        self._subs = {}
+        # (subscriptions, dest, data) to deliver in next reactor iteration,
+        # they are delivered in one call instead of one call per message
+        self._pending = []
+        self._deliver_call = None
+
+        self.logger.info('Create local message bus')
+
+    def connect(self):
+        """Connect to the local broker
+
+        """
+        self.closed = False
+        if self.connected:
+            self.logger.warn('Already connected')
+            return succeed(None)
+        self.connected = True
+        self.logger.info('Connected to local broker')
+        self.auth_event()
+        return succeed(None)
+
+    def send(self, dest, data):
+        """Send data to message bus, callbacks of subscriptions are called
+        in next reactor iteration
+
+        """
+        if not self.connected:
+            self.logger.warn('Not connected, ignore send cmd to %s', dest)
+            return succeed(None)
+        dest = str(dest)
+        if self.copy_on_send:
+            data = copy.deepcopy(data)
+        self.sent_count += 1
+        subs = self.broker.match(dest)
+        if subs:
+            self._pending.append((subs, dest, data))
+            if self._deliver_call is None:
+                self._deliver_call = self.reactor.callLater(0, self._deliver)
+        return succeed(None)
+
+    def _deliver(self):
+        self._deliver_call = None
+        # messages sent by callbacks are delivered in next iteration
+        pending = self._pending
+        self._pending = []
+        for subs, dest, data in pending:
+            for sub in subs:
+                # unsubscribed after the message was sent
+                if not sub.active:
+                    continue
+                sub.bus.delivered_count += 1
+                try:
+                    sub.callback(dest, data)
+                except Exception:
+                    self.logger.error('Failed to deliver message of %s to %r',
+                                      dest, sub.callback, exc_info=True)
+
+    def subscribe(self, dest, callback):
+        """Subscribe to specific destination, the callback will be called when
+        the there is message in the destination
+
+        """
+        if not self.connected:
+            self.logger.warn('Not connected, ignore subscribe cmd to %s', dest)
+            return succeed(None)
+        dest = str(dest)
+        sub = _Subscription(next(_ids), dest, callback, self)
+        self._subs[sub.id] = sub
+        self.broker.add(sub)
+        self.logger.info('Subscribed to %s with id %s', dest, sub.id)
+        return succeed(sub.id)
+
+    def unsubscribe(self, id):
+        """Unsubscribe from message bus, `id` is the id returned by
+        subscribe
+
+        """
+        sub = self._subs.pop(id, None)
+        if sub is None:
+            self.logger.warn('Unknown subscription %s', id)
+            return succeed(None)
+        sub.active = False
+        self.broker.remove(sub)
+        self.logger.info('Unsubscribed from %s with id %s', sub.dest, id)
+        return succeed(None)
+
+    def close(self):
+        """Close connection to message bus, all subscriptions are dropped
+
+        """
+        if not self.connected or self.closed:
+            self.logger.warn('Already closed')
+            return
+        for id in self._subs.keys():
+            self.unsubscribe(id)
+        self.connected = False
+        self.closed = True
+        self.logger.info('Closed local message bus')
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            sent=self.sent_count,
+            delivered=self.delivered_count,
+            subscriptions=len(self._subs),
+        )
@@ -0,0 +1,316 @@
+"""Last value cache of state topics over a message bus
+
+Most messages on the bus are state, such as listener counts or server
+load, rather than events, only the latest value of a destination matters.
+LastValueCache wraps any message bus created by create_message_bus, and
+treats destinations matching its state topics specially:
+
+ * Sending a value equal to the last one sent to the destination is
+   suppressed.
+ * Values are sent in next reactor iteration, or once the message bus is
+   authorized again, a value superseded by a newer one of the same
+   destination before that is dropped instead of sent.
+ * A subscriber gets the latest values of the destination right after
+   subscribing, from values this cache has seen, and from snapshots
+   published by caches of publishers in other processes.
+
+Other destinations are passed to the message bus as they are.
+
+"""
+import collections
+import json
+import logging
+
+from twisted.internet import defer
+
+from nowin_core.message_bus.router import TopicTrie
+from nowin_core.message_bus.router import isPattern
+from nowin_core.message_bus.rpc import RPCClient
+
+
+class LastValueCache(object):
+
+    """Message bus wrapper keeps the last values of state topics
+
+    `state_topics` are destinations or patterns of state topics, `*`
+    matches exactly one word and `#` matches zero or more words. Publishers
+    answer snapshot requests sent to `snapshot_dest` with their latest
+    values, set it to None to use values seen in this process only. Values
+    sent should not be modified after sending.
+
+    To keep subscriptions across reconnects, pass a Router as `msgbus`.
+
+    """
+
+    def __init__(
+        self,
+        msgbus,
+        state_topics=(),
+        snapshot_dest='lvc.snapshot',
+        snapshot_timeout=2,
+        reactor=None,
+        logger=None
+    ):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        #: underlying message bus
+        self.msgbus = msgbus
+        #: destination of snapshot requests, None to disable them
+        self.snapshot_dest = snapshot_dest
+        #: seconds to wait for snapshots from publishers
+        self.snapshot_timeout = snapshot_timeout
+        #: count of state values sent
+        self.sent_count = 0
+        #: count of state values suppressed for being unchanged
+        self.suppressed_count = 0
+        #: count of state values superseded before they were sent
+        self.superseded_count = 0
+        #: count of cached values delivered to new subscriptions
+        self.replayed_count = 0
+        #: count of snapshot requests answered
+        self.snapshot_count = 0
+
+        # patterns of state topics
+        self._topics = TopicTrie()
+        # map destination to encoded last value sent
+        self._published = {}
+        # map destination to value waiting to be sent, in sending order
+        self._outbox = collections.OrderedDict()
+        self._flush_call = None
+        # map destination to last value received
+        self._values = {}
+        # map id to (dest, callback) of state subscriptions
+        self._subs = {}
+        # subscription id of snapshot requests
+        self._snapshot_sub = None
+        self._rpc = None
+        #: can messages be sent now
+        self.ready = getattr(msgbus, 'authorized',
+                             getattr(msgbus, 'connected', True))
+
+        auth_event = getattr(self.msgbus, 'auth_event', None)
+        if auth_event is not None:
+            auth_event.subscribe(self.handleAuth)
+        conn_lost_event = getattr(self.msgbus, 'conn_lost_event', None)
+        if conn_lost_event is not None:
+            conn_lost_event.subscribe(self.handleConnLost)
+
+        for pattern in state_topics:
+            self.addStateTopic(pattern)
+
+    def addStateTopic(self, pattern):
+        """Treat destinations match `pattern` as state topics
+
+        """
+        self._topics.add(str(pattern), pattern)
+
+    def isStateTopic(self, dest):
+        """Is `dest` a state topic, a pattern is a state topic only if it's
+        added as one
+
+        """
+        if isPattern(dest):
+            return dest in self._topics.match(dest)
+        return bool(self._topics.match(dest))
+
+    def send(self, dest, data):
+        """Send data to message bus, unchanged values of state topics are
+        suppressed
+
+        """
+        dest = str(dest)
+        if not self.isStateTopic(dest):
+            return self.msgbus.send(dest, data)
+        encoded = json.dumps(data, sort_keys=True)
+        if self._published.get(dest) == encoded:
+            self.suppressed_count += 1
+            return defer.succeed(None)
+        self._published[dest] = encoded
+        if dest in self._outbox:
+            self.superseded_count += 1
+            del self._outbox[dest]
+        self._outbox[dest] = data
+        if self.snapshot_dest is not None and self._snapshot_sub is None:
+            self._subscribeSnapshot()
+        self._scheduleFlush()
+        return defer.succeed(None)
+
+    def _scheduleFlush(self):
+        if self.ready and self._outbox and self._flush_call is None:
+            self._flush_call = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Send state values waiting in outbox now
+
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        outbox = self._outbox
+        self._outbox = collections.OrderedDict()
+        for dest, data in outbox.iteritems():
+            self.sent_count += 1
+            d = defer.maybeDeferred(self.msgbus.send, dest, data)
+            d.addErrback(self._handleSendError, dest)
+
+    def _handleSendError(self, failure, dest):
+        self.logger.error('Failed to send state of %s, %s',
+                          dest, failure.getErrorMessage())
+        # send it again next time even if it's unchanged
+        self._published.pop(dest, None)
+
+    def subscribe(self, dest, callback):
+        """Subscribe to specific destination, for state topics, the callback
+        is called with cached latest values right after subscribing
+
+        """
+        dest = str(dest)
+        if not self.isStateTopic(dest):
+            return self.msgbus.subscribe(dest, callback)
+
+        def receive(msg_dest, data):
+            self._values[msg_dest] = data
+            callback(msg_dest, data)
+
+        def subscribed(id):
+            self._subs[id] = (dest, callback)
+            self._replay(dest, callback, self._values)
+            if self.snapshot_dest is not None:
+                self._requestSnapshot(id, dest)
+            return id
+
+        d = defer.maybeDeferred(self.msgbus.subscribe, dest, receive)
+        d.addCallback(subscribed)
+        return d
+
+    def unsubscribe(self, id):
+        """Unsubscribe from message bus, `id` is the id returned by
+        subscribe
+
+        """
+        self._subs.pop(id, None)
+        return self.msgbus.unsubscribe(id)
+
+    def close(self):
+        """Close the message bus, values waiting to be sent are dropped
+
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        self._outbox.clear()
+        if self._rpc is not None:
+            self._rpc.close()
+        return self.msgbus.close()
+
+    def getValue(self, dest, default=None):
+        """Get cached latest value of `dest`
+
+        """
+        return self._values.get(dest, default)
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            sent=self.sent_count,
+            suppressed=self.suppressed_count,
+            superseded=self.superseded_count,
+            replayed=self.replayed_count,
+            snapshots=self.snapshot_count,
+            outbox=len(self._outbox),
+            cached=len(self._values),
+        )
+
+    def handleAuth(self):
+        """Called when the message bus is authorized, send values waiting in
+        outbox
+
+        """
+        self.ready = True
+        self._scheduleFlush()
+
+    def handleConnLost(self):
+        """Called when connection of the message bus lost, values are held
+        in outbox until authorized again
+
+        """
+        self.ready = False
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+    def _replay(self, pattern, callback, values):
+        """Call `callback` with values of destinations match `pattern`
+
+        """
+        if isPattern(pattern):
+            trie = TopicTrie()
+            trie.add(pattern, pattern)
+            dests = [dest for dest in values if trie.match(dest)]
+        elif pattern in values:
+            dests = [pattern]
+        else:
+            return
+        for dest in sorted(dests):
+            self.replayed_count += 1
+            try:
+                callback(dest, values[dest])
+            except Exception:
+                self.logger.error('Failed to deliver cached value of %s to '
+                                  '%r', dest, callback, exc_info=True)
+
+    def _subscribeSnapshot(self):
+        self._snapshot_sub = defer.maybeDeferred(
+            self.msgbus.subscribe, self.snapshot_dest, self._handleSnapshot)
+        self._snapshot_sub.addErrback(self._handleSnapshotError)
+
+    def _handleSnapshotError(self, failure):
+        self.logger.error('Failed to subscribe to snapshot requests, %s',
+                          failure.getErrorMessage())
+        self._snapshot_sub = None
+
+    def _handleSnapshot(self, dest, data):
+        """Called to answer a snapshot request with values sent by this
+        cache
+
+        """
+        trie = TopicTrie()
+        trie.add(data['pattern'], None)
+        values = {}
+        for state_dest, encoded in self._published.iteritems():
+            if trie.match(state_dest):
+                values[state_dest] = json.loads(encoded)
+        if not values:
+            return
+        self.snapshot_count += 1
+        self.msgbus.send(data['reply_dest'], values)
+
+    def _requestSnapshot(self, id, pattern):
+        """Ask publishers of `pattern` for their latest values, and deliver
+        values not received yet to subscription `id`
+
+        """
+        if self._rpc is None:
+            self._rpc = RPCClient(self.msgbus, reactor=self.reactor,
+                                  logger=self.logger)
+
+        def progress(_, values):
+            sub = self._subs.get(id)
+            # values received since subscribing are newer
+            values = dict((dest, data) for dest, data in values.iteritems()
+                          if dest not in self._values)
+            self._values.update(values)
+            if sub is not None:
+                self._replay(pattern, sub[1], values)
+
+        d = self._rpc.scatter(self.snapshot_dest, dict(pattern=pattern),
+                              timeout=self.snapshot_timeout,
+                              progress=progress)
+        d.addErrback(lambda failure: None)
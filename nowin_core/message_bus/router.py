@@ -0,0 +1,399 @@
+"""Local subscription router over a message bus
+
+Router holds only one subscription on the broker per destination or
+pattern, no matter how many callbacks in the process subscribe to it, and
+fans messages out to them locally. Destinations are words separated by dots,
+in patterns, `*` matches exactly one word, and `#` matches zero or more
+words. An exact destination covered by a pattern already subscribed doesn't
+get a broker subscription of its own, it is filtered out of messages of
+the pattern instead.
+
+"""
+import logging
+
+from twisted.internet import defer
+
+from nowin_core.message_bus.codec import LazyPayload
+
+#: wildcard matches exactly one word
+SINGLE_WILDCARD = '*'
+#: wildcard matches zero or more words
+MULTI_WILDCARD = '#'
+
+
+def isPattern(dest):
+    """Is `dest` a pattern with wildcards
+
+    """
+    for word in dest.split('.'):
+        if word in (SINGLE_WILDCARD, MULTI_WILDCARD):
+            return True
+    return False
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie(object):
+
+    """Trie maps patterns to values, and finds values of patterns match a
+    topic
+
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, value):
+        """Add `value` for `pattern`
+
+        """
+        node = self._root
+        for word in pattern.split('.'):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = _Node()
+            node = child
+        node.values.append(value)
+        self._count += 1
+
+    def remove(self, pattern, value):
+        """Remove `value` of `pattern`
+
+        """
+        path = [self._root]
+        words = pattern.split('.')
+        for word in words:
+            path.append(path[-1].children[word])
+        path[-1].values.remove(value)
+        self._count -= 1
+        # prune empty nodes
+        for i in xrange(len(words), 0, -1):
+            node = path[i]
+            if node.values or node.children:
+                break
+            del path[i - 1].children[words[i - 1]]
+
+    def match(self, topic):
+        """Return list of values of all patterns match `topic`
+
+        """
+        result = []
+        self._match(self._root, topic.split('.'), 0, result)
+        # a value may be matched more than once with multiple `#`
+        if len(result) > 1:
+            seen = set()
+            unique = []
+            for value in result:
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    unique.append(value)
+            result = unique
+        return result
+
+    def _match(self, node, words, i, result):
+        multi = node.children.get(MULTI_WILDCARD)
+        if multi is not None:
+            for j in xrange(i, len(words) + 1):
+                self._match(multi, words, j, result)
+        if i == len(words):
+            result.extend(node.values)
+            return
+        child = node.children.get(words[i])
+        if child is not None:
+            self._match(child, words, i + 1, result)
+        child = node.children.get(SINGLE_WILDCARD)
+        if child is not None:
+            self._match(child, words, i + 1, result)
+
+
+def matches(pattern, topic):
+    """Does `pattern` match `topic`
+
+    """
+    trie = TopicTrie()
+    trie.add(pattern, pattern)
+    return bool(trie.match(topic))
+
+
+class _LocalSubscription(object):
+
+    __slots__ = ('id', 'dest', 'callback', 'broker')
+
+    def __init__(self, id, dest, callback):
+        self.id = id
+        self.dest = dest
+        self.callback = callback
+        self.broker = None
+
+
+class _BrokerSubscription(object):
+
+    __slots__ = ('pattern', 'id', 'ready', 'waiters', 'locals')
+
+    def __init__(self, pattern):
+        #: pattern or destination subscribed on the broker
+        self.pattern = pattern
+        #: subscription id returned by the message bus
+        self.id = None
+        #: is the subscription confirmed by the message bus
+        self.ready = False
+        #: deferreds waiting for the subscription
+        self.waiters = []
+        #: trie of local subscriptions
+        self.locals = TopicTrie()
+
+
+class Router(object):
+
+    """Router fans messages of one broker subscription out to many local
+    subscriptions
+
+    Router has the same send, subscribe and unsubscribe methods as a
+    message bus, it can be used in place of any message bus. `#` in
+    patterns is translated to `multi_wildcard` for the broker, for
+    example, ActiveMQ uses `>`.
+
+    When the message bus has `auth_event`, the router subscribes all
+    destinations again every time it's authorized, so that subscriptions
+    survive reconnects. `authorized`, `auth_event` and `conn_lost_event`
+    of the message bus are available on the router, so that wrappers over
+    it can follow the connection as well.
+
+    When the message bus has `lazy_payloads`, broker subscriptions get
+    messages undecoded, a message is decoded once for all local callbacks,
+    and messages without local subscriptions are never decoded.
+
+    """
+
+    def __init__(self, msgbus, multi_wildcard=MULTI_WILDCARD, logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        #: underlying message bus
+        self.msgbus = msgbus
+        #: multiple words wildcard of the broker
+        self.multi_wildcard = multi_wildcard
+        #: count of messages delivered to local callbacks
+        self.delivered_count = 0
+        #: count of messages from broker without local subscriptions
+        self.dropped_count = 0
+
+        # map pattern to broker subscriptions
+        self._brokers = {}
+        # trie of broker subscriptions with wildcards
+        self._wildcards = TopicTrie()
+        # map id to local subscriptions
+        self._locals = {}
+        self._next_id = 0
+
+        auth_event = getattr(self.msgbus, 'auth_event', None)
+        if auth_event is not None:
+            auth_event.subscribe(self.handleAuth)
+
+    @property
+    def authorized(self):
+        """Is the message bus authorized, True if the message bus doesn't
+        tell
+
+        """
+        return getattr(self.msgbus, 'authorized',
+                       getattr(self.msgbus, 'connected', True))
+
+    @property
+    def auth_event(self):
+        """auth_event of the message bus, None if it doesn't have one
+
+        """
+        return getattr(self.msgbus, 'auth_event', None)
+
+    @property
+    def conn_lost_event(self):
+        """conn_lost_event of the message bus, None if it doesn't have one
+
+        """
+        return getattr(self.msgbus, 'conn_lost_event', None)
+
+    def _toBroker(self, pattern):
+        if self.multi_wildcard == MULTI_WILDCARD:
+            return pattern
+        words = pattern.split('.')
+        return '.'.join(self.multi_wildcard if word == MULTI_WILDCARD
+                        else word for word in words)
+
+    def send(self, dest, data):
+        """Send data to message bus
+
+        """
+        return self.msgbus.send(dest, data)
+
+    def subscribe(self, dest, callback):
+        """Subscribe `callback` to destination or pattern `dest`, return a
+        Deferred fired with subscription id
+
+        """
+        dest = str(dest)
+        self._next_id += 1
+        sub = _LocalSubscription(self._next_id, dest, callback)
+        self._locals[sub.id] = sub
+
+        broker = self._brokers.get(dest)
+        if broker is None and not isPattern(dest):
+            covering = self._wildcards.match(dest)
+            if covering:
+                broker = covering[0]
+        if broker is None:
+            broker = self._subscribeBroker(dest)
+        self._attach(sub, broker)
+        self.logger.debug('Subscribed %s to broker subscription %s',
+                          dest, broker.pattern)
+        if broker.ready:
+            return defer.succeed(sub.id)
+        d = defer.Deferred()
+        broker.waiters.append((d, sub.id))
+        return d
+
+    def unsubscribe(self, id):
+        """Unsubscribe local subscription `id`
+
+        """
+        sub = self._locals.pop(id)
+        broker = sub.broker
+        broker.locals.remove(sub.dest, sub)
+        sub.broker = None
+        if not len(broker.locals):
+            return self._unsubscribeBroker(broker)
+        return defer.succeed(None)
+
+    def close(self):
+        """Close the message bus
+
+        """
+        return self.msgbus.close()
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            broker_subscriptions=len(self._brokers),
+            local_subscriptions=len(self._locals),
+            delivered=self.delivered_count,
+            dropped=self.dropped_count,
+        )
+
+    def handleAuth(self):
+        """Called when the message bus is authorized, subscribe all
+        broker subscriptions again
+
+        """
+        for broker in self._brokers.values():
+            broker.ready = False
+            self._issueSubscribe(broker)
+
+    def _attach(self, sub, broker):
+        sub.broker = broker
+        broker.locals.add(sub.dest, sub)
+
+    def _subscribeBroker(self, pattern):
+        broker = _BrokerSubscription(pattern)
+        self._brokers[pattern] = broker
+        if isPattern(pattern):
+            self._wildcards.add(pattern, broker)
+        self._issueSubscribe(broker)
+        return broker
+
+    def _issueSubscribe(self, broker):
+        def dispatch(dest, data):
+            self._dispatch(broker, dest, data)
+
+        kwargs = {}
+        if getattr(self.msgbus, 'lazy_payloads', False):
+            kwargs['lazy'] = True
+        d = defer.maybeDeferred(self.msgbus.subscribe,
+                                self._toBroker(broker.pattern), dispatch,
+                                **kwargs)
+        d.addCallback(self._handleSubscribed, broker)
+        d.addErrback(self._handleSubscribeFailed, broker)
+
+    def _handleSubscribed(self, id, broker):
+        broker.id = id
+        broker.ready = True
+        if self._brokers.get(broker.pattern) is not broker:
+            # unsubscribed before it's confirmed
+            self.msgbus.unsubscribe(id)
+        else:
+            self.logger.info('Subscribed to %s on broker', broker.pattern)
+            if isPattern(broker.pattern):
+                self._mergeCovered(broker)
+        waiters = broker.waiters
+        broker.waiters = []
+        for d, sub_id in waiters:
+            d.callback(sub_id)
+
+    def _handleSubscribeFailed(self, failure, broker):
+        self.logger.error('Failed to subscribe to %s, %s',
+                          broker.pattern, failure.getErrorMessage())
+        waiters = broker.waiters
+        broker.waiters = []
+        for d, _ in waiters:
+            d.errback(failure)
+
+    def _mergeCovered(self, wildcard):
+        """Move local subscriptions of exact destinations covered by
+        `wildcard` onto it, and drop their broker subscriptions
+
+        """
+        for pattern, broker in self._brokers.items():
+            if broker is wildcard or isPattern(pattern) or \
+                    not broker.ready or not matches(wildcard.pattern, pattern):
+                continue
+            for sub in broker.locals.match(pattern):
+                broker.locals.remove(sub.dest, sub)
+                self._attach(sub, wildcard)
+            self._unsubscribeBroker(broker)
+            self.logger.info('Merged subscription %s into %s',
+                             pattern, wildcard.pattern)
+
+    def _unsubscribeBroker(self, broker):
+        del self._brokers[broker.pattern]
+        if isPattern(broker.pattern):
+            self._wildcards.remove(broker.pattern, broker)
+        self.logger.info('Unsubscribe from %s on broker', broker.pattern)
+        if not broker.ready:
+            # will be unsubscribed once it's confirmed
+            return defer.succeed(None)
+        return defer.maybeDeferred(self.msgbus.unsubscribe, broker.id)
+
+    def _dispatch(self, broker, dest, data):
+        subs = broker.locals.match(dest)
+        if not subs:
+            self.dropped_count += 1
+            return
+        if isinstance(data, LazyPayload):
+            try:
+                data = data.decode()
+            except Exception:
+                self.dropped_count += 1
+                self.logger.error('Failed to decode message of %s', dest,
+                                  exc_info=True)
+                return
+        if len(subs) > 1:
+            subs.sort(key=lambda sub: sub.id)
+        for sub in subs:
+            self.delivered_count += 1
+            try:
+                sub.callback(dest, data)
+            except Exception:
+                self.logger.error('Failed to deliver message of %s to %r',
+                                  dest, sub.callback, exc_info=True)
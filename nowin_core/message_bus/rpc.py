@@ -1,7 +1,12 @@
+import collections
+import json
 import logging
 import uuid
 
 from twisted.internet import defer
+from twisted.python import failure
+
+from nowin_core.scheduler.wheel import getWheel
 
 
 class TimeoutError(Exception):
@@ -31,6 +36,8 @@ class RemoteCall(object):
         data,
         timeout=5,
         prefix='rpc_reply.',
+        telemetry=None,
+        timer=None,
         reactor=None,
         logger=None
     ):
@@ -41,6 +48,12 @@ class RemoteCall(object):
         if self.reactor is None:
             from twisted.internet import reactor
             self.reactor = reactor
+        #: timer wheel to schedule timeout on
+        self.timer = timer
+        if self.timer is None:
+            self.timer = getWheel(self.reactor)
+        #: Telemetry to record round trip time into
+        self.telemetry = telemetry
         assert 'reply_dest' not in data, 'reply_dest should not be in data'
         #: message bus to use
         self.msgbus = msgbus
@@ -64,6 +77,8 @@ class RemoteCall(object):
         self._sub_id = None
         #: call id for timeout
         self._call_id = None
+        #: time the call was made at
+        self._begin = None
         #: deferred object for returning result and error
         self.deferred = defer.Deferred()
 
@@ -74,13 +89,15 @@ class RemoteCall(object):
         self.logger.info('Remotely calling to %s, reply_dest=%s ...',
                          self.dest, reply_dest)
         self.data['reply_dest'] = reply_dest
+        if self.telemetry is not None:
+            self._begin = self.telemetry.clock()
 
         def sub_callback(id):
             self._sub_id = id
             d = self.msgbus.send(self.dest, self.data)
             d.addErrback(self._handleError)
-            self._call_id = self.reactor.callLater(self.timeout,
-                                                   self._handleTimeout)
+            self._call_id = self.timer.callLater(self.timeout,
+                                                 self._handleTimeout)
             return id
         d = self.msgbus.subscribe(reply_dest, self._handleResult)
         d.addCallback(sub_callback)
@@ -133,6 +150,506 @@ class RemoteCall(object):
             self.logger.info('RPC canceled')
             return
         self.logger.info('Received reply to %s', dest)
+        if self.telemetry is not None:
+            self.telemetry.recordRoundTrip(
+                self.dest, self.telemetry.clock() - self._begin)
         self.replied = True
         self.deferred.callback(data)
         self._clear()
+
+
+class GatherResult(object):
+
+    """Result of a scatter/gather call
+
+    """
+
+    def __init__(self, replies, stragglers):
+        #: map responder to its reply
+        self.replies = replies
+        #: expected responders which didn't reply in time
+        self.stragglers = stragglers
+
+    def __repr__(self):
+        return '<%s replies=%d, stragglers=%r>' % (
+            self.__class__.__name__, len(self.replies), self.stragglers)
+
+
+class _Gather(object):
+
+    __slots__ = ('deferred', 'responders', 'expected', 'key', 'progress',
+                 'replies', 'timeout_call', 'finished')
+
+    def __init__(self, deferred, expected, key, progress):
+        self.deferred = deferred
+        #: map call id to responder, None for replies from a topic
+        self.responders = {}
+        #: expected responders, None for unknown
+        self.expected = expected
+        #: function returns responder of a reply from a topic
+        self.key = key
+        #: function called with (responder, reply) for every reply
+        self.progress = progress
+        #: map responder to reply
+        self.replies = {}
+        self.timeout_call = None
+        self.finished = False
+
+
+class _PendingCall(object):
+
+    __slots__ = ('dest', 'deferred', 'timeout_call', 'begin')
+
+    def __init__(self, dest, deferred, timeout_call, begin=None):
+        self.dest = dest
+        self.deferred = deferred
+        self.timeout_call = timeout_call
+        #: time the call was made at, for telemetry
+        self.begin = begin
+
+
+class RPCClient(object):
+
+    """Client makes remote calls through one shared reply subscription
+
+    Unlike RemoteCall, which subscribes to a new reply destination for
+    every call, RPCClient subscribes once to `<prefix><client id>.*`, every
+    call gets reply destination `<prefix><client id>.<call id>`, and replies
+    are matched to calls by the call id in their destination, so servers
+    reply the same way as to RemoteCall. Any number of calls can be in
+    flight, each with its own timeout.
+
+    To keep the reply subscription across reconnects, pass a Router as
+    `msgbus`, calls sent while disconnected are up to the message bus, they
+    time out if it drops them. Timeouts are scheduled on `timer`, the timer
+    wheel shared by users of the reactor by default. With `telemetry`,
+    round trip time of calls is recorded into it, replies of scatter calls
+    are not.
+
+    """
+
+    def __init__(
+        self,
+        msgbus,
+        timeout=5,
+        prefix='rpc_reply.',
+        telemetry=None,
+        timer=None,
+        reactor=None,
+        logger=None
+    ):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        #: timer wheel to schedule timeouts on
+        self.timer = timer
+        if self.timer is None:
+            self.timer = getWheel(self.reactor)
+        #: Telemetry to record round trip time into
+        self.telemetry = telemetry
+        #: message bus to use
+        self.msgbus = msgbus
+        #: default seconds until timeout
+        self.timeout = timeout
+        #: prefix of replying address
+        self.prefix = prefix
+        #: unique id of this client
+        self.uuid = uuid.uuid4().hex
+        #: count of calls
+        self.call_count = 0
+        #: count of replied calls
+        self.replied_count = 0
+        #: count of timeout calls
+        self.timeout_count = 0
+        #: count of replies to calls no longer pending
+        self.late_count = 0
+
+        # map call id to pending calls
+        self._pending = {}
+        # is the reply subscription ready
+        self._subscribed = False
+        # deferreds waiting for the reply subscription
+        self._waiters = None
+        # subscription id of replies
+        self._sub_id = None
+        self._next_id = 0
+
+    @property
+    def reply_pattern(self):
+        """Pattern of reply destinations of this client
+
+        """
+        return '%s%s.*' % (self.prefix, self.uuid)
+
+    def start(self):
+        """Subscribe to replies, return a Deferred fired when it's ready,
+        calls made before that are sent once it's ready
+
+        """
+        if self._subscribed:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        if self._waiters is not None:
+            self._waiters.append(d)
+            return d
+        self._waiters = [d]
+        sub = defer.maybeDeferred(self.msgbus.subscribe, self.reply_pattern,
+                                  self._handleReply)
+        sub.addCallbacks(self._handleSubscribed, self._handleSubscribeFailed)
+        return d
+
+    def call(self, dest, data, timeout=None):
+        """Call remote function `dest` with `data`, return a Deferred fired
+        with the reply, the Deferred can be canceled
+
+        """
+        assert 'reply_dest' not in data, 'reply_dest should not be in data'
+        if timeout is None:
+            timeout = self.timeout
+        self._next_id += 1
+        self.call_count += 1
+        call_id = str(self._next_id)
+        d = defer.Deferred(lambda _: self._handleCancel(call_id))
+        timeout_call = self.timer.callLater(timeout, self._handleTimeout,
+                                            call_id)
+        begin = None
+        if self.telemetry is not None:
+            begin = self.telemetry.clock()
+        self._pending[call_id] = _PendingCall(dest, d, timeout_call, begin)
+        self._send(call_id, dest, data)
+        return d
+
+    def scatter(self, dests, data, timeout=None, expected=None, key=None,
+                progress=None):
+        """Call remote function on many servers and gather their replies,
+        return a Deferred fired with a GatherResult
+
+        `dests` is either a list of destinations, a request is sent to each
+        of them, and they are the expected responders; or a topic, one
+        request is sent to it, and `key` is called with each reply to get
+        its responder, replies are numbered if there is no `key`. The
+        result is fired once all `expected` responders replied, or when
+        `timeout` seconds passed, with replies arrived so far and expected
+        responders which didn't reply. `progress` is called with (responder,
+        reply) as soon as each reply arrives.
+
+        """
+        assert 'reply_dest' not in data, 'reply_dest should not be in data'
+        if timeout is None:
+            timeout = self.timeout
+        topic = isinstance(dests, basestring)
+        if expected is None and not topic:
+            expected = list(dests)
+
+        gather = _Gather(None, expected, key, progress)
+        gather.deferred = defer.Deferred(
+            lambda _: self._finishGather(
+                gather, CanceledError('canceled by user')))
+        gather.timeout_call = self.timer.callLater(
+            timeout, self._finishGather, gather)
+        if topic:
+            dests = [dests]
+        calls = []
+        for dest in dests:
+            self._next_id += 1
+            self.call_count += 1
+            call_id = str(self._next_id)
+            gather.responders[call_id] = None if topic else dest
+            self._pending[call_id] = gather
+            calls.append((call_id, dest))
+        for call_id, dest in calls:
+            self._send(call_id, dest, data)
+        if expected is not None and not expected:
+            self._finishGather(gather)
+        return gather.deferred
+
+    def close(self):
+        """Cancel all pending calls and unsubscribe from replies
+
+        """
+        for call_id in list(self._pending):
+            self._fail(call_id, CanceledError('client closed'))
+        if self._sub_id is not None:
+            self.msgbus.unsubscribe(self._sub_id)
+            self._sub_id = None
+        self._subscribed = False
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            calls=self.call_count,
+            pending=len(self._pending),
+            replied=self.replied_count,
+            timeout=self.timeout_count,
+            late=self.late_count,
+        )
+
+    def _send(self, call_id, dest, data):
+        """Send call `call_id` once the reply subscription is ready
+
+        """
+        data = dict(data)
+        data['reply_dest'] = '%s%s.%s' % (self.prefix, self.uuid, call_id)
+
+        def send(_):
+            if call_id not in self._pending:
+                return
+            sent = defer.maybeDeferred(self.msgbus.send, dest, data)
+            sent.addErrback(self._handleError, call_id)
+
+        ready = self.start()
+        ready.addCallbacks(send, self._handleError, errbackArgs=(call_id,))
+
+    def _finishGather(self, gather, error=None):
+        """Fire result of `gather`, or `error` if it's given
+
+        """
+        if gather.finished:
+            return
+        gather.finished = True
+        for call_id in gather.responders:
+            self._pending.pop(call_id, None)
+        if gather.timeout_call.active():
+            gather.timeout_call.cancel()
+        if error is not None:
+            gather.deferred.errback(error)
+            return
+        stragglers = []
+        if gather.expected is not None:
+            stragglers = [responder for responder in gather.expected
+                          if responder not in gather.replies]
+        gather.deferred.callback(GatherResult(gather.replies, stragglers))
+
+    def _handleGatherReply(self, gather, call_id, data):
+        responder = gather.responders[call_id]
+        if responder is None:
+            if gather.key is not None:
+                responder = gather.key(data)
+            else:
+                responder = len(gather.replies)
+        else:
+            # only one reply from a destination
+            del self._pending[call_id]
+        if responder in gather.replies:
+            self.late_count += 1
+            return
+        self.replied_count += 1
+        gather.replies[responder] = data
+        if gather.progress is not None:
+            gather.progress(responder, data)
+        if gather.expected is not None and \
+                len(gather.replies) >= len(gather.expected) and \
+                all(r in gather.replies for r in gather.expected):
+            self._finishGather(gather)
+
+    def _handleSubscribed(self, id):
+        self._sub_id = id
+        self._subscribed = True
+        self.logger.info('Subscribed to replies %s', self.reply_pattern)
+        waiters, self._waiters = self._waiters, None
+        for d in waiters:
+            d.callback(None)
+
+    def _handleSubscribeFailed(self, failure):
+        self.logger.error('Failed to subscribe to replies %s, %s',
+                          self.reply_pattern, failure.getErrorMessage())
+        waiters, self._waiters = self._waiters, None
+        for d in waiters:
+            d.errback(failure)
+
+    def _fail(self, call_id, error):
+        call = self._pending.get(call_id)
+        if isinstance(call, _Gather):
+            self._finishGather(call, error)
+            return
+        call = self._pending.pop(call_id, None)
+        if call is None:
+            return
+        if call.timeout_call.active():
+            call.timeout_call.cancel()
+        call.deferred.errback(error)
+
+    def _handleCancel(self, call_id):
+        self._fail(call_id, CanceledError('canceled by user'))
+
+    def _handleError(self, failure, call_id):
+        self.logger.error('Failed to call %s, %s', call_id,
+                          failure.getErrorMessage())
+        gather = self._pending.get(call_id)
+        if isinstance(gather, _Gather):
+            # the destination becomes a straggler
+            del self._pending[call_id]
+            if not any(id in self._pending for id in gather.responders):
+                self._finishGather(gather)
+            return
+        self._fail(call_id, failure)
+
+    def _handleTimeout(self, call_id):
+        call = self._pending.get(call_id)
+        if call is None:
+            return
+        self.timeout_count += 1
+        self.logger.error('Failed to call to %s, timeout', call.dest)
+        self._fail(call_id, TimeoutError('timeout'))
+
+    def _handleReply(self, dest, data):
+        call_id = dest.rsplit('.', 1)[-1]
+        call = self._pending.get(call_id)
+        if isinstance(call, _Gather):
+            self._handleGatherReply(call, call_id, data)
+            return
+        call = self._pending.pop(call_id, None)
+        if call is None:
+            self.late_count += 1
+            self.logger.debug('Reply to %s is not pending', dest)
+            return
+        call.timeout_call.cancel()
+        self.replied_count += 1
+        if self.telemetry is not None:
+            self.telemetry.recordRoundTrip(
+                call.dest, self.telemetry.clock() - call.begin)
+        call.deferred.callback(data)
+
+
+class RPCCache(object):
+
+    """Cache of idempotent remote calls
+
+    Concurrent calls with the same destination and data are collapsed into
+    one remote call, and results are cached for `ttl` seconds, at most
+    `max_size` results are kept, the least recently used ones are dropped
+    first. Cached results are shared by callers, they should not be
+    modified.
+
+    `client` is either an RPCClient, or a message bus, then every remote
+    call is made with a RemoteCall.
+
+    """
+
+    def __init__(
+        self,
+        client,
+        ttl=10,
+        max_size=1024,
+        reactor=None,
+        logger=None
+    ):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        #: RPCClient or message bus to call with
+        self.client = client
+        #: default seconds to keep results
+        self.ttl = ttl
+        #: max count of cached results
+        self.max_size = max_size
+        #: count of calls served from cache
+        self.hit_count = 0
+        #: count of calls made remotely
+        self.miss_count = 0
+        #: count of calls collapsed into a call in flight
+        self.collapsed_count = 0
+
+        # map key to (expire time, result), in order of last use
+        self._cache = collections.OrderedDict()
+        # map key to deferreds waiting for the call in flight
+        self._inflight = {}
+        # increased on every invalidation
+        self._generation = 0
+
+    def _makeKey(self, dest, data):
+        return (dest, json.dumps(data, sort_keys=True))
+
+    def _callRemote(self, dest, data):
+        if hasattr(self.client, 'call'):
+            return self.client.call(dest, data)
+        call = RemoteCall(self.client, dest, dict(data), reactor=self.reactor)
+        return call()
+
+    def call(self, dest, data, ttl=None):
+        """Call remote function `dest` with `data`, return a Deferred fired
+        with the result
+
+        """
+        if ttl is None:
+            ttl = self.ttl
+        key = self._makeKey(dest, data)
+        entry = self._cache.get(key)
+        if entry is not None:
+            expire, result = entry
+            if expire > self.reactor.seconds():
+                self.hit_count += 1
+                del self._cache[key]
+                self._cache[key] = entry
+                return defer.succeed(result)
+            del self._cache[key]
+
+        d = defer.Deferred()
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            self.collapsed_count += 1
+            waiters.append(d)
+            return d
+
+        self.miss_count += 1
+        self._inflight[key] = [d]
+        generation = self._generation
+        remote = defer.maybeDeferred(self._callRemote, dest, data)
+        remote.addBoth(self._handleResult, key, ttl, generation)
+        return d
+
+    def _handleResult(self, result, key, ttl, generation):
+        waiters = self._inflight.pop(key)
+        ok = not isinstance(result, failure.Failure)
+        if ok and ttl > 0 and generation == self._generation:
+            self._cache[key] = (self.reactor.seconds() + ttl, result)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        for d in waiters:
+            if ok:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def invalidate(self, dest=None, data=None):
+        """Drop cached results of (`dest`, `data`), or all results of `dest`
+        if `data` is None, or everything if `dest` is None too, results of
+        calls in flight are not cached
+
+        """
+        self._generation += 1
+        if dest is None:
+            self._cache.clear()
+        elif data is not None:
+            self._cache.pop(self._makeKey(dest, data), None)
+        else:
+            for key in list(self._cache):
+                if key[0] == dest:
+                    del self._cache[key]
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        requests = self.hit_count + self.miss_count + self.collapsed_count
+        hit_rate = 0.0
+        if requests:
+            hit_rate = self.hit_count / float(requests)
+        return dict(
+            hits=self.hit_count,
+            misses=self.miss_count,
+            collapsed=self.collapsed_count,
+            hit_rate=hit_rate,
+            size=len(self._cache),
+            inflight=len(self._inflight),
+        )
@@ -1,9 +1,11 @@
+import collections
 import logging
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.defer import maybeDeferred
 from twisted.internet.defer import returnValue
+from twisted.internet.defer import succeed
 
 from nowin_core.patterns import observer
 from nowin_core.stomp import async_client
@@ -11,13 +13,37 @@ from nowin_core.stomp import async_client
 
 class STOMPMessageBus(object):
 
+    #: drop the oldest spooled message when the spool is full
+    SPOOL_DROP_OLDEST = 'drop_oldest'
+
+    #: keep only the latest spooled message of every destination, drop the
+    #: destination updated least recently when the spool is full
+    SPOOL_COALESCE = 'coalesce'
+
+    #: subscribe takes `lazy` argument for callbacks called with LazyPayload
+    lazy_payloads = True
+
     def __init__(
         self,
         host,
         user,
         password=None,
+        client_opts=None,
+        codec=None,
+        spool_size=0,
+        spool_policy=SPOOL_DROP_OLDEST,
+        telemetry=None,
         logger=None
     ):
+        """
+
+        @param spool_size: max count of messages sent while not connected
+            to keep, they are sent once authorized again, 0 for dropping
+            them
+        @param spool_policy: SPOOL_DROP_OLDEST or SPOOL_COALESCE
+        @param telemetry: Telemetry to record delivery latency and callback
+            time of messages into, None for no telemetry
+        """
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
@@ -25,8 +51,32 @@ class STOMPMessageBus(object):
         self.host = host
         self.user = user
         self.password = password
+        #: keyword arguments for creating STOMPClient, such as batching
+        #: options
+        self.client_opts = client_opts
+        if self.client_opts is None:
+            self.client_opts = {}
+        #: codec for encoding messages to send, None for the default codec
+        self.codec = codec
+        #: Telemetry to record into
+        self.telemetry = telemetry
+        assert spool_policy in (self.SPOOL_DROP_OLDEST, self.SPOOL_COALESCE)
+        self.spool_size = spool_size
+        self.spool_policy = spool_policy
+        #: count of spooled messages dropped because the spool was full
+        self.spool_dropped_count = 0
+        #: count of spooled messages sent after reconnecting
+        self.spool_flushed_count = 0
 
         self.client = None
+        #: is the client authorized, messages are spooled until it is
+        self.authorized = False
+        # (dest, data) of messages sent while not authorized, for coalescing
+        # policy, it maps dest to data
+        if self.spool_policy == self.SPOOL_COALESCE:
+            self._spool = collections.OrderedDict()
+        else:
+            self._spool = collections.deque()
 
         # called when we are authorized
         self.auth_event = observer.Subject()
@@ -55,6 +105,8 @@ class STOMPMessageBus(object):
         """Called when we are authorized
 
         """
+        self.authorized = True
+        self.flushSpool()
         self.auth_event()
 
     @inlineCallbacks
@@ -71,7 +123,9 @@ class STOMPMessageBus(object):
             returnValue(None)
 
         self.logger.debug('Logging in as %s ...', self.user)
-        creator = ClientCreator(reactor, async_client.STOMPClient)
+        creator = ClientCreator(reactor, async_client.STOMPClient,
+                                codec=self.codec, telemetry=self.telemetry,
+                                **self.client_opts)
         try:
             self.logger.info('Connecting to %s', self.host)
             self.client = yield creator.connectTCP(*self.host)
@@ -102,23 +156,68 @@ class STOMPMessageBus(object):
             returnValue(e)
         self.logger.info('Login as %s', self.user)
 
-    @inlineCallbacks
     def send(self, dest, data):
-        """Send data to message bus
+        """Send data to message bus, if it's not authorized, the message is
+        spooled and sent after authorized
 
         """
-        if self.client is None:
-            self.logger.warn('Not connected, ignore send cmd to %s', dest)
-            returnValue(None)
-        dest = str(dest)
-        self.logger.debug('Sending %s bytes to %s ...', len(data), dest)
-        yield maybeDeferred(self.client.send, dest, data)
-        self.logger.info('Sent %s bytes to %s', len(data), dest)
+        if self.client is None or not self.authorized:
+            if self.spool_size:
+                self._spoolMessage(str(dest), data)
+            else:
+                self.logger.warn('Not connected, ignore send cmd to %s', dest)
+            return succeed(None)
+        return maybeDeferred(self.client.send, str(dest), data)
+
+    def _spoolMessage(self, dest, data):
+        if self.spool_policy == self.SPOOL_COALESCE:
+            if dest in self._spool:
+                del self._spool[dest]
+            elif len(self._spool) >= self.spool_size:
+                self._spool.popitem(last=False)
+                self.spool_dropped_count += 1
+            self._spool[dest] = data
+            return
+        if len(self._spool) >= self.spool_size:
+            self._spool.popleft()
+            self.spool_dropped_count += 1
+        self._spool.append((dest, data))
+
+    def flushSpool(self):
+        """Send all spooled messages
+
+        """
+        if not self._spool:
+            return
+        spool = self._spool
+        if self.spool_policy == self.SPOOL_COALESCE:
+            self._spool = collections.OrderedDict()
+            messages = spool.iteritems()
+        else:
+            self._spool = collections.deque()
+            messages = spool
+        count = len(spool)
+        for dest, data in messages:
+            self.client.send(dest, data)
+        self.spool_flushed_count += count
+        self.logger.info('Sent %d spooled messages, %d dropped so far',
+                         count, self.spool_dropped_count)
+
+    def getSpoolStats(self):
+        """Get statistics of the spool as a dict
+
+        """
+        return dict(
+            spooled=len(self._spool),
+            dropped=self.spool_dropped_count,
+            flushed=self.spool_flushed_count,
+        )
 
     @inlineCallbacks
-    def subscribe(self, dest, callback):
+    def subscribe(self, dest, callback, lazy=False):
         """Subscribe to specific destination, the callback will be called when
-        the there is message in the destination
+        the there is message in the destination, with LazyPayload instead of
+        decoded data if `lazy` is True
 
         """
         if self.client is None:
@@ -126,12 +225,15 @@ class STOMPMessageBus(object):
             returnValue(None)
         dest = str(dest)
         self.logger.debug('Subscribing to %s ...', dest)
-        yield maybeDeferred(self.client.subscribe, dest, callback)
+        yield maybeDeferred(self.client.subscribe, dest, callback,
+                            lazy=lazy)
         self.logger.info('Subscribed to %s', dest)
+        returnValue(dest)
 
     @inlineCallbacks
     def unsubscribe(self, dest):
-        """Unsubscribe from message bus
+        """Unsubscribe from message bus, `dest` is the id returned by
+        subscribe
 
         """
         if self.client is None:
@@ -139,7 +241,7 @@ class STOMPMessageBus(object):
                              dest)
             returnValue(None)
         self.logger.debug('Unsubscribe... from queue %s', dest)
-        yield maybeDeferred(self.client.subscribe, dest)
+        yield maybeDeferred(self.client.unsubscribe, dest)
         self.logger.info('Unsubscribed from queue %s', dest)
 
     def close(self):
@@ -155,5 +257,6 @@ class STOMPMessageBus(object):
         self._sub_ids = []
         self.client.close()
         self.client = None
+        self.authorized = False
         self.closed = True
         self.logger.info('Closed message bus')
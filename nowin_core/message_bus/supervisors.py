@@ -1,7 +1,8 @@
 import logging
+import random
 import uuid
 
-from twisted.internet import reactor
+from nowin_core.scheduler.wheel import getWheel
 
 
 class ReconnectSupervisor(object):
@@ -11,32 +12,72 @@ class ReconnectSupervisor(object):
 
     msgbus is the MessageBus object to supervise, and delay is how many
     seconds to delay the reconnection
+
+    With `max_delay`, the delay doubles after every failed attempt up to
+    `max_delay`, and a random delay between 0 and it is taken (full
+    jitter), so that servers disconnected by a broker restart don't
+    reconnect all at once. The attempt count is reset once the message bus
+    is authorized.
     """
 
-    def __init__(self, msgbus, delay=1, logger=None):
+    def __init__(self, msgbus, delay=1, max_delay=None, reactor=None,
+                 logger=None):
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
         self.delay = delay
+        self.max_delay = max_delay
+        #: count of reconnecting attempts since last authorized
+        self.attempts = 0
+        #: random generator for jitter
+        self.random = random.Random()
         self.msgbus = msgbus
         self.msgbus.conn_failed_event.subscribe(self.handleConnFailed)
         self.msgbus.conn_lost_event.subscribe(self.handleConnLost)
+        auth_event = getattr(self.msgbus, 'auth_event', None)
+        if auth_event is not None:
+            auth_event.subscribe(self.handleAuth)
+
+    def getDelay(self):
+        """Get seconds to wait before next attempt
+
+        """
+        if self.max_delay is None:
+            return self.delay
+        ceiling = min(self.max_delay, self.delay * 2 ** min(self.attempts, 32))
+        return self.random.uniform(0, ceiling)
+
+    def _reconnect(self):
+        delay = self.getDelay()
+        self.attempts += 1
+        self.reactor.callLater(delay, self.msgbus.connect)
+        return delay
+
+    def handleAuth(self):
+        """Called to handle authenticated event
+
+        """
+        self.attempts = 0
 
     def handleConnFailed(self):
         """Called to handle connection failed event
 
         """
-        self.logger.warn('Connection of %s failed, retry %s seconds later',
-                         self.msgbus, self.delay)
-        reactor.callLater(self.delay, self.msgbus.connect)
+        delay = self._reconnect()
+        self.logger.warn('Connection of %s failed, retry %.2f seconds later',
+                         self.msgbus, delay)
 
     def handleConnLost(self):
         """Called to handle connection lost event
 
         """
-        self.logger.warn('Connection of %s lost, retry %s later',
-                         self.msgbus, self.delay)
-        reactor.callLater(self.delay, self.msgbus.connect)
+        delay = self._reconnect()
+        self.logger.warn('Connection of %s lost, retry %.2f seconds later',
+                         self.msgbus, delay)
 
 
 class HealthSupervisor(object):
@@ -44,18 +85,39 @@ class HealthSupervisor(object):
     """This supervisor send message in message bus to check is the message bus
     still healthy
 
+    For STOMP message bus, STOMP heart-beating (the `heartbeat` option of
+    STOMPClient in `client_opts`) detects a dead connection in seconds
+    without a subscription and a routed message every period.
+
+    Pings and timeouts are scheduled on `timer`, the timer wheel shared by
+    users of the reactor by default. Round trip time of the last ping is
+    kept in `last_round_trip`, and recorded into `telemetry` as `ping` if
+    it's given.
+
     """
 
-    def __init__(self, msgbus, check_period=10, timeout=30, logger=None):
+    def __init__(self, msgbus, check_period=10, timeout=30, telemetry=None,
+                 timer=None, reactor=None, logger=None):
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.timer = timer
+        if self.timer is None:
+            self.timer = getWheel(self.reactor)
         self.check_period = check_period
         self.timeout = timeout
         self.msgbus = msgbus
         self.msgbus.auth_event.subscribe(self.handleAuth)
         self.uid = uuid.uuid4().hex
+        self.telemetry = telemetry
+        #: seconds from sending the last ping to getting it back
+        self.last_round_trip = None
 
+        self._ping_at = None
         self._timeout_call = None
         self._send_call = None
 
@@ -75,8 +137,14 @@ class HealthSupervisor(object):
                              dest, data)
             self.msgbus.close()
             self.msgbus.connect()
+        elif self._ping_at is not None:
+            self.last_round_trip = self.reactor.seconds() - self._ping_at
+            self._ping_at = None
+            if self.telemetry is not None:
+                self.telemetry.recordRoundTrip('ping', self.last_round_trip)
         self._cancel_send()
-        self._send_call = reactor.callLater(self.check_period, self.sendPing)
+        self._send_call = self.timer.callLater(self.check_period,
+                                               self.sendPing)
 
     def handleTimeout(self):
         self.logger.warn('Message bus timeout, reconnect')
@@ -96,7 +164,8 @@ class HealthSupervisor(object):
 
     def sendPing(self):
         self._send_call = None
+        self._ping_at = self.reactor.seconds()
         self.msgbus.send(self._dest, 'ping')
         self._cancel_timeout()
-        self._timeout_call = reactor.callLater(
+        self._timeout_call = self.timer.callLater(
             self.timeout, self.handleTimeout)
@@ -0,0 +1,197 @@
+"""Latency telemetry of message buses
+
+Message buses and remote calls given a Telemetry record into it:
+
+ * delivery: seconds from sending a message to receiving it, by the
+   `sent-at` header senders add, per destination, clocks of hosts should
+   be synchronized for it to make sense
+ * callback: seconds spent in subscription callbacks, per destination
+ * round_trip: seconds from making a remote call, or sending a ping, to
+   getting the reply, per called destination
+
+Durations are kept in histograms with log scale buckets, so memory is
+fixed no matter how many are recorded, and at most `max_keys`
+destinations are kept per kind, the others are merged into OTHERS_KEY.
+
+"""
+import math
+import time
+
+#: header of the time a message was sent at, in seconds since epoch
+SENT_AT_HEADER = 'sent-at'
+
+#: key of destinations beyond max_keys
+OTHERS_KEY = '*others*'
+
+
+class Histogram(object):
+
+    """Histogram of durations with log scale buckets
+
+    Bucket `i` counts durations up to `min_value * growth ** i`, durations
+    below `min_value` are in the first bucket, and durations beyond the
+    last bucket are in the last bucket. Percentiles are upper bounds of
+    buckets, so they are accurate to `growth`.
+
+    """
+
+    def __init__(self, min_value=0.0001, growth=2 ** 0.25, bucket_count=80):
+        self.min_value = min_value
+        self.growth = growth
+        self.counts = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._log_growth = math.log(growth)
+
+    def record(self, value):
+        """Record a duration in seconds
+
+        """
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(value / self.min_value) /
+                                  self._log_growth - 1e-9))
+            index = min(index, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Get `p` percentile, None if nothing is recorded
+
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index == len(self.counts) - 1:
+            # the last bucket has no upper bound
+            return self.max
+        bound = self.min_value * self.growth ** index
+        return max(self.min, min(bound, self.max))
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        return dict(
+            count=self.count,
+            mean=mean,
+            min=self.min,
+            max=self.max,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+        )
+
+
+class Telemetry(object):
+
+    """Latency histograms of message buses and remote calls
+
+    """
+
+    #: kinds of histograms
+    KINDS = ('delivery', 'callback', 'round_trip')
+
+    def __init__(self, max_keys=256, clock=time.time, **histogram_opts):
+        """
+
+        @param max_keys: max count of destinations kept per kind
+        @param clock: function returns current time in seconds since epoch
+        @param histogram_opts: keyword arguments for creating Histogram
+        """
+        self.max_keys = max_keys
+        self.clock = clock
+        self.histogram_opts = histogram_opts
+        self._histograms = dict((kind, {}) for kind in self.KINDS)
+
+    def getHistogram(self, kind, key):
+        """Get histogram of `kind` for `key`
+
+        """
+        histograms = self._histograms[kind]
+        histogram = histograms.get(key)
+        if histogram is None:
+            if len(histograms) >= self.max_keys:
+                key = OTHERS_KEY
+                histogram = histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(**self.histogram_opts)
+                histograms[key] = histogram
+        return histogram
+
+    def recordDelivery(self, dest, sent_at):
+        """Record delivery of a message to `dest` sent at `sent_at`, the
+        value of SENT_AT_HEADER, return the latency
+
+        """
+        try:
+            latency = self.clock() - float(sent_at)
+        except (TypeError, ValueError):
+            return None
+        self.getHistogram('delivery', dest).record(max(0.0, latency))
+        return latency
+
+    def recordCallback(self, dest, seconds):
+        """Record `seconds` spent in callback of a message to `dest`
+
+        """
+        self.getHistogram('callback', dest).record(seconds)
+
+    def recordRoundTrip(self, dest, seconds):
+        """Record `seconds` from calling `dest` to getting the reply
+
+        """
+        self.getHistogram('round_trip', dest).record(seconds)
+
+    def measure(self, dest, callback):
+        """Return `callback` wrapped to record time spent in it for `dest`,
+        for Deferreds returned, only time until they are returned counts
+
+        """
+        def measured(*args):
+            begin = self.clock()
+            try:
+                return callback(*args)
+            finally:
+                self.recordCallback(dest, self.clock() - begin)
+        return measured
+
+    def getSentAt(self):
+        """Get value of SENT_AT_HEADER for a message sent now
+
+        """
+        return '%.6f' % self.clock()
+
+    def getStats(self):
+        """Get statistics as a dict maps kind to a dict maps key to
+        statistics of histogram
+
+        """
+        stats = {}
+        for kind, histograms in self._histograms.iteritems():
+            stats[kind] = dict((key, histogram.getStats())
+                               for key, histogram in histograms.iteritems())
+        return stats
+
+    def reset(self):
+        """Drop all recorded durations
+
+        """
+        for histograms in self._histograms.itervalues():
+            histograms.clear()
@@ -0,0 +1,64 @@
+"""Benchmark of observer pattern
+
+Notify subjects with 0, 1 and N observers, and print notifications per
+second of Subject, of a subject copies observers into a list for every
+notification as Subject used to, and of Subject with weak subscriptions.
+
+"""
+import time
+
+from nowin_core.patterns import observer
+
+
+class ListSubject(observer.Subject):
+
+    """Subject copies observers for every notification
+
+    """
+
+    def __call__(self, *args, **kwargs):
+        for func in list(self.observers.itervalues()):
+            func(*args, **kwargs)
+
+
+class Listener(object):
+
+    def handle(self, data):
+        pass
+
+
+def measure(subject, duration=1.0):
+    """Notify subject repeatedly for about `duration` seconds, return
+    notifications per second
+
+    """
+    count = 0
+    begin = time.time()
+    elapsed = 0
+    data = 'x' * 1024
+    while elapsed < duration:
+        for _ in xrange(100):
+            subject(data)
+        count += 100
+        elapsed = time.time() - begin
+    return count / elapsed
+
+
+def main():
+    listeners = [Listener() for _ in xrange(100)]
+    print '%-10s %14s %14s %14s' % ('observers', 'list copy', 'Subject',
+                                    'weak Subject')
+    for count in [0, 1, 2, 10, 100]:
+        rates = []
+        for factory, weak in [(ListSubject, False),
+                              (observer.Subject, False),
+                              (observer.Subject, True)]:
+            subject = factory()
+            for listener in listeners[:count]:
+                subject.subscribe(listener.handle, weak=weak)
+            rates.append(measure(subject))
+        print '%-10d %10.0f/sec %10.0f/sec %10.0f/sec' % (
+            count, rates[0], rates[1], rates[2])
+
+if __name__ == '__main__':
+    main()
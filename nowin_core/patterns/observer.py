@@ -1,3 +1,6 @@
+import weakref
+
+
 class SubscribeID(object):
 
     def __init__(self, subject, sid):
@@ -8,23 +11,71 @@ class SubscribeID(object):
         self.subject.unsubscribe(self.sid)
 
 
+class WeakObserver(object):
+
+    """Observer holds only a weak reference to a function or to the object
+    of a bound method, calling it after the object is gone does nothing
+
+    """
+
+    def __init__(self, observer, callback=None):
+        self_ = getattr(observer, 'im_self', None)
+        if self_ is None:
+            self.ref = weakref.ref(observer, callback)
+            self.func = None
+        else:
+            self.ref = weakref.ref(self_, callback)
+            self.func = observer.im_func
+
+    def __call__(self, *args, **kwargs):
+        target = self.ref()
+        if target is None:
+            return
+        if self.func is None:
+            return target(*args, **kwargs)
+        return self.func(target, *args, **kwargs)
+
+
 class Subject(object):
 
     """Object presents subject of observer pattern
 
+    Observers to notify are kept in a tuple, rebuilt only when they are
+    subscribed or unsubscribed, so notifying doesn't copy them, and
+    observers subscribed or unsubscribed while notifying take effect on
+    next notification.
+
     """
 
     def __init__(self):
         self.observers = {}
         self._sn = 0
+        # observers in subscribing order
+        self._dispatch = ()
+
+    def _rebuild(self):
+        self._dispatch = tuple(self.observers[sid]
+                               for sid in sorted(self.observers))
 
-    def subscribe(self, observer):
-        """Subscribe an observer to this subject and return a subscription id
+    def subscribe(self, observer, weak=False):
+        """Subscribe an observer to this subject and return a subscription id,
+        if `weak` is True, only a weak reference to the observer, or to the
+        object of it for a bound method, is kept, and it is unsubscribed once
+        it is gone
 
         """
         sid = self._sn
+        if weak:
+            subject = weakref.ref(self)
+
+            def gone(ref):
+                self_ = subject()
+                if self_ is not None and sid in self_.observers:
+                    self_.unsubscribe(sid)
+            observer = WeakObserver(observer, gone)
         self.observers[sid] = observer
         self._sn += 1
+        self._rebuild()
         return SubscribeID(self, sid)
 
     def unsubscribe(self, sid):
@@ -34,10 +85,17 @@ class Subject(object):
         assert sid in self.observers, \
             "Can't disconnect a observer does not connected to subject"
         del self.observers[sid]
+        self._rebuild()
 
     def __call__(self, *args, **kwargs):
         """Notify all observers which observe this subject
 
         """
-        for observer in list(self.observers.itervalues()):
+        dispatch = self._dispatch
+        if not dispatch:
+            return
+        if len(dispatch) == 1:
+            dispatch[0](*args, **kwargs)
+            return
+        for observer in dispatch:
             observer(*args, **kwargs)
@@ -0,0 +1,299 @@
+"""Hierarchical timer wheel
+
+Twisted keeps delayed calls in a heap, scheduling and canceling cost
+O(log n), and canceled calls stay in the heap until enough of them pile
+up. With tens of thousands of timeouts pending, such as RPC calls and
+STOMP receipts, which are nearly always canceled before they fire, that
+adds up. TimerWheel puts calls into buckets of `resolution` seconds, so
+scheduling and canceling are O(1), and only one delayed call of the
+reactor ticks the wheel while any call is pending.
+
+Calls due within `slots` ticks are in the first level, calls further away
+are in upper levels, each level covers `slots` times as long as the one
+below it, and calls are moved down as their time approaches. Calls fire
+up to `resolution` seconds late, never early, so the wheel suits
+timeouts rather than precise timing.
+
+"""
+import logging
+import math
+import weakref
+
+from twisted.internet import error
+
+# tolerance of float error when converting time to ticks
+_EPSILON = 1e-9
+
+
+class WheelCall(object):
+
+    """A call scheduled on a TimerWheel, it has the same cancel, active and
+    getTime methods as Twisted's DelayedCall
+
+    """
+
+    __slots__ = ('time', 'tick', 'func', 'args', 'kw', 'wheel', 'bucket',
+                 'cancelled', 'called')
+
+    def __init__(self, wheel, time, tick, func, args, kw):
+        self.time = time
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.wheel = wheel
+        self.bucket = None
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        """Get time this call is scheduled at
+
+        """
+        return self.time
+
+    def active(self):
+        """Is this call neither called nor canceled
+
+        """
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        """Cancel this call
+
+        """
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+
+    def __repr__(self):
+        return '<%s time=%s func=%r>' % (self.__class__.__name__,
+                                         self.time, self.func)
+
+
+class TimerWheel(object):
+
+    """Timer wheel schedules calls with O(1) schedule and cancel
+
+    It has callLater and seconds of the reactor, so that it can be used in
+    place of the reactor for scheduling timeouts.
+
+    """
+
+    def __init__(
+        self,
+        resolution=0.1,
+        slots=256,
+        levels=3,
+        reactor=None,
+        logger=None
+    ):
+        """
+
+        @param resolution: seconds of a tick
+        @param slots: count of buckets in every level
+        @param levels: count of levels, calls further than
+            resolution * slots ** levels seconds away are kept in an
+            overflow bucket
+        """
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.resolution = resolution
+        self.slots = slots
+        #: count of calls fired
+        self.fired_count = 0
+        #: count of calls canceled
+        self.cancelled_count = 0
+        #: count of ticks processed, ticks without anything to do are
+        #: skipped
+        self.tick_count = 0
+
+        # ticks covered by a bucket of every level
+        self._spans = [slots ** level for level in xrange(levels)]
+        self._levels = [[set() for _ in xrange(slots)]
+                        for _ in xrange(levels)]
+        self._overflow = set()
+        self._start = self.reactor.seconds()
+        # tick processed last
+        self._tick = 0
+        self._pending = 0
+        self._tick_call = None
+        # tick the reactor call is scheduled for
+        self._wakeup_tick = None
+
+    def __len__(self):
+        return self._pending
+
+    def seconds(self):
+        """Get current time of the reactor
+
+        """
+        return self.reactor.seconds()
+
+    def callLater(self, delay, func, *args, **kw):
+        """Call `func` with `args` and `kw` `delay` seconds later, return a
+        WheelCall
+
+        """
+        now = self.reactor.seconds()
+        if not self._pending:
+            # nothing is pending, catch up without processing empty ticks
+            self._tick = max(self._tick, self._toTick(now, math.floor))
+        time = now + delay
+        tick = max(self._toTick(time, math.ceil), self._tick + 1)
+        call = WheelCall(self, time, tick, func, args, kw)
+        self._insert(call)
+        self._pending += 1
+        if self._tick_call is None:
+            self._scheduleTick()
+        elif tick < self._wakeup_tick:
+            self._tick_call.cancel()
+            self._scheduleTick()
+        return call
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            pending=self._pending,
+            fired=self.fired_count,
+            cancelled=self.cancelled_count,
+            ticks=self.tick_count,
+        )
+
+    def _toTick(self, time, round):
+        offset = (time - self._start) / self.resolution
+        if round is math.ceil:
+            offset -= _EPSILON
+        else:
+            offset += _EPSILON
+        return int(round(offset))
+
+    def _insert(self, call):
+        ticks = call.tick - self._tick
+        for level, span in enumerate(self._spans):
+            if ticks < span * self.slots:
+                bucket = self._levels[level][(call.tick // span) % self.slots]
+                break
+        else:
+            bucket = self._overflow
+        bucket.add(call)
+        call.bucket = bucket
+
+    def _remove(self, call):
+        call.bucket.discard(call)
+        call.bucket = None
+        self._pending -= 1
+        self.cancelled_count += 1
+        if not self._pending and self._tick_call is not None:
+            self._tick_call.cancel()
+            self._tick_call = None
+
+    def _nextTick(self):
+        """Get next tick with something to do, that is the tick of the next
+        non-empty bucket of the first level, or the next tick upper levels
+        cascade at, whichever comes first
+
+        """
+        tick = self._tick
+        boundary = (tick // self.slots + 1) * self.slots
+        buckets = self._levels[0]
+        for next_tick in xrange(tick + 1, boundary):
+            if buckets[next_tick % self.slots]:
+                return next_tick
+        return boundary
+
+    def _scheduleTick(self):
+        self._wakeup_tick = self._nextTick()
+        time = self._start + (self._wakeup_tick - _EPSILON) * self.resolution
+        delay = max(0, time - self.reactor.seconds())
+        self._tick_call = self.reactor.callLater(delay, self._advance)
+
+    def _advance(self):
+        """Process all ticks passed, skipping ticks without anything to do
+
+        """
+        self._tick_call = None
+        target = self._toTick(self.reactor.seconds(), math.floor)
+        while self._pending:
+            tick = self._nextTick()
+            if tick > target:
+                break
+            self._tick = tick
+            self.tick_count += 1
+            self._cascade()
+            self._fire(self._levels[0][self._tick % self.slots])
+        # nothing to do until target
+        self._tick = max(self._tick, target)
+        if self._tick_call is not None:
+            # scheduled by calls fired, before all ticks were processed
+            self._tick_call.cancel()
+            self._tick_call = None
+        if self._pending:
+            self._scheduleTick()
+
+    def _cascade(self):
+        """Move calls of upper levels due in this round of the level below
+        down
+
+        """
+        tick = self._tick
+        top = self._spans[-1] * self.slots
+        if tick % top == 0 and self._overflow:
+            self._reinsert(self._overflow)
+        for level in xrange(len(self._spans) - 1, 0, -1):
+            span = self._spans[level]
+            if tick % span == 0:
+                bucket = self._levels[level][(tick // span) % self.slots]
+                if bucket:
+                    self._reinsert(bucket)
+
+    def _reinsert(self, bucket):
+        calls = list(bucket)
+        bucket.clear()
+        for call in calls:
+            self._insert(call)
+
+    def _fire(self, bucket):
+        if not bucket:
+            return
+        calls = sorted(bucket, key=lambda call: call.time)
+        bucket.clear()
+        for call in calls:
+            # canceled by a call fired before it
+            if call.cancelled:
+                continue
+            call.bucket = None
+            call.called = True
+            self._pending -= 1
+            self.fired_count += 1
+            try:
+                call.func(*call.args, **call.kw)
+            except Exception:
+                self.logger.error('Failed to call %r', call, exc_info=True)
+
+
+# map reactor to its shared timer wheel
+_wheels = weakref.WeakKeyDictionary()
+
+
+def getWheel(reactor=None):
+    """Get timer wheel shared by all users of `reactor`
+
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    wheel = _wheels.get(reactor)
+    if wheel is None:
+        wheel = TimerWheel(reactor=reactor)
+        _wheels[reactor] = wheel
+    return wheel
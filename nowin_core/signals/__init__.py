@@ -1,10 +1,25 @@
-from nowin_core.patterns.observer import Subject as _Subject
+from nowin_core.signals.dispatcher import Signal as _Signal
 
 #: called when user is created
-user_created_event = _Subject()
+user_created_event = _Signal()
 
 #: called when user is activated
-user_activated_event = _Subject()
+user_activated_event = _Signal()
 
 #: called when chat-room settings are changed
-chatroom_setting_changed = _Subject()
+chatroom_setting_changed = _Signal()
+
+_signals = [
+    user_created_event,
+    user_activated_event,
+    chatroom_setting_changed,
+]
+
+
+def set_dispatcher(dispatcher):
+    """Set dispatcher of all signals, such as an AfterCommitDispatcher for
+    delivering events after commit, None for firing them right away
+
+    """
+    for signal in _signals:
+        signal.dispatcher = dispatcher
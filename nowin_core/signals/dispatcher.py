@@ -0,0 +1,133 @@
+"""Dispatch of model signals after commit
+
+Signals fire their observers right away by default, which happens in the
+middle of model methods, inside the database transaction, so slow
+observers lengthen the transaction. With a dispatcher given, a signal only
+records the event into the current transaction, and once the transaction
+is committed, all events recorded in it are delivered as one batch, in the
+order they were recorded. Events of aborted transactions are dropped.
+
+Batches are delivered right after commit, or with `reactor` given, on the
+reactor thread, or in the reactor thread pool when `in_thread` is True.
+
+"""
+import logging
+
+import transaction
+
+from nowin_core.patterns.observer import Subject
+
+
+class Signal(Subject):
+
+    """Subject fires through a dispatcher if there is one
+
+    """
+
+    def __init__(self, dispatcher=None):
+        Subject.__init__(self)
+        #: dispatcher to record events into, None for firing right away
+        self.dispatcher = dispatcher
+
+    def fire(self, *args, **kwargs):
+        """Notify all observers right away
+
+        """
+        Subject.__call__(self, *args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        if self.dispatcher is None:
+            self.fire(*args, **kwargs)
+            return
+        self.dispatcher.record(self, args, kwargs)
+
+
+class AfterCommitDispatcher(object):
+
+    """Dispatcher delivers events in batches after their transaction is
+    committed
+
+    """
+
+    def __init__(
+        self,
+        transaction_manager=None,
+        reactor=None,
+        in_thread=False,
+        logger=None
+    ):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.transaction_manager = transaction_manager
+        if self.transaction_manager is None:
+            self.transaction_manager = transaction.manager
+        self.reactor = reactor
+        self.in_thread = in_thread
+        #: count of recorded events
+        self.recorded_count = 0
+        #: count of delivered events
+        self.delivered_count = 0
+        #: count of events dropped with failed transactions
+        self.dropped_count = 0
+        #: count of delivered batches
+        self.batch_count = 0
+        #: count of events raised errors in observers
+        self.error_count = 0
+
+    def record(self, signal, args=(), kwargs=None):
+        """Record an event of `signal` into current transaction
+
+        """
+        txn = self.transaction_manager.get()
+        # events are kept in the transaction, aborted transactions never
+        # call after commit hooks, their events go away with them
+        try:
+            batch = txn.data(self)
+        except KeyError:
+            batch = []
+            txn.set_data(self, batch)
+            txn.addAfterCommitHook(self._afterCommit, (batch, ))
+        batch.append((signal, args, kwargs or {}))
+        self.recorded_count += 1
+
+    def _afterCommit(self, status, batch):
+        if not status:
+            self.dropped_count += len(batch)
+            self.logger.info('Dropped %d events of failed transaction',
+                             len(batch))
+            return
+        if self.reactor is None:
+            self.deliver(batch)
+        elif self.in_thread:
+            self.reactor.callFromThread(self.reactor.callInThread,
+                                        self.deliver, batch)
+        else:
+            self.reactor.callFromThread(self.deliver, batch)
+
+    def deliver(self, batch):
+        """Deliver a batch of events, errors raised by observers are logged,
+        and don't stop the rest of events
+
+        """
+        self.batch_count += 1
+        for signal, args, kwargs in batch:
+            try:
+                signal.fire(*args, **kwargs)
+            except Exception:
+                self.error_count += 1
+                self.logger.error('Failed to deliver event %r%r',
+                                  signal, args, exc_info=True)
+            self.delivered_count += 1
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            recorded=self.recorded_count,
+            delivered=self.delivered_count,
+            dropped=self.dropped_count,
+            batches=self.batch_count,
+            errors=self.error_count,
+        )
@@ -1,17 +1,59 @@
-import json
+import collections
 import logging
 import uuid
 
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
+from zope.interface import implements
 
+from nowin_core.message_bus.codec import LazyPayload
+from nowin_core.message_bus.codec import default_codec
+from nowin_core.message_bus.telemetry import SENT_AT_HEADER
 from nowin_core.patterns import observer
+from nowin_core.scheduler.wheel import getWheel
 from nowin_core.stomp import protocol
 
 
+class BufferFullError(Exception):
+
+    """Raised when a message is dropped because the outbound buffer is full
+
+    """
+
+
+class SupersededError(BufferFullError):
+
+    """Raised when a pending message is replaced by a newer message of the
+    same destination
+
+    """
+
+
 class STOMPClient(Protocol):
 
+    """STOMP client protocol
+
+    The client registers itself as a producer of its transport. When the
+    transport buffer is full (the broker is slow or dead), the transport
+    pauses the client, and frames sent since then are held in a pending
+    queue until it's resumed. `max_pending_bytes` bounds the pending queue,
+    when a message doesn't fit, `overflow_policy` decides what happens to
+    it:
+
+     - OVERFLOW_BLOCK: it's rejected, `send` raises BufferFullError, every
+       message held while paused makes `send` return a Deferred fired once
+       it's written to the transport, callers should wait for it before
+       sending more
+     - OVERFLOW_DROP: it's dropped, its receipt fails with BufferFullError
+     - OVERFLOW_COALESCE: it replaces the pending message of the same
+       destination, whose receipt fails with SupersededError, or it's
+       dropped if there is none
+
+    """
+    implements(IPushProducer)
+
     #: initial state
     STATE_INIT = 0
 
@@ -21,13 +63,87 @@ class STOMPClient(Protocol):
     #: connected state
     STATE_CONNECTED = 2
 
-    def __init__(self, logger=None):
+    #: messages are acknowledged by broker once they are sent
+    ACK_AUTO = 'auto'
+
+    #: every message is acknowledged after its callback returned, or the
+    #: Deferred returned by its callback fired, or NACKed if it failed
+    ACK_CLIENT_INDIVIDUAL = 'client-individual'
+
+    #: header of SUBSCRIBE frame for count of messages the broker sends
+    #: before they are acknowledged
+    prefetch_header = 'activemq.prefetchSize'
+
+    #: connection is dropped if nothing is received in the negotiated
+    #: heart-beat interval multiplied by this
+    heartbeat_tolerance = 2
+
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_COALESCE = 'coalesce'
+
+    def __init__(
+        self,
+        batch=False,
+        batch_size=64,
+        batch_interval=0,
+        stats_interval=60,
+        codec=None,
+        accept_version=None,
+        heartbeat=(0, 0),
+        ack_mode=ACK_AUTO,
+        prefetch=None,
+        max_pending_bytes=4 * 1024 * 1024,
+        overflow_policy=OVERFLOW_BLOCK,
+        telemetry=None,
+        timer=None,
+        reactor=None,
+        logger=None
+    ):
+        """
+
+        @param accept_version: versions to accept, such as '1.0,1.1,1.2',
+            None for not sending the accept-version header, which means
+            STOMP 1.0
+        @param heartbeat: (milliseconds between heart-beats we send,
+            milliseconds between heart-beats we want to receive), 0 for
+            none, the actual intervals are negotiated with the broker
+        @param ack_mode: default ack mode of subscriptions, ACK_AUTO or
+            ACK_CLIENT_INDIVIDUAL
+        @param prefetch: default max count of unacknowledged messages of
+            subscriptions, None for broker default
+        @param max_pending_bytes: max bytes of messages held while the
+            transport is paused, None for no limit
+        @param overflow_policy: OVERFLOW_BLOCK, OVERFLOW_DROP or
+            OVERFLOW_COALESCE
+        @param telemetry: Telemetry to record delivery latency and
+            callback time of messages into, sent messages get the sent-at
+            header, None for no telemetry
+        @param timer: timer wheel to schedule receipt timeouts on, None for
+            the one shared by users of the reactor
+        """
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.timer = timer
+        if self.timer is None:
+            self.timer = getWheel(self.reactor)
+        #: Telemetry to record into
+        self.telemetry = telemetry
 
         #: parser for STOMP protocol
         self.parser = protocol.Parser()
+        #: encoder for frames to send
+        self.encoder = protocol.Encoder()
+        #: codec for encoding messages to send
+        self.codec = codec
+        if self.codec is None:
+            self.codec = default_codec
+        self._codec_headers = {'content-type': self.codec.content_type}
         #: state of current connection
         self.state = self.STATE_INIT
         #: map channel name to callback functions
@@ -40,6 +156,87 @@ class STOMPClient(Protocol):
 
         #: map receipt id to defers
         self.receipts = {}
+        # map receipt id to timeout calls
+        self._receipt_calls = {}
+
+        #: queue sent frames and write them together
+        self.batch = batch
+        #: count of queued frames to flush the queue immediately
+        self.batch_size = batch_size
+        #: seconds to wait before flushing the queue, 0 for next reactor
+        #: iteration
+        self.batch_interval = batch_interval
+        #: seconds between logging throughput, None for no logging
+        self.stats_interval = stats_interval
+        #: count of sent messages
+        self.sent_count = 0
+        #: bytes of sent messages
+        self.sent_bytes = 0
+        #: count of received messages
+        self.received_count = 0
+        #: count of writes to transport for sent messages
+        self.write_count = 0
+        #: versions to accept
+        self.accept_version = accept_version
+        #: negotiated version
+        self.version = '1.0'
+        #: heart-beat intervals we want in milliseconds
+        self.heartbeat = heartbeat
+        #: negotiated seconds between heart-beats we send, 0 for none
+        self.heartbeat_send = 0
+        #: negotiated seconds between heart-beats we receive, 0 for none
+        self.heartbeat_receive = 0
+        #: count of heart-beats sent
+        self.heartbeat_count = 0
+        #: default ack mode of subscriptions
+        self.ack_mode = ack_mode
+        #: default prefetch count of subscriptions
+        self.prefetch = prefetch
+        #: count of acknowledged messages
+        self.ack_count = 0
+        #: count of messages failed to handle and NACKed
+        self.nack_count = 0
+        #: max bytes of pending messages
+        self.max_pending_bytes = max_pending_bytes
+        assert overflow_policy in (self.OVERFLOW_BLOCK, self.OVERFLOW_DROP,
+                                   self.OVERFLOW_COALESCE)
+        #: what to do with messages don't fit in pending queue
+        self.overflow_policy = overflow_policy
+        #: is the client paused by the transport
+        self.paused = False
+        #: count of times paused by the transport
+        self.pause_count = 0
+        #: count of messages dropped for overflow
+        self.dropped_count = 0
+        #: count of pending messages replaced by newer ones
+        self.coalesced_count = 0
+
+        # strings of queued frames
+        self._queue = []
+        # count of queued frames
+        self._queued = 0
+        # delayed call for flushing queue
+        self._flush_call = None
+        # delayed call for logging throughput
+        self._stats_call = None
+        # (sent count, received count) at last time of logging throughput
+        self._last_counts = (0, 0)
+        # map subscription id to ack mode other than auto
+        self._ack_modes = {}
+        # ids of subscriptions called with LazyPayload
+        self._lazy = set()
+        # [dest, parts, size, deferred, receipt id] of messages held while
+        # paused, dest is None for batches
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        # map dest to its last pending message, for coalescing
+        self._pending_dests = {}
+        # time of last write and last data received
+        self._last_write = 0
+        self._last_received = 0
+        # delayed calls for sending heart-beat and checking heart-beats
+        self._heartbeat_call = None
+        self._watchdog_call = None
 
         # called when connection lost
         self.conn_lost_event = observer.Subject()
@@ -50,31 +247,63 @@ class STOMPClient(Protocol):
         """Called when data received
 
         """
+        self._last_received = self.reactor.seconds()
         self.parser.feed(data)
-        while True:
-            frame = self.parser.getFrame()
-            if frame is None:
-                break
+        for frame in self.parser.getFrames():
             self.processFrame(frame)
 
     def connectionMade(self):
         """Called when connection made
 
         """
+        self.transport.registerProducer(self, True)
+        if self.stats_interval is not None:
+            self._stats_call = self.reactor.callLater(
+                self.stats_interval, self.logStats)
 
     def connectionLost(self, reason):
         """Connection lost
 
         """
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        if self._stats_call is not None:
+            self._stats_call.cancel()
+            self._stats_call = None
+        self._stopHeartbeat()
+        self.connected = 0
+        if self._queued or self._pending:
+            self.logger.warn('[%s] Drop %d queued and %d pending messages',
+                             self.session_id, self._queued,
+                             len(self._pending))
+        self._queue = []
+        self._queued = 0
+        self._dropPending()
         self.conn_lost_event()
         self.logger.info('Connection lost with session %s', self.session_id)
 
-    def login(self, user='', password=''):
+    def _write(self, data):
+        self._last_write = self.reactor.seconds()
+        self.transport.write(data)
+
+    def _writeSequence(self, data):
+        self._last_write = self.reactor.seconds()
+        self.transport.writeSequence(data)
+
+    def login(self, user='', password='', host=None):
         """Login to STOMP server
 
         """
-        frame = protocol.Frame('CONNECT', dict(login=user, passcode=password))
-        self.transport.write(frame.pack())
+        headers = dict(login=user, passcode=password)
+        if self.accept_version is not None:
+            headers['accept-version'] = self.accept_version
+        if host is not None:
+            headers['host'] = host
+        if self.heartbeat != (0, 0):
+            headers['heart-beat'] = '%d,%d' % self.heartbeat
+        frame = protocol.Frame('CONNECT', headers)
+        self._write(frame.pack(self.version))
         self.state = self.STATE_LOGIN
         self._login_defer = defer.Deferred()
         self.logger.info('Logging in as %r', user)
@@ -86,7 +315,11 @@ class STOMPClient(Protocol):
         """
         if self.state == self.STATE_LOGIN:
             if frame.command == 'CONNECTED':
-                self.session_id = frame.headers['session']
+                self.session_id = frame.headers.get('session')
+                self.version = frame.headers.get('version', '1.0')
+                if self.version != '1.0':
+                    self.parser.unescapeHeaders = True
+                self._startHeartbeat(frame.headers.get('heart-beat'))
                 self.state = self.STATE_CONNECTED
                 self._login_defer.callback(None)
                 self.auth_event()
@@ -104,16 +337,31 @@ class STOMPClient(Protocol):
         elif self.state == self.STATE_CONNECTED:
             if frame.command == 'MESSAGE':
                 dest = frame.headers['destination']
-                callback = self.callbacks[dest]
-                callback(dest, json.loads(frame.body))
+                # messages of wildcard subscriptions are routed by the
+                # subscription id, which is the subscribed destination
+                sub_id = frame.headers.get('subscription', dest)
+                callback = self.callbacks[sub_id]
+                self.received_count += 1
+                payload = LazyPayload(frame.body,
+                                      frame.headers.get('content-type'))
+                if self.telemetry is not None:
+                    callback = self._measureCallback(frame, callback)
+                if sub_id not in self._ack_modes:
+                    self._deliver(sub_id, callback, dest, payload)
+                    return
+                d = defer.maybeDeferred(self._deliver, sub_id, callback,
+                                        dest, payload)
+                d.addCallbacks(self._handleProcessed,
+                               self._handleProcessFailed,
+                               callbackArgs=(frame, sub_id),
+                               errbackArgs=(frame, sub_id))
             elif frame.command == 'RECEIPT':
                 # notify the deferred that message was receipted
                 rid = frame.headers.get('receipt-id')
                 if rid is not None:
-                    d = self.receipts.get(rid)
+                    d = self._popReceipt(rid)
                     if d:
                         d.callback(1)
-                        del self.receipts[rid]
             elif frame.command == 'ERROR':
                 self.logger.error('[%s] Error %r',
                                   self.session_id, frame.body)
@@ -123,57 +371,389 @@ class STOMPClient(Protocol):
                                   self.session_id, frame.command,
                                   frame.headers, frame.body)
 
-    def subscribe(self, dest, callback):
-        """Subscribe to a message queue `dest` with `callback` function
+    def _startHeartbeat(self, value):
+        """Negotiate heart-beat intervals with `value` of heart-beat header
+        from server, and start sending and checking heart-beats
+
+        """
+        send, receive = self.heartbeat
+        server_send, server_receive = 0, 0
+        if value:
+            server_send, server_receive = [int(v) for v in value.split(',')]
+        self.heartbeat_send = 0
+        if send and server_receive:
+            self.heartbeat_send = max(send, server_receive) / 1000.0
+        self.heartbeat_receive = 0
+        if receive and server_send:
+            self.heartbeat_receive = max(receive, server_send) / 1000.0
+        if self.heartbeat_send:
+            self._heartbeat_call = self.reactor.callLater(
+                self.heartbeat_send, self._sendHeartbeat)
+        if self.heartbeat_receive:
+            self._watchdog_call = self.reactor.callLater(
+                self.heartbeat_receive * self.heartbeat_tolerance,
+                self._checkHeartbeat)
+        if self.heartbeat_send or self.heartbeat_receive:
+            self.logger.info('Heart-beat every %s seconds, expect every %s '
+                             'seconds', self.heartbeat_send,
+                             self.heartbeat_receive)
+
+    def _stopHeartbeat(self):
+        if self._heartbeat_call is not None:
+            self._heartbeat_call.cancel()
+            self._heartbeat_call = None
+        if self._watchdog_call is not None:
+            self._watchdog_call.cancel()
+            self._watchdog_call = None
+
+    def _sendHeartbeat(self):
+        """Send a heart-beat if nothing was written in the interval, and
+        schedule next check
+
+        """
+        elapsed = self.reactor.seconds() - self._last_write
+        delay = self.heartbeat_send - elapsed
+        if delay <= 0:
+            self._write(protocol.Frame.newline)
+            self.heartbeat_count += 1
+            delay = self.heartbeat_send
+        self._heartbeat_call = self.reactor.callLater(delay,
+                                                      self._sendHeartbeat)
+
+    def _checkHeartbeat(self):
+        """Drop the connection if nothing was received in time
+
+        """
+        self._watchdog_call = None
+        limit = self.heartbeat_receive * self.heartbeat_tolerance
+        elapsed = self.reactor.seconds() - self._last_received
+        if elapsed < limit:
+            self._watchdog_call = self.reactor.callLater(
+                limit - elapsed, self._checkHeartbeat)
+            return
+        self.logger.warn('[%s] Nothing received in %.1f seconds, drop the '
+                         'connection', self.session_id, elapsed)
+        # don't wait for flushing buffer to a dead peer
+        self.transport.abortConnection()
+
+    def _measureCallback(self, frame, callback):
+        """Record delivery latency of `frame`, return `callback` wrapped to
+        record time spent in it
+
+        """
+        dest = frame.headers['destination']
+        sent_at = frame.headers.get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self.telemetry.recordDelivery(dest, sent_at)
+        return self.telemetry.measure(dest, callback)
+
+    def _deliver(self, sub_id, callback, dest, payload):
+        """Call `callback` with the payload for lazy subscriptions, or with
+        decoded data
+
+        """
+        if sub_id in self._lazy:
+            return callback(dest, payload)
+        return callback(dest, payload.decode())
+
+    def _handleProcessed(self, result, frame, sub_id):
+        self._acknowledge('ACK', frame, sub_id)
+
+    def _handleProcessFailed(self, failure, frame, sub_id):
+        self.logger.error('[%s] Failed to handle message of %s, %s',
+                          self.session_id, frame.headers['destination'],
+                          failure.getErrorMessage())
+        self._acknowledge('NACK', frame, sub_id)
+
+    def _acknowledge(self, command, frame, sub_id):
+        # connection lost before the message was handled, the broker will
+        # redeliver it
+        if not self.connected:
+            return
+        if command == 'NACK':
+            self.nack_count += 1
+            # there is no NACK in STOMP 1.0, leave it unacknowledged
+            if self.version == '1.0':
+                return
+        else:
+            self.ack_count += 1
+        if self.version == '1.2':
+            headers = dict(id=frame.headers['ack'])
+        else:
+            headers = {'message-id': frame.headers['message-id'],
+                       'subscription': sub_id}
+        self._write(protocol.Frame(command, headers).pack(self.version))
+
+    def subscribe(self, dest, callback, ack_mode=None, prefetch=None,
+                  lazy=False):
+        """Subscribe to a message queue `dest` with `callback` function, a
+        destination can only be subscribed once, if `lazy` is True, callback
+        is called with LazyPayload instead of decoded data, so that messages
+        it doesn't look into are never decoded
 
         """
-        frame = protocol.Frame('SUBSCRIBE', dict(destination=dest))
-        self.transport.write(frame.pack())
+        if ack_mode is None:
+            ack_mode = self.ack_mode
+        if prefetch is None:
+            prefetch = self.prefetch
+        headers = dict(destination=dest, id=dest)
+        if ack_mode != self.ACK_AUTO:
+            headers['ack'] = ack_mode
+            self._ack_modes[dest] = ack_mode
+        if prefetch is not None:
+            headers[self.prefetch_header] = prefetch
+        frame = protocol.Frame('SUBSCRIBE', headers)
+        self._write(frame.pack(self.version))
         self.callbacks[dest] = callback
+        if lazy:
+            self._lazy.add(dest)
+        else:
+            self._lazy.discard(dest)
         self.logger.info('[%s] Subscribed to %s', self.session_id, dest)
 
     def unsubscribe(self, dest):
         """Unsubscribe from a message queue
 
         """
-        frame = protocol.Frame('UNSUBSCRIBE', dict(destination=dest))
-        self.transport.write(frame.pack())
+        frame = protocol.Frame('UNSUBSCRIBE', dict(destination=dest, id=dest))
+        self._write(frame.pack(self.version))
         del self.callbacks[dest]
+        self._ack_modes.pop(dest, None)
+        self._lazy.discard(dest)
         self.logger.info('[%s] Unsubscribed from %s', self.session_id, dest)
 
+    def pauseProducing(self):
+        """Called by transport when its buffer is full
+
+        """
+        if not self.paused:
+            self.pause_count += 1
+            self.logger.debug('[%s] Paused by transport', self.session_id)
+        self.paused = True
+
+    def resumeProducing(self):
+        """Called by transport when its buffer is drained
+
+        """
+        self.paused = False
+        self._drain()
+
+    def stopProducing(self):
+        """Called by transport when the connection is closing
+
+        """
+        self._dropPending()
+
+    def _drain(self):
+        """Write all pending messages to transport
+
+        """
+        if not self._pending:
+            return
+        parts = []
+        waiters = []
+        for _, entry_parts, _, waiter, _ in self._pending:
+            parts.extend(entry_parts)
+            if waiter is not None:
+                waiters.append(waiter)
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._pending_dests = {}
+        self._writeSequence(parts)
+        self.write_count += 1
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def _dropPending(self):
+        pending = self._pending
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._pending_dests = {}
+        for _, _, _, waiter, _ in pending:
+            if waiter is not None:
+                waiter.errback(BufferFullError('Connection lost'))
+
+    def _enqueue(self, dest, parts, size, rid):
+        """Hold a message while paused, return a Deferred fired once it's
+        written for OVERFLOW_BLOCK
+
+        """
+        if self.max_pending_bytes is not None and \
+                self._pending_bytes + size > self.max_pending_bytes:
+            entry = None
+            if self.overflow_policy == self.OVERFLOW_COALESCE:
+                entry = self._pending_dests.get(dest)
+            if entry is None:
+                self.dropped_count += 1
+                error = BufferFullError(
+                    'Dropped message to %s, %d bytes pending' %
+                    (dest, self._pending_bytes))
+                d = None
+                if rid is not None:
+                    d = self._popReceipt(rid)
+                if self.overflow_policy == self.OVERFLOW_BLOCK:
+                    raise error
+                if d is not None:
+                    d.errback(error)
+                return None
+            if entry[4] is not None:
+                d = self._popReceipt(entry[4])
+                if d is not None:
+                    d.errback(SupersededError(
+                        'Message to %s superseded by a newer one' % dest))
+            self._pending_bytes += size - entry[2]
+            entry[1] = parts
+            entry[2] = size
+            entry[4] = rid
+            self.coalesced_count += 1
+            return None
+        waiter = None
+        if self.overflow_policy == self.OVERFLOW_BLOCK:
+            waiter = defer.Deferred()
+        entry = [dest, parts, size, waiter, rid]
+        self._pending.append(entry)
+        self._pending_bytes += size
+        self._pending_dests[dest] = entry
+        return waiter
+
     def send(self, dest, data, receipt=False, timeout=5):
-        """Send data to message queue
+        """Send data to message queue, return a Deferred fired when receipt
+        is received if `receipt` is True, or a Deferred fired when the
+        message is written if it's held with OVERFLOW_BLOCK, otherwise, None,
+        raise BufferFullError if it's rejected with OVERFLOW_BLOCK
 
         """
-        data = json.dumps(data)
-        headers = dict(destination=dest)
+        data = self.codec.encode(data)
+        headers = None
         d = None
+        rid = None
+        if self.telemetry is not None:
+            headers = {SENT_AT_HEADER: self.telemetry.getSentAt()}
         if receipt:
             rid = uuid.uuid4().hex
+            if headers is None:
+                headers = {}
             headers['receipt'] = rid
             d = defer.Deferred()
             self.receipts[rid] = d
 
             def handle_timeout():
-                d = self.receipts.get(rid)
+                d = self._popReceipt(rid)
                 if d is not None:
                     d.errback(RuntimeError('Time out'))
-                    del self.receipts[rid]
-
-            reactor.callLater(timeout, handle_timeout)
 
-        frame = protocol.Frame('SEND', headers, data)
-        self.transport.write(frame.pack())
-        self.logger.info('[%s] Sent %d bytes data to %s',
-                         self.session_id, len(data), dest)
+            self._receipt_calls[rid] = self.timer.callLater(timeout,
+                                                            handle_timeout)
+
+        parts = self.encoder.encodeSequence(
+            'SEND', dest, data, self._codec_headers, headers, self.version)
+        self.sent_count += 1
+        self.sent_bytes += len(data)
+        if self.paused or self._pending:
+            # keep order of messages queued for batching
+            if self._queued:
+                self.flush()
+            size = 0
+            for part in parts:
+                size += len(part)
+            waiter = self._enqueue(dest, parts, size, rid)
+            return d or waiter
+        if not self.batch:
+            self._writeSequence(parts)
+            self.write_count += 1
+            return d
+        self._queue.extend(parts)
+        self._queued += 1
+        if self._queued >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.reactor.callLater(
+                self.batch_interval, self.flush)
         return d
 
+    def _popReceipt(self, rid):
+        """Remove receipt `rid` and cancel its timeout, return its Deferred
+
+        """
+        call = self._receipt_calls.pop(rid, None)
+        if call is not None and call.active():
+            call.cancel()
+        return self.receipts.pop(rid, None)
+
+    def flush(self):
+        """Write all queued frames to transport
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self._queued:
+            return
+        if self.paused:
+            size = 0
+            for part in self._queue:
+                size += len(part)
+            self._pending.append([None, self._queue, size, None, None])
+            self._pending_bytes += size
+            self._queue = []
+            self._queued = 0
+            return
+        self._writeSequence(self._queue)
+        self.write_count += 1
+        self._queue = []
+        self._queued = 0
+
+    def getStats(self):
+        """Get statistics of messages as a dict
+
+        """
+        return dict(
+            sent=self.sent_count,
+            sent_bytes=self.sent_bytes,
+            received=self.received_count,
+            writes=self.write_count,
+            queued=self._queued,
+            pending=len(self._pending),
+            pending_bytes=self._pending_bytes,
+            dropped=self.dropped_count,
+            coalesced=self.coalesced_count,
+            pauses=self.pause_count,
+        )
+
+    def logStats(self):
+        """Log throughput since last time, and schedule next logging
+
+        """
+        last_sent, last_received = self._last_counts
+        self._last_counts = (self.sent_count, self.received_count)
+        self.logger.info(
+            '[%s] Sent %.1f, received %.1f messages/sec in %s seconds, '
+            'total %d sent in %d writes, %d received',
+            self.session_id,
+            (self.sent_count - last_sent) / float(self.stats_interval),
+            (self.received_count - last_received) /
+            float(self.stats_interval),
+            self.stats_interval,
+            self.sent_count,
+            self.write_count,
+            self.received_count
+        )
+        self._stats_call = self.reactor.callLater(
+            self.stats_interval, self.logStats)
+
     def close(self):
         """Close connection to server
 
         """
+        self.flush()
+        self._stopHeartbeat()
+        # the transport buffers them until they're written before closing
+        self._drain()
         frame = protocol.Frame('DISCONNECT')
-        self.transport.write(frame.pack())
+        self._write(frame.pack(self.version))
+        # the transport doesn't close while a paused producer is registered
+        self.transport.unregisterProducer()
         self.transport.loseConnection()
         self.logger.info('[%s] Connection closed', self.session_id)
 
@@ -0,0 +1,225 @@
+"""Benchmark of STOMP parser and encoder
+
+Feed bursts of frames to the parser as they are read from TCP, and compare
+frames per second with the previous parser, which joins the whole buffer and
+searches from the beginning for every frame.
+
+Encode SEND frames to a handful of destinations, and compare frames per
+second of Encoder with Frame.pack.
+
+Send small messages in bursts with STOMPClient to a sink over loopback, and
+compare messages per second with batching on and off.
+
+"""
+import os
+import time
+
+from twisted.internet import defer
+from twisted.internet import protocol as twisted_protocol
+
+from nowin_core.stomp import protocol
+from nowin_core.stomp.async_client import STOMPClient
+
+
+class LegacyParser(protocol.Parser):
+
+    """The previous STOMP parser, kept for comparison
+
+    """
+
+    def __init__(self, remain=''):
+        self.buffer = [remain]
+        self._phase = self.headerPhase
+        self._command = None
+        self._headers = None
+
+    def feed(self, data):
+        self.buffer.append(data)
+
+    def getFrame(self):
+        if len(self.buffer) > 1:
+            self.buffer = [''.join(self.buffer)]
+        data = self.buffer[0]
+
+        frame = None
+        if self._phase == self.headerPhase:
+            splitter = self.newline * 2
+            if splitter in data:
+                i = data.find(splitter)
+                headerLines = data[:i].split(self.newline)
+                data = data[i + len(splitter):]
+                self._command = headerLines[0]
+                self._headers = {}
+                for line in headerLines[1:]:
+                    key, value = line.split(':', 1)
+                    self._headers[key.strip()] = value.strip()
+                self._phase = self.bodyPhase
+        if self._phase == self.bodyPhase:
+            i = None
+            if 'content-length' in self._headers:
+                length = int(self._headers['content-length'])
+                if len(data) >= length:
+                    i = length
+            elif '\0' in data:
+                i = data.index('\0')
+            if i is not None:
+                body = data[:i]
+                data = data[i + 1:]
+                frame = protocol.Frame(self._command, self._headers, body)
+                self._command = None
+                self._headers = None
+                self._phase = self.headerPhase
+
+        self.buffer = [data]
+        return frame
+
+    def getFrames(self):
+        frames = []
+        while True:
+            frame = self.getFrame()
+            if frame is None:
+                break
+            frames.append(frame)
+        return frames
+
+
+def makeChunks(body_size, burst, binary=False, read_size=65536):
+    """Make data of `burst` frames, split as TCP reads of `read_size`
+
+    """
+    headers = dict(destination='/topic/proxy.state')
+    if binary:
+        body = os.urandom(body_size)
+        headers['content-length'] = body_size
+    else:
+        body = 'x' * body_size
+    data = protocol.Frame('MESSAGE', headers, body).pack() * burst
+    return [data[i:i + read_size] for i in range(0, len(data), read_size)]
+
+
+def run(parser_class, chunks, rounds):
+    """Parse chunks `rounds` times and return frames per second
+
+    """
+    parser = parser_class()
+    count = 0
+    begin = time.time()
+    for _ in xrange(rounds):
+        for chunk in chunks:
+            parser.feed(chunk)
+            count += len(parser.getFrames())
+    elapsed = time.time() - begin
+    return count / elapsed
+
+
+def runEncoding(body_size, count):
+    """Encode `count` SEND frames with Frame.pack and Encoder, return frames
+    per second of both
+
+    """
+    dests = ['/topic/stats', '/topic/listeners', '/topic/ping']
+    body = 'x' * body_size
+
+    begin = time.time()
+    for i in xrange(count):
+        frame = protocol.Frame('SEND', dict(destination=dests[i % 3]), body)
+        frame.pack()
+    pack_fps = count / (time.time() - begin)
+
+    encoder = protocol.Encoder()
+    begin = time.time()
+    for i in xrange(count):
+        encoder.encodeSequence('SEND', dests[i % 3], body)
+    encoder_fps = count / (time.time() - begin)
+    return pack_fps, encoder_fps
+
+
+class Sink(twisted_protocol.Protocol):
+
+    """Protocol counts received frames, fires `deferred` after `expected`
+    frames
+
+    """
+
+    def connectionMade(self):
+        self.factory.sinks.append(self)
+        self.count = 0
+
+    def dataReceived(self, data):
+        self.count += data.count('\0')
+        if self.count >= self.factory.expected:
+            self.factory.deferred.callback(self.count)
+
+
+@defer.inlineCallbacks
+def runBatching(reactor, batch, count, burst):
+    """Send `count` messages in bursts of `burst` messages per reactor
+    iteration, return messages per second
+
+    """
+    factory = twisted_protocol.ServerFactory()
+    factory.protocol = Sink
+    factory.sinks = []
+    factory.expected = count
+    factory.deferred = defer.Deferred()
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    creator = twisted_protocol.ClientCreator(
+        reactor, STOMPClient, batch=batch, batch_size=burst,
+        stats_interval=None)
+    client = yield creator.connectTCP('127.0.0.1', port.getHost().port)
+    message = dict(id=1234, listeners=56, bitrate=128)
+
+    def sendBurst(remaining):
+        for _ in xrange(min(burst, remaining)):
+            client.send('/topic/stats', message)
+        remaining -= burst
+        if remaining > 0:
+            reactor.callLater(0, sendBurst, remaining)
+
+    begin = time.time()
+    sendBurst(count)
+    yield factory.deferred
+    elapsed = time.time() - begin
+    client.transport.loseConnection()
+    yield port.stopListening()
+    defer.returnValue(count / elapsed)
+
+
+@defer.inlineCallbacks
+def runAllBatching(reactor):
+    for burst in [10, 100]:
+        print 'sending messages in bursts of %d' % burst
+        for batch in [False, True]:
+            mps = yield runBatching(reactor, batch, 200000, burst)
+            print '  batch=%-8s %12.0f messages/sec' % (batch, mps)
+    reactor.stop()
+
+
+def main():
+    cases = [
+        ('small', 64, 1000, False, 20),
+        ('small binary', 64, 1000, True, 20),
+        ('large', 16384, 100, False, 20),
+        ('large binary', 16384, 100, True, 20),
+    ]
+    for name, body_size, burst, binary, rounds in cases:
+        chunks = makeChunks(body_size, burst, binary)
+        print '%s bodies, %d bytes, %d frames per burst' % (
+            name, body_size, burst)
+        for parser_class in [LegacyParser, protocol.Parser]:
+            fps = run(parser_class, chunks, rounds)
+            print '  %-14s %12.0f frames/sec' % (parser_class.__name__, fps)
+
+    for body_size in [64, 16384]:
+        pack_fps, encoder_fps = runEncoding(body_size, 100000)
+        print 'encoding %d bytes bodies' % body_size
+        print '  %-14s %12.0f frames/sec' % ('Frame.pack', pack_fps)
+        print '  %-14s %12.0f frames/sec' % ('Encoder', encoder_fps)
+
+    from twisted.internet import reactor
+    reactor.callWhenRunning(runAllBatching, reactor)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+"""Minimal STOMP broker
+
+A small in-process broker for tests and benchmarks, so that STOMPClient and
+the message bus stack can be measured with real round trips over loopback
+without running ActiveMQ. It supports CONNECT, SEND, SUBSCRIBE, UNSUBSCRIBE
+and DISCONNECT, and RECEIPT for any frame with a receipt header. Messages
+are fanned out to every subscription matches the destination, with
+headers of the SEND frame other than those of the protocol, nothing is
+persisted.
+
+Version 1.0 to 1.2 are negotiated with the accept-version header, and so
+are heart-beats. Subscriptions with `client` or `client-individual` ack
+mode get at most `activemq.prefetchSize` unacknowledged messages, more
+are queued until ACK or NACK frames arrive, NACKed messages are dropped.
+`client` mode is handled as `client-individual`.
+
+Destinations are words separated by dots, in subscriptions, `*` matches
+exactly one word, and `multi_wildcard` (`>` as ActiveMQ by default) matches
+zero or more words.
+
+"""
+import collections
+import itertools
+import logging
+
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ServerFactory
+
+from nowin_core.message_bus.router import MULTI_WILDCARD
+from nowin_core.message_bus.router import TopicTrie
+from nowin_core.stomp import protocol
+
+
+#: versions supported, from the lowest
+VERSIONS = ('1.0', '1.1', '1.2')
+
+#: headers of SEND frames not forwarded to subscribers
+SEND_ONLY_HEADERS = frozenset(['destination', 'receipt', 'content-type',
+                               'content-length', 'transaction'])
+
+
+class _Subscription(object):
+
+    __slots__ = ('id', 'dest', 'session', 'ack', 'prefetch', 'unacked',
+                 'backlog')
+
+    def __init__(self, id, dest, session, ack='auto', prefetch=None):
+        self.id = id
+        self.dest = dest
+        self.session = session
+        self.ack = ack
+        #: max count of unacknowledged messages, None for no limit
+        self.prefetch = prefetch
+        #: ack ids of unacknowledged messages
+        self.unacked = set()
+        #: (dest, content type, body) of messages waiting for the window
+        self.backlog = collections.deque()
+
+
+class STOMPBrokerProtocol(Protocol):
+
+    """Connection of a client to the broker
+
+    """
+
+    def __init__(self):
+        self.parser = protocol.Parser()
+        #: session id, None before the client is connected
+        self.session_id = None
+        #: negotiated version
+        self.version = '1.0'
+        # map subscription id to subscriptions
+        self.subscriptions = {}
+        # map ack id to subscriptions
+        self.unacked = {}
+        # negotiated heart-beat intervals in seconds
+        self.heartbeat_send = 0
+        self.heartbeat_receive = 0
+        self._last_write = 0
+        self._last_received = 0
+        self._heartbeat_call = None
+        self._watchdog_call = None
+
+    def dataReceived(self, data):
+        self._last_received = self.factory.reactor.seconds()
+        self.parser.feed(data)
+        for frame in self.parser.getFrames():
+            self.processFrame(frame)
+            if self.transport is None or self.transport.disconnecting:
+                break
+
+    def connectionLost(self, reason):
+        for call in (self._heartbeat_call, self._watchdog_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._heartbeat_call = None
+        self._watchdog_call = None
+        self.factory.removeSession(self)
+
+    def write(self, data):
+        self._last_write = self.factory.reactor.seconds()
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self._last_write = self.factory.reactor.seconds()
+        self.transport.writeSequence(data)
+
+    def sendFrame(self, command, headers=None, body=''):
+        self.write(protocol.Frame(command, headers, body).pack(self.version))
+
+    def _startHeartbeat(self, value):
+        client_send, client_receive = 0, 0
+        if value:
+            client_send, client_receive = [int(v) for v in value.split(',')]
+        send, receive = self.factory.heartbeat
+        if send and client_receive:
+            self.heartbeat_send = max(send, client_receive) / 1000.0
+            self._heartbeat_call = self.factory.reactor.callLater(
+                self.heartbeat_send, self._sendHeartbeat)
+        if receive and client_send:
+            self.heartbeat_receive = max(receive, client_send) / 1000.0
+            self._watchdog_call = self.factory.reactor.callLater(
+                self.heartbeat_receive * 2, self._checkHeartbeat)
+
+    def _sendHeartbeat(self):
+        elapsed = self.factory.reactor.seconds() - self._last_write
+        delay = self.heartbeat_send - elapsed
+        if delay <= 0:
+            self.write(protocol.Frame.newline)
+            delay = self.heartbeat_send
+        self._heartbeat_call = self.factory.reactor.callLater(
+            delay, self._sendHeartbeat)
+
+    def _checkHeartbeat(self):
+        self._watchdog_call = None
+        limit = self.heartbeat_receive * 2
+        elapsed = self.factory.reactor.seconds() - self._last_received
+        if elapsed < limit:
+            self._watchdog_call = self.factory.reactor.callLater(
+                limit - elapsed, self._checkHeartbeat)
+            return
+        self.factory.logger.warn('[%s] No heart-beat in %.1f seconds',
+                                 self.session_id, elapsed)
+        self.transport.abortConnection()
+
+    def sendError(self, message):
+        self.factory.logger.warn('[%s] Error %s', self.session_id, message)
+        self.sendFrame('ERROR', dict(message=message), message)
+        self.transport.loseConnection()
+
+    def processFrame(self, frame):
+        """Called to process a frame from client
+
+        """
+        command = frame.command
+        if self.session_id is None and command != 'CONNECT':
+            self.sendError('Not connected')
+            return
+        handler = getattr(self, 'handle' + command.capitalize(), None)
+        if handler is None:
+            self.sendError('Unknown command %s' % command)
+            return
+        if not handler(frame):
+            return
+        receipt = frame.headers.get('receipt')
+        if receipt is not None:
+            self.sendFrame('RECEIPT', {'receipt-id': receipt})
+        if command == 'DISCONNECT':
+            self.transport.loseConnection()
+
+    def handleConnect(self, frame):
+        if self.session_id is not None:
+            self.sendError('Already connected')
+            return False
+        login = frame.headers.get('login', '')
+        passcode = frame.headers.get('passcode', '')
+        if not self.factory.authenticate(login, passcode):
+            self.sendError('Authentication failed for %s' % login)
+            return False
+        accepted = frame.headers.get('accept-version')
+        if accepted is not None:
+            accepted = accepted.split(',')
+            versions = [v for v in VERSIONS if v in accepted]
+            if not versions:
+                self.sendError('Supported versions are %s' %
+                               ','.join(VERSIONS))
+                return False
+            self.version = versions[-1]
+        if self.version != '1.0':
+            self.parser.unescapeHeaders = True
+        self.session_id = self.factory.addSession(self)
+        headers = dict(session=self.session_id)
+        if accepted is not None:
+            headers['version'] = self.version
+        heartbeat = frame.headers.get('heart-beat')
+        if heartbeat is not None:
+            headers['heart-beat'] = '%d,%d' % self.factory.heartbeat
+            self._startHeartbeat(heartbeat)
+        self.sendFrame('CONNECTED', headers)
+        return True
+
+    def handleSend(self, frame):
+        dest = frame.headers.get('destination')
+        if dest is None:
+            self.sendError('No destination')
+            return False
+        headers = dict((key, value) for key, value in frame.headers.iteritems()
+                       if key not in SEND_ONLY_HEADERS)
+        self.factory.publish(dest, frame.headers.get('content-type'),
+                             frame.body, headers)
+        return True
+
+    def handleSubscribe(self, frame):
+        dest = frame.headers.get('destination')
+        if dest is None:
+            self.sendError('No destination')
+            return False
+        id = frame.headers.get('id', dest)
+        if id in self.subscriptions:
+            self.factory.unsubscribe(self.subscriptions.pop(id))
+        ack = frame.headers.get('ack', 'auto')
+        prefetch = frame.headers.get('activemq.prefetchSize')
+        if prefetch is not None:
+            prefetch = int(prefetch)
+        sub = _Subscription(id, dest, self, ack, prefetch)
+        self.subscriptions[id] = sub
+        self.factory.subscribe(sub)
+        return True
+
+    def handleUnsubscribe(self, frame):
+        id = frame.headers.get('id', frame.headers.get('destination'))
+        sub = self.subscriptions.pop(id, None)
+        if sub is not None:
+            self.factory.unsubscribe(sub)
+        return True
+
+    def handleAck(self, frame):
+        return self._acknowledge(frame, True)
+
+    def handleNack(self, frame):
+        return self._acknowledge(frame, False)
+
+    def _acknowledge(self, frame, ok):
+        if self.version == '1.2':
+            ack_id = frame.headers.get('id')
+        else:
+            ack_id = frame.headers.get('message-id')
+        sub = self.unacked.pop(ack_id, None)
+        if sub is None:
+            self.sendError('Unknown message %s' % ack_id)
+            return False
+        sub.unacked.discard(ack_id)
+        if ok:
+            self.factory.acked_count += 1
+        else:
+            self.factory.nacked_count += 1
+        self.factory.pump(sub)
+        return True
+
+    def handleDisconnect(self, frame):
+        return True
+
+
+class STOMPBroker(ServerFactory):
+
+    """Factory of broker connections, it holds subscriptions of all
+    sessions
+
+    """
+
+    protocol = STOMPBrokerProtocol
+
+    def __init__(self, users=None, multi_wildcard='>', heartbeat=(0, 0),
+                 reactor=None, logger=None):
+        """
+
+        @param users: dict maps login to passcode, None for accepting any
+            login
+        @param multi_wildcard: wildcard matches zero or more words
+        @param heartbeat: (milliseconds between heart-beats we send,
+            milliseconds between heart-beats we want to receive)
+        """
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.users = users
+        self.heartbeat = heartbeat
+        self.multi_wildcard = multi_wildcard
+        #: encoder for MESSAGE frames
+        self.encoder = protocol.Encoder()
+        #: map session id to connections
+        self.sessions = {}
+        #: count of published messages
+        self.published_count = 0
+        #: count of messages delivered to subscriptions
+        self.delivered_count = 0
+        #: count of acknowledged messages
+        self.acked_count = 0
+        #: count of NACKed messages
+        self.nacked_count = 0
+
+        self._subs = TopicTrie()
+        self._session_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def authenticate(self, login, passcode):
+        """Is `login` with `passcode` allowed to connect
+
+        """
+        if self.users is None:
+            return True
+        return self.users.get(login) == passcode
+
+    def addSession(self, conn):
+        session_id = 'session-%d' % next(self._session_ids)
+        self.sessions[session_id] = conn
+        self.logger.info('Session %s connected', session_id)
+        return session_id
+
+    def removeSession(self, conn):
+        if conn.session_id is None:
+            return
+        for sub in conn.subscriptions.values():
+            self.unsubscribe(sub)
+        conn.subscriptions = {}
+        conn.unacked = {}
+        del self.sessions[conn.session_id]
+        self.logger.info('Session %s disconnected', conn.session_id)
+
+    def _toPattern(self, dest):
+        if self.multi_wildcard == MULTI_WILDCARD:
+            return dest
+        return '.'.join(MULTI_WILDCARD if word == self.multi_wildcard
+                        else word for word in dest.split('.'))
+
+    def subscribe(self, sub):
+        self._subs.add(self._toPattern(sub.dest), sub)
+
+    def unsubscribe(self, sub):
+        self._subs.remove(self._toPattern(sub.dest), sub)
+        for ack_id in sub.unacked:
+            del sub.session.unacked[ack_id]
+        sub.unacked.clear()
+        sub.backlog.clear()
+
+    def publish(self, dest, content_type, body, headers=None):
+        """Deliver a message to all subscriptions match `dest`, with extra
+        `headers`
+
+        """
+        self.published_count += 1
+        subs = self._subs.match(dest)
+        if not subs:
+            return
+        for sub in subs:
+            if sub.ack == 'auto':
+                self._deliver(sub, dest, content_type, body, headers)
+                continue
+            sub.backlog.append((dest, content_type, body, headers))
+            self.pump(sub)
+
+    def pump(self, sub):
+        """Deliver queued messages of subscription `sub` within its prefetch
+        window
+
+        """
+        while sub.backlog:
+            if sub.prefetch is not None and len(sub.unacked) >= sub.prefetch:
+                break
+            self._deliver(sub, *sub.backlog.popleft())
+
+    def _deliver(self, sub, dest, content_type, body, headers=None):
+        self.delivered_count += 1
+        extra = {}
+        if headers:
+            extra.update(headers)
+        headers = None
+        if content_type is not None:
+            headers = {'content-type': content_type}
+        message_id = 'message-%d' % next(self._message_ids)
+        extra['subscription'] = sub.id
+        extra['message-id'] = message_id
+        if sub.ack != 'auto':
+            sub.unacked.add(message_id)
+            sub.session.unacked[message_id] = sub
+            if sub.session.version == '1.2':
+                extra['ack'] = message_id
+        sub.session.writeSequence(self.encoder.encodeSequence(
+            'MESSAGE', dest, body, headers, extra, sub.session.version))
+
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            sessions=len(self.sessions),
+            subscriptions=len(self._subs),
+            published=self.published_count,
+            delivered=self.delivered_count,
+            acked=self.acked_count,
+            nacked=self.nacked_count,
+        )
+
+if __name__ == '__main__':
+    from twisted.internet import reactor
+
+    logging.basicConfig(level=logging.INFO)
+    reactor.listenTCP(61613, STOMPBroker())
+    reactor.run()
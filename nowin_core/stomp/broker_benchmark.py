@@ -0,0 +1,345 @@
+"""Benchmark of the STOMP stack against the embedded broker over loopback
+
+Publish throughput: send messages in bursts with STOMPClient through the
+broker to a subscriber, and print messages per second with batching on and
+off.
+
+Fan-out latency: publish timestamped messages at a steady rate to many
+subscribers of a topic, and print percentiles of latency from sending to
+receiving.
+
+RPC round trip: make remote calls to an echo server with RemoteCall and
+RPCClient over STOMPMessageBus, and print percentiles of latency of calls.
+
+Reconnect time: drop connections of STOMPMessageBus from the broker side,
+and print time until ReconnectSupervisor gets it authorized again.
+
+Slow broker: stop reading from a publisher sending state updates of a
+hundred destinations as fast as it can, and print peak bytes held in
+memory by the client and its transport with each overflow policy.
+
+Failure detection: make the broker hang, stop reading and sending anything,
+and print time until STOMPClient with heart-beating drops the connection.
+
+"""
+import logging
+import time
+
+from twisted.internet import defer
+from twisted.internet import protocol as twisted_protocol
+
+from nowin_core.message_bus.rpc import RPCClient
+from nowin_core.message_bus.rpc import RemoteCall
+from nowin_core.message_bus.stomp import STOMPMessageBus
+from nowin_core.message_bus.supervisors import ReconnectSupervisor
+from nowin_core.stomp.async_client import STOMPClient
+from nowin_core.stomp.broker import STOMPBroker
+
+
+def percentile(values, p):
+    """Get `p` percentile of sorted `values`
+
+    """
+    index = min(len(values) - 1, int(len(values) * p / 100.0))
+    return values[index]
+
+
+def formatLatencies(latencies):
+    latencies = sorted(latencies)
+    return 'p50 %7.3f ms  p90 %7.3f ms  p99 %7.3f ms  max %7.3f ms' % tuple(
+        percentile(latencies, p) * 1000 for p in [50, 90, 99, 100])
+
+
+@defer.inlineCallbacks
+def connectClient(reactor, port, **kwargs):
+    """Connect a STOMPClient to the broker and login
+
+    """
+    creator = twisted_protocol.ClientCreator(
+        reactor, STOMPClient, stats_interval=None, **kwargs)
+    client = yield creator.connectTCP('127.0.0.1', port)
+    yield client.login('bench', 'bench')
+    defer.returnValue(client)
+
+
+def sync(client):
+    """Return a Deferred fired once the broker processed all frames sent by
+    `client`
+
+    """
+    return client.send('bench.sync', None, receipt=True)
+
+
+@defer.inlineCallbacks
+def runPublish(reactor, port, batch, count, burst):
+    """Send `count` messages in bursts of `burst` messages per reactor
+    iteration through the broker, return messages per second
+
+    """
+    done = defer.Deferred()
+    received = [0]
+
+    def callback(dest, data):
+        received[0] += 1
+        if received[0] == count:
+            done.callback(None)
+
+    subscriber = yield connectClient(reactor, port)
+    subscriber.subscribe('bench.publish', callback)
+    yield sync(subscriber)
+    publisher = yield connectClient(reactor, port, batch=batch,
+                                    batch_size=burst)
+    message = dict(id=1234, listeners=56, bitrate=128)
+
+    def sendBurst(remaining):
+        for _ in xrange(min(burst, remaining)):
+            publisher.send('bench.publish', message)
+        remaining -= burst
+        if remaining > 0:
+            reactor.callLater(0, sendBurst, remaining)
+
+    begin = time.time()
+    sendBurst(count)
+    yield done
+    elapsed = time.time() - begin
+    publisher.close()
+    subscriber.close()
+    defer.returnValue(count / elapsed)
+
+
+@defer.inlineCallbacks
+def runFanOut(reactor, port, subscriber_count, count, interval):
+    """Publish `count` timestamped messages every `interval` seconds to
+    `subscriber_count` subscribers, return latencies of all deliveries
+
+    """
+    latencies = []
+    done = defer.Deferred()
+
+    def callback(dest, data):
+        latencies.append(time.time() - data)
+        if len(latencies) == count * subscriber_count:
+            done.callback(None)
+
+    subscribers = []
+    for _ in xrange(subscriber_count):
+        subscriber = yield connectClient(reactor, port)
+        subscriber.subscribe('bench.fanout', callback)
+        yield sync(subscriber)
+        subscribers.append(subscriber)
+    publisher = yield connectClient(reactor, port)
+
+    def publish(remaining):
+        publisher.send('bench.fanout', time.time())
+        if remaining > 1:
+            reactor.callLater(interval, publish, remaining - 1)
+
+    publish(count)
+    yield done
+    publisher.close()
+    for subscriber in subscribers:
+        subscriber.close()
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def connectBus(port):
+    bus = STOMPMessageBus(('127.0.0.1', port), 'bench', 'bench',
+                          client_opts=dict(stats_interval=None))
+    yield bus.connect()
+    defer.returnValue(bus)
+
+
+@defer.inlineCallbacks
+def runRPC(reactor, port, use_client, concurrency, count):
+    """Make `count` calls to an echo server in `concurrency` concurrent
+    loops, return latencies of calls
+
+    """
+    server = yield connectBus(port)
+
+    def echo(dest, data):
+        server.send(data['reply_dest'], data['value'])
+    yield server.subscribe('rpc.echo', echo)
+    yield sync(server.client)
+
+    bus = yield connectBus(port)
+    client = RPCClient(bus, reactor=reactor)
+    yield client.start()
+    yield sync(bus.client)
+    latencies = []
+
+    @defer.inlineCallbacks
+    def loop():
+        for i in xrange(count // concurrency):
+            begin = time.time()
+            if use_client:
+                yield client.call('rpc.echo', dict(value=i))
+            else:
+                call = RemoteCall(bus, 'rpc.echo', dict(value=i),
+                                  reactor=reactor)
+                yield call()
+            latencies.append(time.time() - begin)
+
+    yield defer.DeferredList([loop() for _ in xrange(concurrency)])
+    client.close()
+    bus.close()
+    server.close()
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def runReconnect(reactor, broker, port, rounds):
+    """Drop connection of a supervised message bus `rounds` times, return
+    seconds from dropping to authorized again of every round
+
+    """
+    bus = yield connectBus(port)
+    ReconnectSupervisor(bus, delay=0)
+    durations = []
+    for _ in xrange(rounds):
+        authorized = defer.Deferred()
+        sub_id = bus.auth_event.subscribe(lambda: authorized.callback(None))
+        begin = time.time()
+        for conn in broker.sessions.values():
+            conn.transport.loseConnection()
+        yield authorized
+        durations.append(time.time() - begin)
+        sub_id.unsubscribe()
+    bus.close()
+    defer.returnValue(durations)
+
+
+def bufferedBytes(client):
+    """Bytes held by `client` and its transport, not written to socket yet
+
+    """
+    transport = client.transport
+    buffered = len(getattr(transport, 'dataBuffer', '')) + \
+        getattr(transport, '_tempDataLen', 0)
+    return client.getStats()['pending_bytes'] + buffered
+
+
+@defer.inlineCallbacks
+def runSlowBroker(reactor, broker, port, duration, **kwargs):
+    """Send state updates for `duration` seconds while the broker doesn't
+    read, return peak buffered bytes and client statistics
+
+    """
+    client = yield connectClient(reactor, port, **kwargs)
+    conn = broker.sessions[client.session_id]
+    conn.transport.stopReading()
+    # the broker recovers after `duration`, so that blocked sending resumes
+    reactor.callLater(duration, conn.transport.startReading)
+    state = dict(peak=0)
+    end = time.time() + duration
+    done = defer.Deferred()
+    message = dict(listeners=123, bitrate=128, padding='x' * 200)
+
+    @defer.inlineCallbacks
+    def sendBurst():
+        for i in xrange(100):
+            d = client.send('bench.state.%d' % i, message)
+            if d is not None:
+                yield d
+        state['peak'] = max(state['peak'], bufferedBytes(client))
+        if time.time() < end:
+            reactor.callLater(0, sendBurst)
+        else:
+            done.callback(None)
+
+    sendBurst()
+    yield done
+    stats = client.getStats()
+    client.transport.abortConnection()
+    defer.returnValue((state['peak'], stats))
+
+
+@defer.inlineCallbacks
+def runFailureDetection(reactor, broker, port, heartbeat):
+    """Make the broker hang for a client with `heartbeat`, return seconds
+    until the client drops the connection
+
+    """
+    client = yield connectClient(reactor, port, accept_version='1.2',
+                                 heartbeat=heartbeat)
+    lost = defer.Deferred()
+    client.conn_lost_event.subscribe(lambda: lost.callback(None))
+    conn = broker.sessions[client.session_id]
+    begin = time.time()
+    conn._heartbeat_call.cancel()
+    conn._watchdog_call.cancel()
+    conn._heartbeat_call = conn._watchdog_call = None
+    conn.transport.stopReading()
+    yield lost
+    conn.transport.loseConnection()
+    defer.returnValue(time.time() - begin)
+
+
+@defer.inlineCallbacks
+def runAll(reactor):
+    broker = STOMPBroker()
+    port = reactor.listenTCP(0, broker, interface='127.0.0.1')
+    port_number = port.getHost().port
+
+    for burst in [10, 100]:
+        print 'publishing through broker in bursts of %d' % burst
+        for batch in [False, True]:
+            mps = yield runPublish(reactor, port_number, batch, 100000, burst)
+            print '  batch=%-8s %12.0f messages/sec' % (batch, mps)
+
+    print 'fan-out latency of 1000 messages, one every 2 ms'
+    for subscriber_count in [1, 10, 50]:
+        latencies = yield runFanOut(reactor, port_number, subscriber_count,
+                                    1000, 0.002)
+        print '  subscribers=%-4d %s' % (subscriber_count,
+                                         formatLatencies(latencies))
+
+    print 'RPC round trip of 2000 calls'
+    for concurrency in [1, 50]:
+        for name, use_client in [('RemoteCall', False),
+                                 ('RPCClient', True)]:
+            latencies = yield runRPC(reactor, port_number, use_client,
+                                     concurrency, 2000)
+            print '  %-12s concurrency=%-4d %s' % (
+                name, concurrency, formatLatencies(latencies))
+
+    durations = yield runReconnect(reactor, broker, port_number, 20)
+    print 'reconnect of 20 rounds'
+    print '  %s' % formatLatencies(durations)
+
+    print 'slow broker for 2 seconds, 100 destinations'
+    limit = 256 * 1024
+    for name, kwargs in [
+        ('unbounded', dict(max_pending_bytes=None, overflow_policy='drop')),
+        ('block', dict(max_pending_bytes=limit, overflow_policy='block')),
+        ('drop', dict(max_pending_bytes=limit, overflow_policy='drop')),
+        ('coalesce', dict(max_pending_bytes=limit,
+                          overflow_policy='coalesce')),
+    ]:
+        peak, stats = yield runSlowBroker(reactor, broker, port_number, 2,
+                                          **kwargs)
+        print '  %-10s peak %8.1f KB  %8d sent %8d dropped %8d coalesced' \
+            % (name, peak / 1024.0, stats['sent'], stats['dropped'],
+               stats['coalesced'])
+
+    print 'detecting a hung broker with heart-beats'
+    for interval in [200, 1000]:
+        broker.heartbeat = (interval, interval)
+        elapsed = yield runFailureDetection(reactor, broker, port_number,
+                                            (interval, interval))
+        print '  heart-beat=%-5d ms  detected in %6.3f s' % (
+            interval, elapsed)
+
+    yield port.stopListening()
+    reactor.stop()
+
+
+def main():
+    from twisted.internet import reactor
+    logging.basicConfig(level=logging.ERROR)
+    reactor.callWhenRunning(runAll, reactor)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,29 @@
-import json
+"""Synchronous STOMP client for scripts
+
+Client sends frames with `sendall`, so writes are never truncated. With
+`flush_size`, sent messages are pipelined, they are buffered and written
+together once `flush_size` bytes are buffered, or when `flush` is called.
+A message sent with `receipt` flushes the buffer and waits until the
+server receipts it, which means all messages sent before it are processed.
+Data is received into a reusable buffer with `recv_into`.
+
+ClientPool serves many connections, to one or more brokers, with one
+`select` loop, and spreads messages across them by destination. Clients of
+a pool are in non-blocking mode, data a socket doesn't take is kept by the
+client, and written once select says the socket is writable, so that a
+stalled broker doesn't block the others. Once `max_unsent_bytes` are kept,
+`send` raises BufferFullError until the broker catches up.
+
+"""
+import collections
+import errno
+import itertools
 import logging
+import select
 import socket
 
+from nowin_core.message_bus.codec import LazyPayload
+from nowin_core.message_bus.codec import default_codec
 from nowin_core.stomp import protocol
 
 
@@ -12,11 +34,32 @@ class StompError(Exception):
     """
 
 
+class BufferFullError(StompError):
+
+    """Raised when a message is sent while too much data is not written to
+    the socket yet
+
+    """
+
+
 class Client(object):
 
-    recv_size = 4096
+    recv_size = 65536
+
+    #: max bytes of kept data to write with one send call
+    send_size = 65536
+
+    def __init__(self, host, port, SocketClass=None, codec=None,
+                 flush_size=0, max_unsent_bytes=4 * 1024 * 1024,
+                 logger=None):
+        """
 
-    def __init__(self, host, port, SocketClass=None, logger=None):
+        @param flush_size: bytes of sent messages to buffer before writing
+            them together, 0 for writing every message immediately
+        @param max_unsent_bytes: in non-blocking mode, bytes not written to
+            the socket yet over which sending messages raises
+            BufferFullError, None for no limit
+        """
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger('stomp.client')
@@ -26,26 +69,182 @@ class Client(object):
         self.host = host
         self.port = port
         self.parser = protocol.Parser()
+        self.encoder = protocol.Encoder()
+        self.codec = codec
+        if self.codec is None:
+            self.codec = default_codec
+        self._codec_headers = {'content-type': self.codec.content_type}
+        self.flush_size = flush_size
+        self.max_unsent_bytes = max_unsent_bytes
         self.connected = False
         self.session_id = None
         self.socket = None
         self.callbacks = {}
+        # destinations of callbacks called with LazyPayload
+        self._lazy = set()
+        #: count of sent messages
+        self.sent_count = 0
+        #: bytes of sent messages
+        self.sent_bytes = 0
+        #: count of writes to the socket
+        self.write_count = 0
+        #: count of received messages
+        self.received_count = 0
+
+        #: is the socket in blocking mode
+        self.blocking = True
+
+        # frames to write
+        self._outbox = []
+        self._outbox_size = 0
+        # chunks of data flushed but not taken by the socket yet
+        # (non-blocking mode), bytes of them, and bytes of the first one
+        # already written
+        self._unsent = collections.deque()
+        self._unsent_size = 0
+        self._unsent_offset = 0
+        # buffer data is received into
+        self._recv_buffer = bytearray(self.recv_size)
+        # receipt ids received
+        self._receipts = set()
+        self._receipt_ids = itertools.count(1)
 
     def checkError(self, frame):
         if frame.command == 'ERROR':
             message = frame.headers['message']
             raise StompError(message)
 
+    def fileno(self):
+        """File descriptor of the socket, for select
+
+        """
+        return self.socket.fileno()
+
+    def setBlocking(self, flag):
+        """Set blocking mode of the socket, in non-blocking mode, flush
+        writes only what the socket takes, and the rest is written by
+        handleWrite
+
+        """
+        self.socket.setblocking(flag)
+        self.blocking = flag
+
+    def wantsWrite(self):
+        """Is there data flushed but not written yet, for select loops
+
+        """
+        return bool(self._unsent)
+
+    def _recv(self):
+        """Receive data once, return False if the connection is closed
+
+        """
+        try:
+            size = self.socket.recv_into(self._recv_buffer)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            raise
+        if not size:
+            return False
+        self.parser.feed(memoryview(self._recv_buffer)[:size])
+        return True
+
+    def _wait(self, read=True):
+        """Wait until the socket is readable, or with `read` False, until all
+        data is written, in non-blocking mode
+
+        """
+        while read or self._unsent:
+            writers = [self] if self._unsent else []
+            readable, writable, _ = select.select([self] if read else [],
+                                                  writers, [])
+            if writable:
+                self.handleWrite()
+            if readable:
+                return
+
     def getFrame(self):
-        frame = None
+        # frames received with previous data come first
+        frame = self.parser.getFrame()
         while frame is None:
-            data = self.socket.recv(self.recv_size)
-            if not data:
+            if not self.blocking:
+                self._wait()
+            if not self._recv():
                 break
-            self.parser.feed(data)
             frame = self.parser.getFrame()
         return frame
 
+    def _write(self, data):
+        self._outbox.append(data)
+        self._outbox_size += len(data)
+        if self._outbox_size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered frames to the socket
+
+        """
+        if not self._outbox:
+            return
+        if len(self._outbox) == 1:
+            data = self._outbox[0]
+        else:
+            data = ''.join(self._outbox)
+        self._outbox = []
+        self._outbox_size = 0
+        if self.blocking:
+            self.socket.sendall(data)
+            self.write_count += 1
+            return
+        self._unsent.append(data)
+        self._unsent_size += len(data)
+        self.handleWrite()
+
+    def handleWrite(self):
+        """Write data not sent yet as much as the socket takes, for select
+        loops
+
+        """
+        unsent = self._unsent
+        while unsent:
+            chunk = unsent[0]
+            # join small chunks, so that they are not written one by one
+            if not self._unsent_offset and len(unsent) > 1 and \
+                    len(chunk) < self.send_size:
+                chunks = []
+                size = 0
+                while unsent and size < self.send_size:
+                    chunks.append(unsent.popleft())
+                    size += len(chunks[-1])
+                chunk = ''.join(chunks)
+                unsent.appendleft(chunk)
+            try:
+                sent = self.socket.send(buffer(chunk, self._unsent_offset))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.write_count += 1
+            self._unsent_size -= sent
+            self._unsent_offset += sent
+            if self._unsent_offset < len(chunk):
+                return
+            unsent.popleft()
+            self._unsent_offset = 0
+
+    def isFull(self):
+        """Are there `max_unsent_bytes` or more not written to the socket
+        yet, try writing some of them first
+
+        """
+        if self.blocking or self.max_unsent_bytes is None:
+            return False
+        if self._unsent_size + self._outbox_size < self.max_unsent_bytes:
+            return False
+        self.handleWrite()
+        return self._unsent_size + self._outbox_size >= self.max_unsent_bytes
+
     def login(self, user, password):
         """Login to STOMP server
 
@@ -56,7 +255,7 @@ class Client(object):
         self.socket.connect((self.host, self.port))
 
         frame = protocol.Frame('CONNECT', dict(login=user, passcode=password))
-        self.socket.send(frame.pack())
+        self.socket.sendall(frame.pack())
 
         reply = self.getFrame()
         # disconnected
@@ -74,14 +273,19 @@ class Client(object):
         else:
             raise StompError('Unknown command')
 
-    def subscribe(self, dest, callback):
-        """Subscribe to message queue `dest` with `callback` function
+    def subscribe(self, dest, callback, lazy=False):
+        """Subscribe to message queue `dest` with `callback` function, which
+        is called with LazyPayload instead of decoded data if `lazy` is True
 
         """
         assert self.connected is True
         frame = protocol.Frame('SUBSCRIBE', dict(destination=dest))
-        self.socket.send(frame.pack())
+        self._write(frame.pack())
         self.callbacks[dest] = callback
+        if lazy:
+            self._lazy.add(dest)
+        else:
+            self._lazy.discard(dest)
         self.logger.info('Session %s subscribed to %s', self.session_id, dest)
 
     def unsubscribe(self, dest):
@@ -90,47 +294,218 @@ class Client(object):
         """
         assert self.connected is True
         frame = protocol.Frame('UNSUBSCRIBE', dict(destination=dest))
-        self.socket.send(frame.pack())
+        self._write(frame.pack())
         del self.callbacks[dest]
+        self._lazy.discard(dest)
         self.logger.info(
             'Session %s unsubscribed to %s', self.session_id, dest)
 
-    def send(self, dest, data):
-        """Send data to message queue
+    def send(self, dest, data, receipt=False):
+        """Send data to message queue, if `receipt` is True, wait until the
+        server receipts it, messages received meanwhile are dispatched, raise
+        BufferFullError if too much data is not written yet
 
         """
         assert self.connected is True
-        data = json.dumps(data)
-        frame = protocol.Frame('SEND', dict(destination=dest), data)
-        self.socket.send(frame.pack())
-        self.logger.info('Session %s send %d bytes data to %s',
-                         self.session_id, len(data), dest)
+        if self.isFull():
+            raise BufferFullError('%d bytes not written to %s:%s yet' % (
+                self._unsent_size + self._outbox_size, self.host, self.port))
+        data = self.codec.encode(data)
+        rid = None
+        headers = None
+        if receipt:
+            rid = 'receipt-%d' % next(self._receipt_ids)
+            headers = dict(receipt=rid)
+        self._write(self.encoder.encode('SEND', dest, data,
+                                        self._codec_headers, headers))
+        self.sent_count += 1
+        self.sent_bytes += len(data)
+        self.logger.debug('Session %s send %d bytes data to %s',
+                          self.session_id, len(data), dest)
+        if rid is not None:
+            self.waitReceipt(rid)
+
+    def waitReceipt(self, rid):
+        """Flush and wait for receipt `rid`, messages received meanwhile are
+        dispatched
+
+        """
+        self.flush()
+        while rid not in self._receipts:
+            frame = self.getFrame()
+            if frame is None:
+                self.connected = False
+                raise StompError('Connection closed before receipt %s' % rid)
+            self.dispatch(frame)
+        self._receipts.discard(rid)
+
+    def dispatch(self, frame):
+        """Handle a frame from the server
+
+        """
+        if frame.command == 'MESSAGE':
+            dest = frame.headers['destination']
+            callback = self.callbacks[dest]
+            self.received_count += 1
+            payload = LazyPayload(frame.body,
+                                  frame.headers.get('content-type'))
+            if dest in self._lazy:
+                callback(dest, payload)
+            else:
+                callback(dest, payload.decode())
+        elif frame.command == 'RECEIPT':
+            self._receipts.add(frame.headers.get('receipt-id'))
+        else:
+            self.checkError(frame)
+            raise StompError('Unexpected command %s' % frame.command)
+
+    def handleRead(self):
+        """Receive data once and dispatch complete frames, for select
+        loops, return False if the connection is closed by peer
+
+        """
+        if not self._recv():
+            self.connected = False
+            self.logger.info('Session %s closed by peer', self.session_id)
+            return False
+        self.dispatchPending()
+        return True
+
+    def dispatchPending(self):
+        """Dispatch complete frames already received
+
+        """
+        for frame in self.parser.getFrames():
+            self.dispatch(frame)
 
     def close(self):
         """Close connection to server
 
         """
         assert self.connected is True
-        frame = protocol.Frame('DISCONNECT')
-        self.socket.send(frame.pack())
+        self._write(protocol.Frame('DISCONNECT').pack())
+        self.flush()
+        if not self.blocking:
+            self._wait(read=False)
         self.socket.close()
         self.connected = False
         self.logger.info('Session %s closed', self.session_id)
 
+    def getStats(self):
+        """Get statistics as a dict
+
+        """
+        return dict(
+            sent=self.sent_count,
+            sent_bytes=self.sent_bytes,
+            writes=self.write_count,
+            received=self.received_count,
+            buffered_bytes=self._outbox_size,
+            unsent_bytes=self._unsent_size,
+        )
+
     def run(self):
         """Run loop for checking messages and calling callbacks
 
         """
         assert self.connected is True
-        frame = None
+        self.flush()
         while True:
             frame = self.getFrame()
             if frame is None:
                 break
-            if frame.command != 'MESSAGE':
-                raise StompError('Unexpected command %s', frame.command)
-            dest = frame.headers['destination']
-            callback = self.callbacks[dest]
-            callback(dest, json.loads(frame.body))
+            self.dispatch(frame)
         self.connected = False
         self.logger.info('Session %s closed by peer', self.session_id)
+
+
+class ClientPool(object):
+
+    """Logged in clients served by one select loop
+
+    Messages sent through the pool go through one of the clients chosen by
+    destination, so that messages of a destination keep their order. Clients
+    are put in non-blocking mode, and those have data not written yet are
+    written when their sockets are writable.
+
+    """
+
+    def __init__(self, clients=(), logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger('stomp.client')
+        self.clients = []
+        for client in clients:
+            self.add(client)
+
+    def add(self, client):
+        """Add a logged in client, it's put in non-blocking mode
+
+        """
+        client.setBlocking(False)
+        self.clients.append(client)
+
+    def remove(self, client):
+        """Remove a client
+
+        """
+        self.clients.remove(client)
+
+    def getClient(self, dest):
+        """Get client to send messages of `dest` through
+
+        """
+        return self.clients[hash(dest) % len(self.clients)]
+
+    def send(self, dest, data, receipt=False):
+        """Send data to message queue through one of the clients, raise
+        BufferFullError if the client has too much data not written yet
+
+        """
+        self.getClient(dest).send(dest, data, receipt)
+
+    def flush(self):
+        """Write buffered frames of all clients
+
+        """
+        for client in self.clients:
+            client.flush()
+
+    def poll(self, timeout=None):
+        """Flush all clients, wait up to `timeout` seconds for data, or for
+        sockets to take data not written yet, dispatch frames received, and
+        return count of readable clients, clients closed by peer are removed
+
+        """
+        self.flush()
+        if not self.clients:
+            return 0
+        # frames received while waiting for receipts
+        for client in self.clients:
+            client.dispatchPending()
+        writers = [client for client in self.clients if client.wantsWrite()]
+        readable, writable, _ = select.select(self.clients, writers, [],
+                                              timeout)
+        for client in readable:
+            if not client.handleRead():
+                self.remove(client)
+        for client in writable:
+            if client in self.clients:
+                client.handleWrite()
+        return len(readable)
+
+    def run(self):
+        """Run loop until all clients are closed by peer
+
+        """
+        while self.clients:
+            self.poll()
+
+    def close(self):
+        """Close all clients
+
+        """
+        for client in self.clients:
+            if client.connected:
+                client.close()
+        self.clients = []
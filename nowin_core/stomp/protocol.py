@@ -1,13 +1,44 @@
+#: escapes of header keys and values by version, backslash goes first
+_header_escapes = {
+    '1.1': [('\\', '\\\\'), ('\n', '\\n'), (':', '\\c')],
+    '1.2': [('\\', '\\\\'), ('\n', '\\n'), (':', '\\c'),
+            ('\r', '\\r')],
+}
+
+
+def escapeHeader(value, version='1.0'):
+    """Escape a header key or value for STOMP `version`, 1.0 has no escaping
+
+    """
+    for char, escaped in _header_escapes.get(version, ()):
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+
+def encodeHeader(key, value, version='1.0', command=None):
+    """Encode a header line without newline, keys and values are escaped if
+    `version` is 1.1 or later, except in CONNECT and CONNECTED frames
+
+    """
+    if version != '1.0' and command not in ('CONNECT', 'CONNECTED'):
+        key = escapeHeader('%s' % key, version)
+        value = escapeHeader('%s' % value, version)
+    line = '%s:%s' % (key, value)
+    if isinstance(line, unicode):
+        line = line.encode('utf8')
+    return line
+
+
 class Parser(object):
 
     """Parser for parsing STOMP frames
 
     """
 
-    # Note: The STOMP standard didn't say anything about what new line
-    # character it should be, it said that's an HTTP school style protocol,
-    # therefore, it should be \r\n, but however, we saw other STOMP library
-    # use \n as the newline character. That's why we set it as a variable here
+    # Note: STOMP 1.0 didn't say anything about what new line character it
+    # should be, 1.2 says lines end with \n or \r\n, we accept both, and a
+    # frame may mix them
     newline = '\n'
 
     # Note: The STOMP standard didn't mention that should we strip the
@@ -15,76 +46,169 @@ class Parser(object):
     # headers
     stripHeaders = False
 
+    # STOMP 1.1 and later escape \n, : and \ in header values (and \r in
+    # 1.2) of frames other than CONNECT and CONNECTED, set it to True once
+    # such version is negotiated
+    unescapeHeaders = False
+
+    _escapes = {'n': '\n', 'r': '\r', 'c': ':', '\\': '\\'}
+
     # phase for header
     headerPhase = 0
     # phase for body
     bodyPhase = 1
 
     def __init__(self, remain=''):
-        self.buffer = [remain]
+        self.buffer = bytearray(remain)
+        # position of data not parsed yet in buffer
+        self._pos = 0
+        # position to resume searching delimiter from
+        self._search = 0
 
         # what phase we are in
         self._phase = self.headerPhase
         self._command = None
         self._headers = None
+        # length of body, None for reading until null character
+        self._length = None
+        # splitters of header and body, the one last seen goes first
+        self._splitters = self.newline * 2, self.newline + '\r\n'
+        #: count of heart-beats (EOLs between frames) received
+        self.heartbeat_count = 0
 
     def feed(self, data):
         """Feed data to parser
 
         """
-        self.buffer.append(data)
+        self.buffer.extend(data)
 
-    def getFrame(self):
-        """Get a frame from buffer, if there is no complete frame, return None
+    def _compact(self):
+        """Remove parsed data from buffer, only when it's worth moving the
+        remaining data
 
         """
-        if len(self.buffer) > 1:
-            self.buffer = [''.join(self.buffer)]
-        data = self.buffer[0]
+        if not self._pos or self._pos * 2 < len(self.buffer):
+            return
+        del self.buffer[:self._pos]
+        self._search -= self._pos
+        self._pos = 0
+
+    def _unescape(self, value):
+        i = value.find('\\')
+        if i < 0:
+            return value
+        result = []
+        begin = 0
+        while i >= 0:
+            result.append(value[begin:i])
+            result.append(self._escapes.get(value[i + 1:i + 2], ''))
+            begin = i + 2
+            i = value.find('\\', begin)
+        result.append(value[begin:])
+        return ''.join(result)
+
+    def _parseHeaders(self, end):
+        headerLines = str(self.buffer[self._pos:end]).split(self.newline)
+        self._command = headerLines[0].rstrip('\r')
+        self._headers = {}
+        unescape = self.unescapeHeaders and \
+            self._command not in ('CONNECT', 'CONNECTED')
+        # \r of line breaks is stripped with values
+        for line in headerLines[1:]:
+            key, value = line.split(':', 1)
+            if self.stripHeaders:
+                key = key.strip()
+                value = value.strip()
+            if unescape:
+                key = self._unescape(key)
+                value = self._unescape(value)
+                # only the first value of a repeated header is used
+                if key.strip() in self._headers:
+                    continue
+            self._headers[key.strip()] = value.strip()
+        self._length = None
+        if 'content-length' in self._headers:
+            self._length = int(self._headers['content-length'])
 
-        frame = None
+    def _parse(self):
+        """Parse a frame from buffer without compacting it, if there is no
+        complete frame, return None
+
+        """
+        buf = self.buffer
         if self._phase == self.headerPhase:
-            # read header
-            splitter = self.newline * 2
-            if splitter in data:
-                i = data.find(splitter)
-                headerLines = data[:i].split(self.newline)
-                data = data[i + len(splitter):]
-
-                self._command = headerLines[0]
-                self._headers = {}
-                for line in headerLines[1:]:
-                    key, value = line.split(':', 1)
-                    key = key
-                    value = value
-                    if self.stripHeaders:
-                        key = key.strip()
-                        value = value.strip()
-                    self._headers[key.strip()] = value.strip()
-                self._phase = self.bodyPhase
-        if self._phase == self.bodyPhase:
-            # the index of \0 character to read in body
-            i = None
-            # read content-length bytes from buffer
-            if 'content-length' in self._headers:
-                length = int(self._headers['content-length'])
-                if len(data) >= length:
-                    i = length
+            # skip heart-beats, and EOLs after the null character of last
+            # frame
+            while self._pos < len(buf) and buf[self._pos] in (10, 13):
+                if buf[self._pos] == 10:
+                    self.heartbeat_count += 1
+                self._pos += 1
+            if self._search < self._pos:
+                self._search = self._pos
+            # read header, look for the splitter of last frame first, the
+            # other one is only looked for in the header found, so that it
+            # doesn't scan the whole buffer
+            first, second = self._splitters
+            i = buf.find(first, self._search)
+            end = len(buf)
+            if i >= 0:
+                end = i + len(second)
+            j = buf.find(second, self._search, end)
+            if j >= 0 and (i < 0 or j < i):
+                self._splitters = second, first
+                i, first = j, second
+            elif i < 0:
+                # the splitter (up to 3 bytes) may be cut at the end of
+                # buffer
+                self._search = max(self._pos, len(buf) - 2)
+                return None
+            self._parseHeaders(i)
+            self._pos = self._search = i + len(first)
+            self._phase = self.bodyPhase
+
+        # the index of \0 character after the body
+        if self._length is not None:
+            # read content-length bytes without scanning them
+            i = self._pos + self._length
+            if len(buf) <= i:
+                return None
+        else:
             # read until null character
-            elif '\0' in data:
-                i = data.index('\0')
-
-            if i is not None:
-                body = data[:i]
-                data = data[i + 1:]
-                frame = Frame(self._command, self._headers, body)
-                self._command = None
-                self._headers = None
-                self._phase = self.headerPhase
-
-        self.buffer = [data]
+            i = buf.find('\0', self._search)
+            if i < 0:
+                self._search = len(buf)
+                return None
+
+        body = buffer(buf, self._pos, i - self._pos)[:]
+        frame = Frame(self._command, self._headers, body)
+        self._pos = self._search = i + 1
+        self._command = None
+        self._headers = None
+        self._length = None
+        self._phase = self.headerPhase
+        return frame
+
+    def getFrame(self):
+        """Get a frame from buffer, if there is no complete frame, return None
+
+        """
+        frame = self._parse()
+        self._compact()
         return frame
 
+    def getFrames(self):
+        """Get all complete frames from buffer as a list
+
+        """
+        frames = []
+        while True:
+            frame = self._parse()
+            if frame is None:
+                break
+            frames.append(frame)
+        self._compact()
+        return frames
+
 
 class Frame(object):
 
@@ -101,8 +225,9 @@ class Frame(object):
             self.headers = {}
         self.body = body
 
-    def pack(self):
-        """Pack the frame as a string
+    def pack(self, version='1.0'):
+        """Pack the frame as a string, headers are escaped if `version` is
+        1.1 or later
 
         """
         if '\0' in self.body:
@@ -110,9 +235,80 @@ class Frame(object):
 
         headers = [self.command]
         for key, value in self.headers.iteritems():
-            line = '%s:%s' % (key, value)
-            if isinstance(line, unicode):
-                line = line.encode('utf8')
-            headers.append(line)
+            headers.append(encodeHeader(key, value, version, self.command))
 
         return self.newline.join(headers) + self.newline * 2 + self.body + '\0'
+
+
+class Encoder(object):
+
+    """Encoder for packing frames to send
+
+    Header lines of a frame are encoded once per (command, destination,
+    static headers, version) and cached, only the content-length and the
+    dynamic headers (such as receipt) are formatted for every frame. Body is
+    always sent with content-length, so that it doesn't need to be scanned
+    for null character. Headers are escaped if version is 1.1 or later.
+
+    """
+
+    newline = '\n'
+
+    def __init__(self, cache_size=1024):
+        #: max count of cached header prefixes
+        self.cache_size = cache_size
+        # map (command, destination, static headers, version) to encoded
+        # prefix
+        self._prefixes = {}
+
+    def getPrefix(self, command, destination=None, headers=None,
+                  version='1.0'):
+        """Get encoded command and header lines of a frame
+
+        """
+        static = None
+        if headers:
+            static = tuple(sorted(headers.iteritems()))
+        key = (command, destination, static, version)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            lines = [command]
+            if destination is not None:
+                lines.append(encodeHeader('destination', destination,
+                                          version, command))
+            for name, value in static or ():
+                lines.append(encodeHeader(name, value, version, command))
+            prefix = self.newline.join(lines) + self.newline
+            if len(self._prefixes) >= self.cache_size:
+                self._prefixes.clear()
+            self._prefixes[key] = prefix
+        return prefix
+
+    def encodeSequence(self, command, destination=None, body='',
+                       headers=None, extra_headers=None, version='1.0'):
+        """Encode a frame as a list of strings, for writeSequence
+
+        @param headers: static headers, which are cached with destination
+        @param extra_headers: dynamic headers, which are encoded every time
+        @param version: negotiated version of STOMP
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        parts = [self.getPrefix(command, destination, headers, version)]
+        if extra_headers:
+            for key, value in extra_headers.iteritems():
+                parts.append(encodeHeader(key, value, version, command) +
+                             self.newline)
+        parts.append('content-length:%d%s%s' % (
+            len(body), self.newline, self.newline))
+        parts.append(body)
+        parts.append('\0')
+        return parts
+
+    def encode(self, command, destination=None, body='',
+               headers=None, extra_headers=None, version='1.0'):
+        """Encode a frame as a string
+
+        """
+        return ''.join(self.encodeSequence(command, destination, body,
+                                           headers, extra_headers, version))
@@ -0,0 +1,168 @@
+"""Benchmark for streaming audio data to listeners
+
+Compare the CPU time of pull and push producer modes of StreamProtocol, and
+measure the heap size of every connected listener, run it with
+
+    python -m nowin_core.stream.benchmark [listeners] [blocks]
+
+"""
+import gc
+import sys
+import time
+
+from nowin_core.memory.audio_stream import AudioStream
+from nowin_core.stream import base
+from nowin_core.stream.server import StreamFactory
+
+
+class FakeTransport(object):
+
+    """Transport mimics the producer behavior of Twisted's FileDescriptor,
+    without touching any real socket
+
+    """
+
+    bufferSize = 2 ** 16
+
+    def __init__(self):
+        self.producer = None
+        self.streamingProducer = False
+        self.producerPaused = False
+        self.buffered = 0
+        self.written = 0
+
+    def getPeer(self):
+        return None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streamingProducer = streaming
+        if not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        pass
+
+    def write(self, data):
+        self.buffered += len(data)
+        if self.streamingProducer and self.buffered > self.bufferSize:
+            self.producerPaused = True
+            self.producer.pauseProducing()
+
+    def doWrite(self):
+        """Called as the reactor flushes the buffer to socket
+
+        """
+        if not self.buffered:
+            return
+        self.written += self.buffered
+        self.buffered = 0
+        if self.producer is None:
+            return
+        if not self.streamingProducer:
+            self.producer.resumeProducing()
+        elif self.producerPaused:
+            self.producerPaused = False
+            self.producer.resumeProducing()
+
+
+def connect(factory, transports, name='radio'):
+    """Connect a listener to resource `name` for each of transports
+
+    """
+    header = base.makeHeader(dict(name=name))
+    protocols = []
+    for transport in transports:
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(transport)
+        protocol.dataReceived(header)
+        protocols.append(protocol)
+    return protocols
+
+
+def heapSize():
+    """Get current size of Python heap in bytes
+
+    Use tracemalloc if it is available, otherwise, sum the size of all
+    objects tracked by the garbage collector, that is all containers and
+    instances, which is what a listener session is made of
+
+    """
+    gc.collect()
+    try:
+        import tracemalloc
+    except ImportError:
+        return sum(sys.getsizeof(obj) for obj in gc.get_objects())
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measureMemory(listeners=1000, block_size=1024):
+    """Connect `listeners` listeners and return bytes of heap per listener
+
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        pass
+    else:
+        tracemalloc.start()
+    factory = StreamFactory(lambda: AudioStream(block_size, 128))
+    res = factory.add('radio')
+    res.write('x' * block_size * 2)
+    # transports are not part of the session, create them beforehand
+    transports = [FakeTransport() for _ in xrange(listeners)]
+
+    begin = heapSize()
+    protocols = connect(factory, transports)
+    used = heapSize() - begin
+    assert len(protocols) == listeners
+    return used / float(listeners)
+
+
+def run(push_producer, listeners=1000, blocks=1000, block_size=1024):
+    """Stream `blocks` blocks to `listeners` listeners, and return CPU time
+    in seconds it costs
+
+    """
+    factory = StreamFactory(lambda: AudioStream(block_size, 128),
+                            push_producer=push_producer)
+    res = factory.add('radio')
+    block = 'x' * block_size
+    # fill half of the buffer, so that listeners begin in the middle
+    for _ in xrange(64):
+        res.write(block)
+
+    transports = [FakeTransport() for _ in xrange(listeners)]
+    connect(factory, transports)
+    # flush the initial data
+    for transport in transports:
+        transport.doWrite()
+
+    begin = time.clock()
+    for _ in xrange(blocks):
+        res.write(block)
+        for transport in transports:
+            transport.doWrite()
+    return time.clock() - begin
+
+
+def main():
+    listeners = 1000
+    blocks = 1000
+    if len(sys.argv) > 1:
+        listeners = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        blocks = int(sys.argv[2])
+    for name, push_producer in [('pull', False), ('push', True)]:
+        elapsed = run(push_producer, listeners, blocks)
+        print '%s mode: %d listeners, %d blocks, %.3f seconds CPU, ' \
+            '%.3f ms CPU per 1000 listeners per block' % (
+                name, listeners, blocks, elapsed,
+                elapsed * 1000 * 1000.0 / listeners / blocks)
+    print 'memory: %.1f bytes per listener' % measureMemory(listeners)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""Live migration of a StreamFactory to another process
+
+To upgrade a broadcast server without disconnecting listeners, the new
+process listens on a UNIX socket with MigrationReceiverFactory, then the old
+process calls migrate. The old process
+
+1. stops reading and writing on every listener connection
+2. sends file descriptors of the listening port and all listener sockets
+   with SCM_RIGHTS through the UNIX socket
+3. sends the state, that is audio streams of all resources and the name,
+   offset and not yet sent data of all sessions
+
+The new process adopts the listening port and all sockets, loads the audio
+streams, and then resumes every session from its offset. Once it's done, it
+replies an acknowledge, and the old process closes its copies of sockets
+without shutting them down, so that listeners see no reconnect.
+
+Sources are not migrated, audio written to the old process after its state
+is sent is lost, but listeners are in the middle of the buffer, new sources
+of the new process have about half buffer of time to reconnect before they
+run out of data.
+
+The message is a 4 bytes length (network order) followed by the state in
+JSON, binary data in it is encoded as base64.
+
+"""
+import base64
+import json
+import logging
+import os
+import socket
+import struct
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.internet.protocol import ClientCreator
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+from zope.interface import implements
+
+from nowin_core.patterns import observer
+
+#: acknowledge from the new process
+ACK = 'OK'
+
+_length = struct.Struct('!I')
+
+
+def encodeState(state):
+    """Encode state as a message to send
+
+    """
+    state = dict(state)
+    resources = {}
+    for name, stream_state in state['resources'].iteritems():
+        stream_state = dict(stream_state)
+        stream_state['bytes'] = base64.b64encode(stream_state['bytes'])
+        stream_state['pieces'] = base64.b64encode(stream_state['pieces'])
+        resources[name] = stream_state
+    state['resources'] = resources
+    sessions = []
+    for session in state['sessions']:
+        session = dict(session)
+        session['pending'] = base64.b64encode(session['pending'])
+        sessions.append(session)
+    state['sessions'] = sessions
+    body = json.dumps(state)
+    return _length.pack(len(body)) + body
+
+
+def decodeState(body):
+    """Decode state from body of a message
+
+    """
+    state = json.loads(body)
+    for stream_state in state['resources'].itervalues():
+        stream_state['bytes'] = base64.b64decode(stream_state['bytes'])
+        stream_state['pieces'] = base64.b64decode(stream_state['pieces'])
+    for session in state['sessions']:
+        session['pending'] = base64.b64decode(session['pending'])
+    return state
+
+
+def getPendingData(transport):
+    """Get data buffered in a Twisted transport but not sent yet, return None
+    if the transport doesn't buffer data as we know
+
+    Streams write audio data to their transport directly, so that the data
+    not sent yet is only in the buffer of transport. Twisted has no public
+    API for it, this reads the write buffer of abstract.FileDescriptor, that
+    is `dataBuffer` from `offset`, followed by `_tempDataBuffer`.
+
+    """
+    try:
+        data = transport.dataBuffer
+        offset = transport.offset
+        temp = transport._tempDataBuffer
+    except AttributeError:
+        return None
+    return str(data[offset:]) + ''.join(temp)
+
+
+def detach(transport):
+    """Remove a transport from reactor and close its socket without shutting
+    it down, so that the process we sent it to keeps the connection
+
+    """
+    transport.stopReading()
+    transport.stopWriting()
+    transport.socket.close()
+
+
+class MigrationSender(Protocol):
+
+    """Protocol for sending state of a StreamFactory to the new process
+
+    """
+
+    def __init__(self, stream_factory, port=None, logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        #: factory to migrate
+        self.stream_factory = stream_factory
+        #: listening port of the factory to migrate
+        self.port = port
+        #: streams we are migrating
+        self.streams = []
+        #: resources of streams we are migrating
+        self.resources = set()
+        #: is the migration acknowledged by peer
+        self.acknowledged = False
+        self._buffer = ''
+        #: fired with count of migrated sessions
+        self.deferred = defer.Deferred()
+
+    def freeze(self):
+        """Stop all streams and return their states
+
+        Streams are taken out of their resources without firing empty_event,
+        so that an emptied resource is not torn down while migrating. Streams
+        which we can't get pending data of are not migrated.
+
+        """
+        sessions = []
+        for res in self.stream_factory.resources.itervalues():
+            for stream in list(res.streams):
+                if not stream.streaming or stream.is_closed:
+                    continue
+                transport = stream.transport
+                pending = getPendingData(transport)
+                if pending is None:
+                    self.logger.warn('Unable to get pending data of %s, '
+                                     'not migrated', stream)
+                    continue
+                transport.stopReading()
+                transport.stopWriting()
+                res.remove(stream, event=False)
+                self.resources.add(res)
+                self.streams.append(stream)
+                sessions.append(dict(
+                    session_no=stream.session_no,
+                    name=stream.name,
+                    offset=stream.offset,
+                    family=transport.socket.family,
+                    pending=pending,
+                ))
+        return sessions
+
+    def thaw(self):
+        """Resume all streams we stopped, called if the migration failed
+
+        """
+        for stream in self.streams:
+            res = self.stream_factory.getResource(stream.name)
+            if res is None:
+                stream.close('Resource removed during migration')
+                continue
+            res.add(stream)
+            stream.transport.startReading()
+            stream.transport.startWriting()
+        self.streams = []
+        self.resources = set()
+
+    def connectionMade(self):
+        state = self.stream_factory.getState()
+        state['sessions'] = self.freeze()
+        state['port'] = None
+        if self.port is not None:
+            self.port.stopReading()
+            state['port'] = dict(family=self.port.socket.family)
+            self.transport.sendFileDescriptor(self.port.fileno())
+        for stream in self.streams:
+            self.transport.sendFileDescriptor(stream.transport.fileno())
+        self.transport.write(encodeState(state))
+        self.logger.info('Sent state of %d sessions to %s',
+                         len(self.streams), self.transport.getPeer())
+
+    def dataReceived(self, data):
+        if self.acknowledged:
+            self.logger.error('Unexpected data %r', data)
+            return
+        self._buffer += data
+        if len(self._buffer) < len(ACK):
+            return
+        if self._buffer != ACK:
+            # we don't know what the peer did, resume streams here
+            self.logger.error('Unexpected data %r', self._buffer)
+            self.transport.loseConnection()
+            return
+        self.acknowledged = True
+        for stream in self.streams:
+            stream.is_closed = True
+            detach(stream.transport)
+        if self.port is not None:
+            detach(self.port)
+        count = len(self.streams)
+        self.streams = []
+        # resources emptied by migration are idle now
+        for res in self.resources:
+            if not res.streams:
+                res.empty_event()
+        self.resources = set()
+        self.transport.loseConnection()
+        self.logger.info('Migrated %d sessions', count)
+        self.deferred.callback(count)
+
+    def connectionLost(self, reason):
+        if self.acknowledged:
+            return
+        self.logger.error('Migration failed, %s', reason)
+        self.thaw()
+        if self.port is not None:
+            self.port.startReading()
+        self.deferred.errback(reason)
+
+
+def migrate(stream_factory, path, port=None, reactor=None):
+    """Migrate `stream_factory` and its listening `port` to the process
+    listening on UNIX socket `path`, return a Deferred fired with count of
+    migrated sessions
+
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    creator = ClientCreator(reactor, MigrationSender, stream_factory, port)
+    d = creator.connectUNIX(path)
+    d.addCallback(lambda sender: sender.deferred)
+    return d
+
+
+class _PrebuiltFactory(Factory):
+
+    """Factory returns an already built protocol, for adopting a connection
+
+    """
+
+    def __init__(self, protocol):
+        self._protocol = protocol
+
+    def buildProtocol(self, addr):
+        return self._protocol
+
+
+class MigrationReceiver(Protocol):
+
+    """Protocol for receiving state of a StreamFactory from old process
+
+    """
+    implements(IFileDescriptorReceiver)
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        #: received file descriptors
+        self.fds = []
+        self._buffer = ''
+
+    def fileDescriptorReceived(self, fd):
+        self.fds.append(fd)
+
+    def dataReceived(self, data):
+        self._buffer += data
+        if len(self._buffer) < _length.size:
+            return
+        length, = _length.unpack(self._buffer[:_length.size])
+        if len(self._buffer) < _length.size + length:
+            return
+        body = self._buffer[_length.size:_length.size + length]
+        self._buffer = ''
+        try:
+            self.factory.restore(decodeState(body), self.fds)
+        finally:
+            for fd in self.fds:
+                os.close(fd)
+            self.fds = []
+        self.transport.write(ACK)
+
+
+class MigrationReceiverFactory(Factory):
+
+    """Factory for receiving a migrated StreamFactory
+
+    """
+
+    protocol = MigrationReceiver
+
+    def __init__(self, stream_factory, reactor=None, logger=None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        #: factory to restore
+        self.stream_factory = stream_factory
+        #: adopted listening port
+        self.port = None
+
+        #: called when a migration is done with argument (count of sessions)
+        self.restored_event = observer.Subject()
+
+    def restore(self, state, fds):
+        """Restore `state` of StreamFactory with sockets in `fds`, the first
+        one is the listening port if there is one in state
+
+        """
+        fds = list(fds)
+        self.stream_factory.setState(state)
+        if state['port'] is not None:
+            self.port = self.reactor.adoptStreamPort(
+                fds.pop(0), state['port']['family'], self.stream_factory)
+        assert len(fds) == len(state['sessions']), \
+            'count of sockets does not match count of sessions'
+        for fd, session in zip(fds, state['sessions']):
+            res = self.stream_factory.getResource(session['name'])
+            stream = self.stream_factory.buildProtocol(None)
+            stream.session_no = session['session_no']
+            self.reactor.adoptStreamConnection(
+                fd, session.get('family', socket.AF_INET),
+                _PrebuiltFactory(stream))
+            stream.startStreaming(res, session['offset'], session['pending'])
+        self.logger.info('Restored %d sessions', len(state['sessions']))
+        self.restored_event(len(state['sessions']))
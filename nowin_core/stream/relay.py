@@ -0,0 +1,198 @@
+import logging
+
+from nowin_core.memory.governor import MemoryLimitError
+from nowin_core.stream.client import StreamClientFactory
+
+
+class Relay(object):
+
+    """A relay from upstream server to an audio resource of a proxy
+
+    """
+
+    #: connecting to upstream
+    STATE_STARTING = 'starting'
+    #: receiving audio data from upstream
+    STATE_STREAMING = 'streaming'
+
+    def __init__(self, name, resource, client):
+        #: name of audio resource
+        self.name = name
+        #: audio resource of StreamFactory
+        self.resource = resource
+        #: StreamClientFactory to upstream
+        self.client = client
+        #: state of this relay
+        self.state = self.STATE_STARTING
+        #: delayed call for tearing down this relay
+        self.idle_call = None
+
+    def __repr__(self):
+        return '<%s name=%s, state=%s, listeners=%d>' % (
+            self.__class__.__name__,
+            self.name,
+            self.state,
+            len(self.resource.streams)
+        )
+
+
+class RelayManager(object):
+
+    """Manager opens relays from upstream on demand for a proxy
+
+    The first listener request for a radio which the StreamFactory doesn't
+    have opens a relay to upstream, the resource is added right away, so that
+    listeners coming while the relay is starting are pooled in it, and they
+    get audio data once the upstream starts streaming. After the last
+    listener left, or if no listener ever comes to an opened relay, and
+    nobody comes in `grace_period` seconds, the relay is torn down and its
+    buffer is freed. If the upstream fails, the relay is torn down with all
+    its listeners.
+
+    """
+
+    def __init__(
+        self,
+        stream_factory,
+        host,
+        port,
+        grace_period=30,
+        keep_alive_opts=None,
+        client_factory=StreamClientFactory,
+        reactor=None,
+        logger=None
+    ):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+        self.reactor = reactor
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        #: StreamFactory of the proxy
+        self.stream_factory = stream_factory
+        #: host of upstream server
+        self.host = host
+        #: port of upstream server
+        self.port = port
+        #: seconds to wait before tearing down an idle relay
+        self.grace_period = grace_period
+        #: keep alive options for upstream connections
+        self.keep_alive_opts = keep_alive_opts
+        #: class for creating client to upstream
+        self.client_factory = client_factory
+        #: map name to relays
+        self.relays = {}
+        #: count of relays torn down
+        self.torn_down_count = 0
+
+        self.stream_factory.resource_provider = self.open
+
+    def open(self, name):
+        """Open a relay for `name` and return the resource, return None if
+        there is no room for it, the relay is idle until a listener comes
+
+        """
+        assert name not in self.relays
+        try:
+            res = self.stream_factory.add(name)
+        except MemoryLimitError:
+            self.logger.warn('No memory for relay %s', name)
+            return None
+        client = self.client_factory(
+            self.host,
+            self.port,
+            name,
+            keep_alive_opts=self.keep_alive_opts,
+            reactor=self.reactor
+        )
+        relay = Relay(name, res, client)
+        self.relays[name] = relay
+
+        client.audio_received_event.subscribe(res.write)
+        client.streaming_event.subscribe(
+            lambda: self.handleStreaming(relay))
+        client.conn_failed_event.subscribe(
+            lambda: self.teardown(relay, 'Upstream failed'))
+        client.conn_lost_event.subscribe(
+            lambda: self.teardown(relay, 'Upstream lost'))
+        res.empty_event.subscribe(lambda: self.handleIdle(relay))
+        client.start()
+        self.logger.info('Opened relay %s', relay)
+        self.handleIdle(relay)
+        return res
+
+    def handleStreaming(self, relay):
+        """Called when upstream of relay started streaming
+
+        """
+        relay.state = Relay.STATE_STREAMING
+        self.logger.info('Relay %s started streaming', relay)
+
+    def handleIdle(self, relay):
+        """Called when the last listener of relay left
+
+        """
+        if self.relays.get(relay.name) is not relay:
+            return
+        if relay.idle_call is not None:
+            relay.idle_call.cancel()
+        relay.idle_call = self.reactor.callLater(
+            self.grace_period, self.handleIdleTimeout, relay)
+        self.logger.info('Relay %s is idle, tear down in %s seconds',
+                         relay, self.grace_period)
+
+    def handleIdleTimeout(self, relay):
+        """Called when the grace period of an idle relay is over
+
+        """
+        relay.idle_call = None
+        # somebody came back
+        if relay.resource.streams:
+            return
+        self.teardown(relay, 'Idle')
+
+    def teardown(self, relay, reason=None):
+        """Tear down a relay, close its upstream connection and listeners,
+        and remove its resource
+
+        """
+        if self.relays.get(relay.name) is not relay:
+            return
+        del self.relays[relay.name]
+        if relay.idle_call is not None:
+            relay.idle_call.cancel()
+            relay.idle_call = None
+        relay.client.connector.disconnect()
+        self.stream_factory.remove(relay.name)
+        relay.resource.close('Relay torn down')
+        self.torn_down_count += 1
+        self.logger.info('Tore down relay %s with reason %s', relay, reason)
+
+    def close(self):
+        """Tear down all relays
+
+        """
+        for relay in self.relays.values():
+            self.teardown(relay, 'Closed by manager')
+
+    def getStats(self):
+        """Get statistics of relays as a dict
+
+        """
+        active = 0
+        idle = 0
+        starting = 0
+        for relay in self.relays.itervalues():
+            if relay.state == Relay.STATE_STARTING:
+                starting += 1
+            elif relay.resource.streams:
+                active += 1
+            else:
+                idle += 1
+        return dict(
+            starting=starting,
+            active=active,
+            idle=idle,
+            torn_down=self.torn_down_count,
+        )
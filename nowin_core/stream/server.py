@@ -1,15 +1,18 @@
 import logging
 
+from twisted.internet.interfaces import ILoggingContext
+from twisted.internet.interfaces import IProtocol
 from twisted.internet.interfaces import IPullProducer
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Factory
-from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import connectionDone
 from zope.interface import implements
 
 from nowin_core.patterns import observer
 from nowin_core.stream import base
 
 
-class StreamProtocol(Protocol):
+class StreamProtocol(object):
 
     """Stream protocol is a very simple protocol for sending audio stream data
     only.
@@ -93,10 +96,52 @@ class StreamProtocol(Protocol):
     Server -> Client
         (audio binary data)
 
-    """
-    implements(IPullProducer)
+    The stream can be registered to the transport in two modes. As a pull
+    producer (default), Twisted calls resumeProducing every time the write
+    buffer is drained, and we send one block for each call. As a streaming
+    (push) producer, data written to the audio resource goes directly to the
+    transport, Twisted only calls pauseProducing when the peer can't keep up,
+    and resumeProducing when it catches up again, then we resync from the
+    offset of this stream.
+
+    A broadcast server holds tens of thousands of these, so that the
+    protocol is kept compact: it doesn't inherit Twisted's Protocol, which is
+    an old-style class with a __dict__ for every instance, but implements
+    IProtocol by itself with __slots__. Events are created only when someone
+    subscribes to them, and the audio resource is notified directly rather
+    than through subscriptions.
 
-    def __init__(self, get_res_func, session_no=0, logger=None):
+    """
+    implements(IProtocol, ILoggingContext, IPullProducer, IPushProducer)
+
+    __slots__ = (
+        'logger',
+        'get_res_func',
+        'session_no',
+        'push_producer',
+        '_buffer',
+        '_buffer_size',
+        '_hungry',
+        'streaming',
+        'name',
+        'offset',
+        'is_closed',
+        'resource',
+        'audio_stream',
+        '_conn_lost_event',
+        '_data_write_event',
+        'factory',
+        'transport',
+        'connected',
+    )
+
+    def __init__(
+        self,
+        get_res_func,
+        session_no=0,
+        push_producer=False,
+        logger=None
+    ):
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
@@ -104,10 +149,12 @@ class StreamProtocol(Protocol):
         self.get_res_func = get_res_func
         #: session number
         self.session_no = session_no
-        #: buffer for header
-        self._buffer = []
+        #: register as a streaming (push) producer rather than a pull one
+        self.push_producer = push_producer
+        #: buffer for header, created when the first chunk arrives
+        self._buffer = None
         self._buffer_size = 0
-        #: does the client needs more data
+        #: does the client needs more data (in push mode: is it not paused)
         self._hungry = True
         #: is this stream already streaming data
         self.streaming = False
@@ -117,13 +164,17 @@ class StreamProtocol(Protocol):
         self.offset = 0
         #: is this connection closed?
         self.is_closed = False
+        #: audio resource we are streaming
+        self.resource = None
         #: audio stream
         self.audio_stream = None
 
-        #: called when connection lost
-        self.conn_lost_event = observer.Subject()
-        #: called when data write with argument (data)
-        self.data_write_event = observer.Subject()
+        self._conn_lost_event = None
+        self._data_write_event = None
+
+        self.factory = None
+        self.transport = None
+        self.connected = 0
 
     def __repr__(self):
         return '<%s session=%s, addr=%s>' % (
@@ -139,18 +190,65 @@ class StreamProtocol(Protocol):
         """
         return self.transport.getPeer()
 
+    @property
+    def conn_lost_event(self):
+        """Called when connection lost
+
+        """
+        if self._conn_lost_event is None:
+            self._conn_lost_event = observer.Subject()
+        return self._conn_lost_event
+
+    @property
+    def data_write_event(self):
+        """Called when data write with argument (data)
+
+        """
+        if self._data_write_event is None:
+            self._data_write_event = observer.Subject()
+        return self._data_write_event
+
+    def _notifyConnLost(self):
+        if self.resource is not None:
+            self.resource.handleClosedStream(self)
+        if self._conn_lost_event is not None:
+            self._conn_lost_event()
+
+    def _notifyDataWrite(self, block):
+        if self.resource is not None:
+            self.resource.data_write_event(block)
+        if self._data_write_event is not None:
+            self._data_write_event(block)
+
     def getBuffer(self):
         data = ''.join(self._buffer)
         self._buffer = [data]
         return data
 
+    def logPrefix(self):
+        return self.__class__.__name__
+
+    def makeConnection(self, transport):
+        self.connected = 1
+        self.transport = transport
+        self.connectionMade()
+
     def connectionMade(self):
         self.logger.info('New connection %s', self)
 
+    def connectionLost(self, reason=connectionDone):
+        self.connected = 0
+
     def stopProducing(self):
-        self.conn_lost_event()
+        self._notifyConnLost()
         self.logger.info('%s stop producing', self)
 
+    def pauseProducing(self):
+        """Called when the write buffer of peer is full (push mode only)
+
+        """
+        self._hungry = False
+
     def resumeProducing(self):
         """Called when peer needs more data
 
@@ -171,10 +269,20 @@ class StreamProtocol(Protocol):
             self.close('Out of buffer', event=True)
             return
 
+        if self.push_producer:
+            # send every block we have, the transport will call
+            # pauseProducing during the write once its buffer is full
+            stream = self.audio_stream
+            while self._hungry and self.offset < stream.size:
+                block, self.offset = stream.read(self.offset)
+                self.transport.write(block)
+                self._notifyDataWrite(block)
+            return
+
         block, self.offset = self.audio_stream.read(self.offset)
         if block:
             self.transport.write(block)
-            self.data_write_event(block)
+            self._notifyDataWrite(block)
             self._hungry = False
 
     def sendHeader(self, header):
@@ -191,27 +299,46 @@ class StreamProtocol(Protocol):
             self.sendHeader(dict(name=name, result='not_found'))
             self.close(event=True)
             return
-        res.add(self)
         # set the offset to middle of the buffer, in order to avoid
         # running out of data too soon
-        self.offset = res.audio_stream.middle
-        self.audio_stream = res.audio_stream
-        header = dict(name=name, result='found', begin_offset=self.offset)
+        offset = res.audio_stream.middle
+        header = dict(name=name, result='found', begin_offset=offset)
         self.sendHeader(header)
-        # register self as the pull producer
-        self.transport.registerProducer(self, False)
+        self.startStreaming(res, offset)
+
+    def startStreaming(self, res, offset, pending=''):
+        """Start streaming audio data of resource `res` from `offset`
+
+        This is also called to resume a stream migrated from another process,
+        `pending` is the data that process buffered but not sent yet
+
+        """
+        res.add(self)
+        self.name = res.name
+        self.offset = offset
+        self.audio_stream = res.audio_stream
+        if pending:
+            self.transport.write(pending)
+        # register self as the producer, a pull producer is resumed by the
+        # transport right away, a push producer has to send the data we
+        # already have by itself
+        self.transport.registerProducer(self, self.push_producer)
         self.streaming = True
+        if self.push_producer:
+            self.produce()
         self.logger.info('%s started streaming', self)
 
     def dataReceived(self, data):
         if not self.streaming:
+            if self._buffer is None:
+                self._buffer = []
             self._buffer.append(data)
             self._buffer_size += len(data)
             if base.end_of_header in data:
                 header_data = self.getBuffer()
                 # we don't need the buffer any more
-                del self._buffer
-                del self._buffer_size
+                self._buffer = None
+                self._buffer_size = 0
                 header, other = base.parseHeader(header_data)
                 self.handleRequest(header)
                 if other:
@@ -229,11 +356,12 @@ class StreamProtocol(Protocol):
         """
         if self.is_closed:
             return
-        self.transport.unregisterProducer()
+        if self.streaming:
+            self.transport.unregisterProducer()
         self.transport.loseConnection()
         self.is_closed = True
         if event:
-            self.conn_lost_event()
+            self._notifyConnLost()
         self.logger.info('Close stream %s with reason %s', self, reason)
 
 
@@ -251,30 +379,52 @@ class AudioResource(object):
         self.streams = set()
         #: called when data write with argument (data)
         self.data_write_event = observer.Subject()
+        #: called when the last stream is removed
+        self.empty_event = observer.Subject()
 
     def handleClosedStream(self, stream):
         self.remove(stream)
 
+    def getListenerOffsets(self):
+        """Get offsets of all streams
+
+        """
+        return [s.offset for s in self.streams]
+
     def add(self, stream):
+        """Add a stream to this resource, the stream notifies us directly
+        when it writes data or gets closed
+
+        """
         self.streams.add(stream)
-        stream.conn_lost_event.subscribe(
-            lambda: self.handleClosedStream(stream))
-        stream.data_write_event.subscribe(self.data_write_event)
+        stream.resource = self
         self.logger.info('Add stream %s to resource %s', stream, self)
 
-    def remove(self, stream):
+    def remove(self, stream, event=True):
+        """Remove a stream from this resource, fire empty_event if it's the
+        last one and `event` is True
+
+        """
         self.streams.remove(stream)
+        stream.resource = None
         self.logger.info('Delete stream %s from resource %s', stream, self)
+        if event and not self.streams:
+            self.empty_event()
 
     def write(self, data):
         """Write audio data to all streams
 
+        Streams in pull mode send a block only if the peer asked for it, while
+        streams in push mode send new data right away unless they are paused
+
         """
         self.audio_stream.write(data)
         [s.produce() for s in self.streams]
 
     def close(self, reason=None):
-        [s.close('Resource closed') for s in self.streams]
+        for s in self.streams:
+            s.resource = None
+            s.close('Resource closed')
         self.streams = set()
         self.logger.info('Close audio resource %s with reason %s',
                          self, reason)
@@ -284,31 +434,58 @@ class StreamFactory(Factory):
 
     protocol = StreamProtocol
 
-    def __init__(self, audio_stream_factory, logger=None):
+    def __init__(
+        self,
+        audio_stream_factory,
+        push_producer=False,
+        governor=None,
+        logger=None
+    ):
         self.logger = logger
         if self.logger is None:
             self.logger = logging.getLogger(__name__)
         self.audio_stream_factory = audio_stream_factory
+        #: register streams as streaming (push) producers
+        self.push_producer = push_producer
+        #: memory governor audio streams register with
+        self.governor = governor
+        #: function called with (name) to provide a resource which doesn't
+        #: exist for a listener request, it returns the resource or None
+        self.resource_provider = None
         #: mapping name to audio resources
         self.resources = {}
         #: current session number
         self.session_no = 0
         #: triggered when data was wrote with argument (data string)
         self.data_write_event = observer.Subject()
+        # bound method shared by all protocols
+        self._get_res_func = self.getOrOpenResource
 
     def buildProtocol(self, addr):
         s = self.session_no
-        p = self.protocol(self.getResource, s)
+        p = self.protocol(self._get_res_func, s,
+                          push_producer=self.push_producer,
+                          logger=self.logger)
         p.factory = self
         self.session_no += 1
         return p
 
     def getResource(self, name):
-        """Get resource and return
+        """Get resource and return, return None if there is no such resource
 
         """
         return self.resources.get(name)
 
+    def getOrOpenResource(self, name):
+        """Get resource for a listener request, ask resource_provider for it
+        if there is no such resource
+
+        """
+        res = self.resources.get(name)
+        if res is None and self.resource_provider is not None:
+            res = self.resource_provider(name)
+        return res
+
     def getCountOfStreams(self):
         """Get total count of streams (connections)
 
@@ -319,22 +496,50 @@ class StreamFactory(Factory):
         return sum
 
     def add(self, name):
-        """Add audio resource
+        """Add audio resource, raise MemoryLimitError if the governor has no
+        room for it
 
         """
         assert name not in self.resources
         audio_stream = self.audio_stream_factory()
         resource = AudioResource(name, audio_stream)
+        if self.governor is not None:
+            self.governor.register(audio_stream, resource.getListenerOffsets)
         resource.data_write_event.subscribe(self.data_write_event)
         self.resources[name] = resource
         return resource
 
+    def getState(self):
+        """Get state of this factory, that is the session number and the audio
+        streams of all resources, for migrating it to another process
+
+        """
+        resources = {}
+        for name, res in self.resources.iteritems():
+            resources[name] = res.audio_stream.getState()
+        return dict(session_no=self.session_no, resources=resources)
+
+    def setState(self, state):
+        """Load state from getState, resources which don't exist are added
+
+        """
+        self.session_no = max(self.session_no, state['session_no'])
+        for name, stream_state in state['resources'].iteritems():
+            res = self.resources.get(name)
+            if res is None:
+                res = self.add(name)
+            res.audio_stream.setState(stream_state)
+            if self.governor is not None:
+                self.governor.update(res.audio_stream)
+
     def remove(self, name):
         """Delete audio resource
 
         """
         resource = self.resources[name]
         del self.resources[name]
+        if self.governor is not None:
+            self.governor.unregister(resource.audio_stream)
         return resource
 
     def write(self, name, data):
@@ -83,6 +83,29 @@ class TestUserModel(unittest.TestCase):
         self.assertEqual(site.location, u'location'.upper())
         self.assertEqual(user.active, True)
 
+    def test_signals_after_commit(self):
+        import transaction
+        from nowin_core import signals
+        from nowin_core.signals.dispatcher import AfterCommitDispatcher
+        model = self.make_one()
+        signals.set_dispatcher(AfterCommitDispatcher())
+
+        result = []
+        signals.user_created_event.subscribe(result.append)
+        signals.user_activated_event.subscribe(result.append)
+
+        with transaction.manager:
+            user_id = model.create_user(
+                user_name=u'tester',
+                email=u'tester@now.in',
+                display_name=u'tester',
+                password=u'thepass'
+            )
+            model.activate_user(user_id, u'title', u'location')
+            # not delivered until commit
+            self.assertEqual(result, [])
+        self.assertEqual(result, [user_id, user_id])
+
     def test_authenticate_user(self):
         import transaction
         model = self.make_one()
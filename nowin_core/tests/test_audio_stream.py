@@ -135,6 +135,54 @@ class TestAudioStream(unittest.TestCase):
         stream.write('123456789')
         self.assertEqual(stream.data, '89abcdef123456789')
 
+    def testResize(self):
+        stream = audio_stream.AudioStream(3, 5)
+        stream.write('1234567890abcdefghijk')
+        # 9 <- base
+        # 789 0ab cde fgh ijk
+        self.assertEqual(stream.base, 6)
+        stream.resize(3)
+        self.assertEqual(stream.blockCount, 3)
+        self.assertEqual(stream.bufferSize, 9)
+        self.assertEqual(stream.base, 12)
+        self.assertEqual(stream.size, 21)
+        self.assertEqual(stream.data, 'cdefghijk')
+        self.assertEqual(stream.read(15), ('fgh', 18))
+        self.assertEqual(stream.read(12), ('cde', 15))
+
+        stream.write('lmn')
+        self.assertEqual(stream.base, 15)
+        self.assertEqual(stream.read(21), ('lmn', 24))
+
+        # grow it back, there is no old data
+        stream.resize(5)
+        self.assertEqual(stream.base, 15)
+        self.assertEqual(stream.read(15), ('fgh', 18))
+        stream.write('opqrst')
+        self.assertEqual(stream.base, 15)
+        self.assertEqual(stream.read(27), ('rst', 30))
+        stream.write('uvw')
+        self.assertEqual(stream.base, 18)
+        self.assertEqual(stream.read(18), ('ijk', 21))
+
+    def testState(self):
+        stream = audio_stream.AudioStream(3, 5)
+        stream.write('1234567890abcdefghij')
+        state = stream.getState()
+
+        other = audio_stream.AudioStream()
+        other.setState(state)
+        self.assertEqual(other.blockSize, 3)
+        self.assertEqual(other.blockCount, 5)
+        self.assertEqual(other.base, stream.base)
+        self.assertEqual(other.size, stream.size)
+        self.assertEqual(other.data, stream.data)
+        self.assertEqual(other.read(9), stream.read(9))
+
+        # the piece should be kept too
+        other.write('k')
+        self.assertEqual(other.read(18), ('ijk', 21))
+
 
 def suite():
     suite = unittest.TestSuite()
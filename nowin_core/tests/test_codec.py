@@ -0,0 +1,67 @@
+import unittest
+
+
+class TestCodec(unittest.TestCase):
+
+    data = dict(server_name='p1', radios={u'user0': 10, u'user1': 0})
+
+    def test_round_trip(self):
+        from nowin_core.message_bus import codec
+        for c in [codec.JSONCodec(), codec.DeflateCodec()]:
+            body = c.encode(self.data)
+            self.assert_(isinstance(body, str))
+            self.assertEqual(c.decode(body), self.data)
+
+    def test_deflate(self):
+        from nowin_core.message_bus import codec
+        c = codec.DeflateCodec()
+        data = dict(radios=dict((u'user%05d' % i, i % 50)
+                                for i in xrange(1000)))
+        body = c.encode(data)
+        self.assert_(len(body) * 2 < len(codec.JSONCodec().encode(data)))
+        # decompression bombs are refused
+        c.max_size = 1024
+        self.assertRaises(ValueError, c.decode, body)
+
+    def test_get_codec(self):
+        from nowin_core.message_bus import codec
+        self.assert_(codec.getCodec() is codec.default_codec)
+        self.assert_(isinstance(codec.getCodec('application/x-json-deflate'),
+                                codec.DeflateCodec))
+        # parameters are ignored
+        self.assert_(isinstance(
+            codec.getCodec('Application/X-JSON-Deflate; charset=utf-8'),
+            codec.DeflateCodec))
+        self.assert_(codec.getCodec('application/json; charset=utf-8') is
+                     codec.default_codec)
+        # foreign content types are JSON
+        self.assert_(codec.getCodec('text/plain') is codec.default_codec)
+
+    def test_lazy_payload(self):
+        from nowin_core.message_bus import codec
+        deflate_codec = codec.DeflateCodec()
+        payload = codec.LazyPayload(deflate_codec.encode(self.data),
+                                    deflate_codec.content_type)
+        self.assertFalse(payload.decoded)
+        data = payload.decode()
+        self.assertEqual(data, self.data)
+        self.assertTrue(payload.decoded)
+        # decoded only once
+        self.assert_(payload.decode() is data)
+
+        payload = codec.LazyPayload('[1, 2]')
+        self.assertEqual(payload.decode(), [1, 2])
+        payload = codec.LazyPayload('[1, 2]',
+                                    'application/json; charset=utf-8')
+        self.assertEqual(payload.decode(), [1, 2])
+        payload = codec.LazyPayload('[1, 2]', 'text/plain')
+        self.assertEqual(payload.decode(), [1, 2])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCodec))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
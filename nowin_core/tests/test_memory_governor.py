@@ -0,0 +1,127 @@
+import unittest
+
+from nowin_core.memory.audio_stream import AudioStream
+
+
+class TestMemoryGovernor(unittest.TestCase):
+
+    def make_one(self, *args, **kwargs):
+        from nowin_core.memory.governor import MemoryGovernor
+        return MemoryGovernor(*args, **kwargs)
+
+    def make_stream(self, blockCount=10):
+        stream = AudioStream(10, blockCount)
+        stream.write('x' * 10 * blockCount)
+        return stream
+
+    def test_register(self):
+        governor = self.make_one(300, min_blocks=2)
+        a = self.make_stream()
+        b = self.make_stream()
+        governor.register(a)
+        governor.register(b)
+        self.assertEqual(governor.usage, 200)
+        self.assertEqual(governor.shrink_count, 0)
+        governor.unregister(a)
+        self.assertEqual(governor.usage, 100)
+
+    def test_shrink_idle_first(self):
+        governor = self.make_one(250, 400, min_blocks=2)
+        shrinks = []
+        governor.shrink_event.subscribe(
+            lambda stream, old, new: shrinks.append((stream, old, new)))
+        busy = self.make_stream()
+        idle = self.make_stream()
+        few = self.make_stream()
+        governor.register(busy, lambda: [50, 60, 70])
+        governor.register(idle)
+        governor.register(few, lambda: [40])
+        self.assertEqual(governor.usage, 250)
+        self.assertEqual(shrinks, [(idle, 10, 5)])
+
+        # stream with a listener is not shrunk to where the listener would
+        # be out of the window
+        other = self.make_stream()
+        governor.register(other, lambda: [40, 50])
+        self.assertEqual(idle.blockCount, 2)
+        self.assertEqual(few.blockCount, 6)
+        self.assertEqual(other.blockCount, 7)
+        self.assertEqual(busy.blockCount, 10)
+        self.assertEqual(governor.usage, 250)
+        self.assertEqual(governor.shrink_count, 4)
+
+    def test_refuse(self):
+        from nowin_core.memory.governor import MemoryLimitError
+        governor = self.make_one(150, 200, min_blocks=5)
+        refused = []
+        governor.refuse_event.subscribe(refused.append)
+        a = self.make_stream()
+        governor.register(a, lambda: [0])
+        b = self.make_stream()
+        governor.register(b, lambda: [0])
+        c = self.make_stream()
+        with self.assertRaises(MemoryLimitError):
+            governor.register(c)
+        self.assertEqual(refused, [c])
+        self.assertEqual(governor.refused_count, 1)
+        self.assertEqual(governor.usage, 200)
+        self.assertEqual(governor.getStats()['streams'], 2)
+
+    def test_grow(self):
+        governor = self.make_one(200, 300, min_blocks=2)
+        a = self.make_stream()
+        b = self.make_stream()
+        c = self.make_stream()
+        governor.register(a)
+        governor.register(b)
+        governor.register(c)
+        self.assertEqual(governor.usage, 200)
+        governor.unregister(c)
+        self.assertEqual(a.blockCount, 10)
+        self.assertEqual(b.blockCount, 10)
+
+    def test_update(self):
+        governor = self.make_one(200, 300, min_blocks=2)
+        a = self.make_stream()
+        b = self.make_stream()
+        governor.register(a)
+        governor.register(b)
+        # loaded a bigger buffer, shrunk to the budget
+        a.setState(self.make_stream(15).getState())
+        governor.update(a)
+        self.assertEqual(governor.usage, 200)
+        self.assertEqual(governor.shrink_count, 1)
+        # loaded a smaller buffer, grown back as the budget allows
+        b.setState(self.make_stream(5).getState())
+        governor.update(b)
+        self.assertEqual(governor.usage, 200)
+
+    def test_factory(self):
+        from nowin_core.memory.governor import MemoryLimitError
+        from nowin_core.stream.server import StreamFactory
+        governor = self.make_one(200, 250, min_blocks=8)
+        factory = StreamFactory(self.make_stream, governor=governor)
+        factory.add('a')
+        factory.add('b')
+        with self.assertRaises(MemoryLimitError):
+            factory.add('c')
+        self.assertEqual(sorted(factory.resources), ['a', 'b'])
+        factory.remove('a')
+        self.assertEqual(governor.usage, 100)
+        factory.add('c')
+        self.assertEqual(governor.usage, 200)
+
+        # loading state keeps the usage in the budget
+        other = StreamFactory(lambda: self.make_stream(15))
+        other.add('c')
+        factory.setState(other.getState())
+        self.assertEqual(governor.usage, 200)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMemoryGovernor))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -60,9 +60,9 @@ class MockReactor(object):
 
 class TestRemoteCall(unittest.TestCase):
 
-    def _makeOne(self, msgbus, dest, data, timeout=5, reactor=None):
+    def _makeOne(self, msgbus, dest, data, timeout=5, timer=None):
         from nowin_core.message_bus.rpc import RemoteCall
-        return RemoteCall(msgbus, dest, data, timeout, reactor=reactor)
+        return RemoteCall(msgbus, dest, data, timeout, timer=timer)
 
     def test_reply_dest_check(self):
         msgbus = MockMsgBus()
@@ -152,7 +152,7 @@ class TestRemoteCall(unittest.TestCase):
         test_dest = 'test_dest'
 
         # make a remote call
-        call = self._makeOne(msgbus, test_dest, msg, reactor=reactor)
+        call = self._makeOne(msgbus, test_dest, msg, timer=reactor)
         d = call()
         errbacks = []
 
@@ -181,7 +181,7 @@ class TestRemoteCall(unittest.TestCase):
         msg = dict(body='hello')
         test_dest = 'test_dest'
         # make a remote call
-        call = self._makeOne(msgbus, test_dest, msg, reactor=reactor)
+        call = self._makeOne(msgbus, test_dest, msg, timer=reactor)
         d = call()
 
         results = []
@@ -203,9 +203,354 @@ class TestRemoteCall(unittest.TestCase):
         self.assertEqual(len(results), 1)
 
 
+class TestRPCClient(unittest.TestCase):
+
+    def setUp(self):
+        from twisted.internet import task
+        from nowin_core.message_bus.rpc import RPCClient
+        self.msgbus = MockMsgBus()
+        self.clock = task.Clock()
+        self.client = RPCClient(self.msgbus, timeout=5, reactor=self.clock)
+
+    def reply(self, index, data):
+        pattern, callback, _ = self.msgbus.sub_calls[0]
+        _, msg, _ = self.msgbus.send_calls[index]
+        callback(msg['reply_dest'], data)
+
+    def test_call(self):
+        results = []
+        for i in range(3):
+            d = self.client.call('add', dict(value=i))
+            d.addCallback(results.append)
+        # only one subscription for all calls
+        self.assertEqual(len(self.msgbus.sub_calls), 1)
+        pattern, _, sub_d = self.msgbus.sub_calls[0]
+        self.assertEqual(pattern, self.client.reply_pattern)
+        self.assertEqual(self.msgbus.send_calls, [])
+        sub_d.callback('subid')
+        self.assertEqual(len(self.msgbus.send_calls), 3)
+
+        # replies out of order
+        self.reply(2, 'r2')
+        self.reply(0, 'r0')
+        self.reply(1, 'r1')
+        self.assertEqual(results, ['r2', 'r0', 'r1'])
+        # calls after subscribed are sent immediately
+        self.client.call('add', dict(value=4)).addCallback(results.append)
+        self.assertEqual(len(self.msgbus.sub_calls), 1)
+        self.reply(3, 'r4')
+        self.assertEqual(results[-1], 'r4')
+        # reply_dest is not added to data of caller
+        data = dict(value=5)
+        self.client.call('add', data)
+        self.assertEqual(data, dict(value=5))
+
+        self.reply(0, 'duplicate')
+        self.assertEqual(self.client.getStats(), dict(
+            calls=5, pending=1, replied=4, timeout=0, late=1))
+        call, = self.client._pending.values()
+        self.assertEqual(call.timeout_call.getTime(), 5)
+
+    def test_timeout(self):
+        from nowin_core.message_bus.rpc import TimeoutError
+        errors = []
+        d1 = self.client.call('add', dict(value=1))
+        d1.addErrback(errors.append)
+        self.clock.advance(1)
+        results = []
+        d2 = self.client.call('add', dict(value=2), timeout=10)
+        d2.addCallback(results.append)
+        self.msgbus.sub_calls[0][2].callback('subid')
+        self.clock.advance(4)
+        self.assertEqual(len(errors), 1)
+        self.assert_(errors[0].check(TimeoutError))
+        self.reply(1, 'r2')
+        self.assertEqual(results, ['r2'])
+        self.reply(0, 'late')
+        self.assertEqual(self.client.late_count, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        from nowin_core.message_bus.rpc import CanceledError
+        errors = []
+        d = self.client.call('add', dict(value=1))
+        d.addErrback(errors.append)
+        d.cancel()
+        self.assert_(errors[0].check(CanceledError))
+        self.msgbus.sub_calls[0][2].callback('subid')
+        # canceled call is not sent
+        self.assertEqual(self.msgbus.send_calls, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_subscribe_failed(self):
+        errors = []
+        for i in range(2):
+            self.client.call('add', dict(value=i)).addErrback(errors.append)
+        self.msgbus.sub_calls[0][2].errback(Exception('Boom'))
+        self.assertEqual(len(errors), 2)
+        # subscribe again for next call
+        self.client.call('add', dict(value=3))
+        self.assertEqual(len(self.msgbus.sub_calls), 2)
+
+    def test_close(self):
+        errors = []
+        self.client.call('add', dict(value=1)).addErrback(errors.append)
+        self.msgbus.sub_calls[0][2].callback('subid')
+        self.client.close()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.msgbus.unsub_calls[0][0], 'subid')
+
+    def test_scatter(self):
+        results = []
+        progress = []
+        d = self.client.scatter(['p1', 'p2', 'p3'], dict(cmd='stats'),
+                                progress=lambda *args: progress.append(args))
+        d.addCallback(results.append)
+        self.assertEqual(len(self.msgbus.sub_calls), 1)
+        self.msgbus.sub_calls[0][2].callback('subid')
+        sent = dict((dest, msg) for dest, msg, _ in self.msgbus.send_calls)
+        self.assertEqual(sorted(sent), ['p1', 'p2', 'p3'])
+        callback = self.msgbus.sub_calls[0][1]
+        callback(sent['p2']['reply_dest'], 2)
+        callback(sent['p2']['reply_dest'], 'duplicate')
+        callback(sent['p1']['reply_dest'], 1)
+        self.assertEqual(progress, [('p2', 2), ('p1', 1)])
+        self.assertEqual(results, [])
+
+        self.clock.advance(5)
+        result, = results
+        self.assertEqual(result.replies, dict(p1=1, p2=2))
+        self.assertEqual(result.stragglers, ['p3'])
+        self.assertEqual(self.client.getStats()['pending'], 0)
+        callback(sent['p3']['reply_dest'], 3)
+        self.assertEqual(self.client.late_count, 2)
+
+    def test_scatter_all_replied(self):
+        results = []
+        self.client.scatter(['p1', 'p2'], dict(cmd='stats')) \
+            .addCallback(results.append)
+        self.msgbus.sub_calls[0][2].callback('subid')
+        callback = self.msgbus.sub_calls[0][1]
+        for _, msg, _ in self.msgbus.send_calls:
+            callback(msg['reply_dest'], 'ok')
+        # finished before the deadline
+        result, = results
+        self.assertEqual(result.replies, dict(p1='ok', p2='ok'))
+        self.assertEqual(result.stragglers, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_scatter_topic(self):
+        results = []
+        d = self.client.scatter('proxy.stats', dict(cmd='stats'),
+                                expected=['p1', 'p2', 'p3'],
+                                key=lambda data: data['name'])
+        d.addCallback(results.append)
+        self.msgbus.sub_calls[0][2].callback('subid')
+        (dest, msg, _), = self.msgbus.send_calls
+        self.assertEqual(dest, 'proxy.stats')
+        callback = self.msgbus.sub_calls[0][1]
+        for name in ['p1', 'p3', 'x']:
+            callback(msg['reply_dest'], dict(name=name))
+        self.clock.advance(5)
+        result, = results
+        self.assertEqual(sorted(result.replies), ['p1', 'p3', 'x'])
+        self.assertEqual(result.stragglers, ['p2'])
+
+    def test_scatter_send_failed(self):
+        results = []
+        self.client.scatter(['p1', 'p2'], dict(cmd='stats')) \
+            .addCallback(results.append)
+        self.msgbus.sub_calls[0][2].errback(Exception('Boom'))
+        result, = results
+        self.assertEqual(result.replies, {})
+        self.assertEqual(result.stragglers, ['p1', 'p2'])
+
+    def test_scatter_cancel(self):
+        from nowin_core.message_bus.rpc import CanceledError
+        errors = []
+        d = self.client.scatter(['p1', 'p2'], dict(cmd='stats'))
+        d.addErrback(errors.append)
+        d.cancel()
+        self.assert_(errors[0].check(CanceledError))
+        self.assertEqual(self.client.getStats()['pending'], 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_telemetry(self):
+        from nowin_core.message_bus.telemetry import Telemetry
+        self.client.telemetry = Telemetry(clock=self.clock.seconds)
+        self.client.call('add', dict(value=1))
+        self.msgbus.sub_calls[0][2].callback('subid')
+        self.clock.advance(0.5)
+        self.reply(0, 'r1')
+        stats = self.client.telemetry.getStats()['round_trip']
+        self.assertEqual(stats['add']['count'], 1)
+        self.assertEqual(stats['add']['max'], 0.5)
+
+    def test_router_reconnect(self):
+        from nowin_core.message_bus.local import LocalBroker
+        from nowin_core.message_bus.local import LocalMessageBus
+        from nowin_core.message_bus.router import Router
+        from nowin_core.message_bus.rpc import RPCClient
+        broker = LocalBroker()
+        server = LocalMessageBus(broker=broker, reactor=self.clock)
+        server.connect()
+        server.subscribe('add', lambda dest, data: server.send(
+            data['reply_dest'], data['value'] + 1))
+        bus = LocalMessageBus(broker=broker, reactor=self.clock)
+        bus.connect()
+        client = RPCClient(Router(bus), reactor=self.clock)
+
+        results = []
+        client.call('add', dict(value=1)).addCallback(results.append)
+        for _ in xrange(5):
+            self.clock.advance(0)
+        self.assertEqual(results, [2])
+
+        # the reply subscription comes back with the router
+        bus.close()
+        bus.conn_lost_event()
+        bus.connect()
+        client.call('add', dict(value=2)).addCallback(results.append)
+        for _ in xrange(5):
+            self.clock.advance(0)
+        self.assertEqual(results, [2, 3])
+
+
+class TestHealthSupervisor(unittest.TestCase):
+
+    def test_round_trip(self):
+        from twisted.internet import task
+        from nowin_core.message_bus.supervisors import HealthSupervisor
+        from nowin_core.message_bus.telemetry import Telemetry
+        from nowin_core.patterns import observer
+        msgbus = MockMsgBus()
+        msgbus.auth_event = observer.Subject()
+        clock = task.Clock()
+        telemetry = Telemetry()
+        supervisor = HealthSupervisor(msgbus, telemetry=telemetry,
+                                      reactor=clock)
+        msgbus.auth_event()
+        (dest, _, _), = msgbus.sub_calls
+        self.assertEqual([call[:2] for call in msgbus.send_calls],
+                         [(dest, 'ping')])
+        clock.advance(0.3)
+        supervisor.handleReply(dest, 'ping')
+        self.assertEqual(supervisor.last_round_trip, 0.3)
+        stats = telemetry.getStats()['round_trip']['ping']
+        self.assertEqual(stats['count'], 1)
+
+
+class MockRPCClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def call(self, dest, data):
+        from twisted.internet import defer
+        d = defer.Deferred()
+        self.calls.append((dest, data, d))
+        return d
+
+
+class TestRPCCache(unittest.TestCase):
+
+    def setUp(self):
+        from twisted.internet import task
+        from nowin_core.message_bus.rpc import RPCCache
+        self.client = MockRPCClient()
+        self.clock = task.Clock()
+        self.cache = RPCCache(self.client, ttl=10, max_size=2,
+                              reactor=self.clock)
+
+    def test_collapse(self):
+        results = []
+        for i in range(3):
+            self.cache.call('where', dict(radio='r1', n=1)) \
+                .addCallback(results.append)
+        # same payload with different key order
+        self.cache.call('where', dict(n=1, radio='r1')) \
+            .addCallback(results.append)
+        self.assertEqual(len(self.client.calls), 1)
+        self.client.calls[0][2].callback('b1')
+        self.assertEqual(results, ['b1'] * 4)
+
+        # served from cache
+        self.cache.call('where', dict(radio='r1', n=1)) \
+            .addCallback(results.append)
+        self.assertEqual(len(self.client.calls), 1)
+        self.assertEqual(results[-1], 'b1')
+        stats = self.cache.getStats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['collapsed'], 3)
+        self.assertEqual(stats['hit_rate'], 0.2)
+
+        # expired
+        self.clock.advance(10)
+        self.cache.call('where', dict(radio='r1', n=1))
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_error(self):
+        errors = []
+        for i in range(2):
+            self.cache.call('where', dict(radio='r1')) \
+                .addErrback(errors.append)
+        self.client.calls[0][2].errback(Exception('Boom'))
+        self.assertEqual(len(errors), 2)
+        # errors are not cached
+        self.cache.call('where', dict(radio='r1'))
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_lru(self):
+        for radio in ['r1', 'r2']:
+            self.cache.call('where', dict(radio=radio))
+            self.client.calls[-1][2].callback(radio)
+        # use r1, so r2 is the least recently used
+        self.cache.call('where', dict(radio='r1'))
+        self.cache.call('where', dict(radio='r3'))
+        self.client.calls[-1][2].callback('r3')
+        self.assertEqual(self.cache.getStats()['size'], 2)
+        self.cache.call('where', dict(radio='r1'))
+        self.assertEqual(len(self.client.calls), 3)
+        self.cache.call('where', dict(radio='r2'))
+        self.assertEqual(len(self.client.calls), 4)
+
+    def test_invalidate(self):
+        self.cache.call('where', dict(radio='r1'))
+        self.client.calls[-1][2].callback('b1')
+        self.cache.call('count', dict(radio='r1'))
+        self.cache.invalidate('where', dict(radio='r1'))
+        # result of call in flight is not cached after invalidation
+        self.client.calls[-1][2].callback(10)
+        self.assertEqual(self.cache.getStats()['size'], 0)
+
+        self.cache.call('where', dict(radio='r1'))
+        self.client.calls[-1][2].callback('b1')
+        self.cache.invalidate('where')
+        self.assertEqual(self.cache.getStats()['size'], 0)
+
+    def test_remote_call(self):
+        from nowin_core.message_bus.rpc import RPCCache
+        msgbus = MockMsgBus()
+        cache = RPCCache(msgbus, reactor=self.clock)
+        data = dict(radio='r1')
+        results = []
+        cache.call('where', data).addCallback(results.append)
+        cache.call('where', data).addCallback(results.append)
+        self.assertEqual(len(msgbus.sub_calls), 1)
+        reply_dest, callback, d = msgbus.sub_calls[0]
+        d.callback('subid')
+        callback(reply_dest, 'b1')
+        self.assertEqual(results, ['b1', 'b1'])
+        self.assertEqual(data, dict(radio='r1'))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestRemoteCall))
+    suite.addTest(unittest.makeSuite(TestRPCClient))
+    suite.addTest(unittest.makeSuite(TestHealthSupervisor))
+    suite.addTest(unittest.makeSuite(TestRPCCache))
     return suite
 
 if __name__ == '__main__':
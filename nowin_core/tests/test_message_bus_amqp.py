@@ -0,0 +1,378 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet import task
+from txamqp.queue import TimeoutDeferredQueue
+
+
+class MockResult(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MockMessage(object):
+
+    def __init__(self, routing_key, content, delivery_tag):
+        self.routing_key = routing_key
+        self.content = content
+        self.delivery_tag = delivery_tag
+
+
+class MockChannel(object):
+
+    def __init__(self, conn, id):
+        self.conn = conn
+        self.id = id
+        self.calls = []
+        self.published = []
+        self.acked = []
+        self.rejected = []
+
+    def channel_open(self):
+        self.calls.append('channel_open')
+        return defer.succeed(None)
+
+    def basic_qos(self, prefetch_count):
+        self.calls.append(('basic_qos', prefetch_count))
+        return defer.succeed(None)
+
+    def exchange_declare(self, exchange, type):
+        self.calls.append(('exchange_declare', exchange, type))
+        return defer.succeed(None)
+
+    def basic_publish(self, exchange, routing_key, content):
+        self.published.append((routing_key, content))
+        return defer.succeed(None)
+
+    def queue_declare(self, exclusive, durable):
+        self.conn.next_queue += 1
+        return defer.succeed(MockResult(queue='q%d' % self.conn.next_queue))
+
+    def queue_bind(self, exchange, queue, routing_key):
+        self.calls.append(('queue_bind', queue, routing_key))
+        return defer.succeed(None)
+
+    def basic_consume(self, queue, no_ack):
+        self.calls.append(('basic_consume', queue, no_ack))
+        return defer.succeed(MockResult(consumer_tag='tag-' + queue))
+
+    def basic_cancel(self, tag):
+        self.calls.append(('basic_cancel', tag))
+        return defer.succeed(None)
+
+    def queue_delete(self, queue):
+        self.calls.append(('queue_delete', queue))
+        return defer.succeed(None)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append((delivery_tag, requeue))
+
+
+class MockConnection(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.channels = {}
+        self.queues = {}
+        self.next_queue = 0
+        self.closed = False
+        self.batching = False
+        self.batch_count = 0
+
+    def authenticate(self, user, password):
+        return defer.succeed(None)
+
+    def channel(self, id):
+        channel = self.channels[id] = MockChannel(self, id)
+        return defer.succeed(channel)
+
+    def queue(self, tag):
+        if tag not in self.queues:
+            self.queues[tag] = TimeoutDeferredQueue(clock=self.clock)
+        return defer.succeed(self.queues[tag])
+
+    def close(self, reason):
+        self.closed = True
+        return defer.succeed(None)
+
+    def beginBatch(self):
+        self.batching = True
+
+    def endBatch(self):
+        self.batching = False
+        self.batch_count += 1
+
+
+class TestAMQPMessageBus(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.conn = MockConnection(self.clock)
+        self.connected = []
+        self.down_hosts = set()
+
+    def make(self, hosts=None, **kwargs):
+        from nowin_core.message_bus.amqp import AMQPMessageBus
+        bus = AMQPMessageBus(hosts or [('host1', 5672)],
+                             reactor=self.clock, **kwargs)
+
+        def connect(host):
+            self.connected.append(host)
+            if host in self.down_hosts:
+                return defer.fail(IOError('connection refused'))
+            return defer.succeed(self.conn)
+        bus._connect = connect
+        self.login_errors = []
+        bus.login('user', 'password').addErrback(self.login_errors.append)
+        return bus
+
+    def deliver(self, tag, dest, data, delivery_tag, headers=None):
+        from txamqp.content import Content
+        properties = {'content type': 'application/json'}
+        if headers is not None:
+            properties['headers'] = headers
+        content = Content(data, properties=properties)
+        self.conn.queues[tag].put(MockMessage(dest, content, delivery_tag))
+
+    def test_failover(self):
+        hosts = [('host1', 5672), ('host2', 5672), ('host3', 5672)]
+        self.down_hosts = set(hosts[:2])
+        bus = self.make(hosts)
+        self.assertEqual(bus.host, hosts[2])
+        # down hosts are tried at most once
+        self.assertEqual(self.connected[-1], hosts[2])
+        self.assertEqual(len(set(self.connected)), len(self.connected))
+        # connections start from a random host
+        self.connected = []
+        self.down_hosts = set(hosts)
+        starts = set()
+        for _ in xrange(50):
+            self.make(hosts)
+            starts.add(self.connected[-3])
+        self.assertEqual(len(starts), 3)
+
+    def test_failover_all_down(self):
+        from nowin_core.message_bus.amqp import AMQPMessageBus
+        bus = AMQPMessageBus([('host1', 5672)], reactor=self.clock)
+        bus._connect = lambda host: defer.fail(IOError('connection refused'))
+        errors = []
+        bus.login('user', 'password').addErrback(errors.append)
+        self.assertEqual(len(errors), 1)
+        errors[0].trap(IOError)
+
+    def test_channels(self):
+        bus = self.make(publish_channels=2, consume_channels=3, prefetch=10,
+                        ack_mode='after')
+        self.assertEqual(sorted(self.conn.channels), [1, 2, 3, 4, 5])
+        for id in [1, 2]:
+            self.assertEqual(self.conn.channels[id].calls[0], 'channel_open')
+            self.assertEqual(len(self.conn.channels[id].calls), 1 + (id == 1))
+        for id in [3, 4, 5]:
+            self.assertEqual(self.conn.channels[id].calls,
+                             ['channel_open', ('basic_qos', 10)])
+        self.assertTrue(bus.channel is self.conn.channels[1])
+        self.assertEqual(self.conn.channels[1].calls[-1],
+                         ('exchange_declare', 'message_bus', 'topic'))
+
+        # publish channels are used in turn
+        bus.send('a', 'data1')
+        bus.send('b', 'data2')
+        bus.send('c', 'data3')
+        self.assertEqual([dest for dest, _ in self.conn.channels[1].published],
+                         ['a', 'c'])
+        self.assertEqual([dest for dest, _ in self.conn.channels[2].published],
+                         ['b'])
+        _, content = self.conn.channels[1].published[0]
+        self.assertEqual(content.properties['content type'],
+                         'application/json')
+
+        # subscriptions are assigned to consume channels in turn
+        for dest in ['x', 'y', 'z', 'w']:
+            bus.subscribe(dest, lambda dest, data: None)
+        self.assertEqual(bus.queues['tag-q1'][1], self.conn.channels[3])
+        self.assertEqual(bus.queues['tag-q2'][1], self.conn.channels[4])
+        self.assertEqual(bus.queues['tag-q3'][1], self.conn.channels[5])
+        self.assertEqual(bus.queues['tag-q4'][1], self.conn.channels[3])
+        self.assertEqual(self.conn.channels[3].calls[-1],
+                         ('basic_consume', 'q4', False))
+
+    def test_relogin(self):
+        bus = self.make(publish_channels=2)
+        bus.login('user', 'password')
+        self.assertEqual(len(bus._publishers), 2)
+        self.assertEqual(len(bus._consumers), 1)
+
+    def test_batch(self):
+        bus = self.make(publish_channels=2, batch_size=3)
+        channel1 = self.conn.channels[1]
+        results = []
+        bus.send('a', 1).addCallback(results.append)
+        bus.send('b', 2).addCallback(results.append)
+        self.assertEqual(channel1.published, [])
+        self.clock.advance(0)
+        self.assertEqual([dest for dest, _ in channel1.published], ['a', 'b'])
+        self.assertEqual(results, [None, None])
+
+        # a full batch is published immediately on the next channel
+        channel2 = self.conn.channels[2]
+        for dest in ['c', 'd', 'e', 'f']:
+            bus.send(dest, 0)
+        self.assertEqual([dest for dest, _ in channel2.published],
+                         ['c', 'd', 'e'])
+        bus.close()
+        self.assertEqual([dest for dest, _ in channel1.published],
+                         ['a', 'b', 'f'])
+        self.assertTrue(self.conn.closed)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # every batch is written together
+        self.assertEqual(self.conn.batch_count, 3)
+        self.assertFalse(self.conn.batching)
+
+    def test_ack_none(self):
+        bus = self.make()
+        received = []
+        bus.subscribe('a.b', lambda dest, data: received.append((dest, data)))
+        self.assertEqual(self.conn.channels[2].calls[-1],
+                         ('basic_consume', 'q1', True))
+        self.deliver('tag-q1', 'a.b', '"data"', 1)
+        self.assertEqual(received, [('a.b', 'data')])
+        self.assertEqual(self.conn.channels[2].acked, [])
+
+    def test_lazy(self):
+        bus = self.make()
+        received = []
+        bus.subscribe('a.b', lambda dest, data: received.append(data),
+                      lazy=True)
+        self.deliver('tag-q1', 'a.b', 'not json', 1)
+        payload, = received
+        self.assertFalse(payload.decoded)
+        self.assertEqual(payload.content_type, 'application/json')
+
+    def test_ack_after(self):
+        bus = self.make(ack_mode='after')
+        channel = self.conn.channels[2]
+        pending = []
+
+        def callback(dest, data):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        bus.subscribe('a.b', callback)
+        self.deliver('tag-q1', 'a.b', '"data1"', 1)
+        self.deliver('tag-q1', 'a.b', '"data2"', 2)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(channel.acked, [])
+        pending[1].callback(None)
+        self.assertEqual(channel.acked, [2])
+        # failed messages are rejected without requeuing, so they are not
+        # redelivered forever
+        pending[0].errback(ValueError('boom'))
+        self.assertEqual(channel.acked, [2])
+        self.assertEqual(channel.rejected, [(1, False)])
+
+    def test_malformed(self):
+        for ack_mode in ['none', 'after']:
+            self.conn = MockConnection(self.clock)
+            bus = self.make(ack_mode=ack_mode)
+            channel = self.conn.channels[2]
+            received = []
+            bus.subscribe('a.b', lambda dest, data: received.append(data))
+            self.deliver('tag-q1', 'a.b', 'not json', 1)
+            # polling goes on
+            self.deliver('tag-q1', 'a.b', '"data"', 2)
+            self.assertEqual(received, ['data'])
+            if ack_mode == 'after':
+                self.assertEqual(channel.rejected, [(1, False)])
+                self.assertEqual(channel.acked, [2])
+
+    def test_telemetry(self):
+        from nowin_core.message_bus.telemetry import Telemetry
+        telemetry = Telemetry(clock=self.clock.seconds)
+        bus = self.make(telemetry=telemetry)
+        self.clock.advance(10)
+        bus.send('a.b', 'data')
+        (_, content), = self.conn.channels[1].published
+        self.assertEqual(content.properties['headers'],
+                         {'sent-at': '10.000000'})
+
+        bus.subscribe('a.b', lambda dest, data: self.clock.advance(0.5))
+        self.clock.advance(0.25)
+        self.deliver('tag-q1', 'a.b', '"data"', 1, {'sent-at': '10.0'})
+        # messages from senders without telemetry
+        self.deliver('tag-q1', 'a.b', '"data"', 2)
+        stats = telemetry.getStats()
+        self.assertEqual(stats['delivery']['a.b']['count'], 1)
+        self.assertEqual(stats['delivery']['a.b']['max'], 0.25)
+        self.assertEqual(stats['callback']['a.b']['count'], 2)
+        self.assertEqual(stats['callback']['a.b']['max'], 0.5)
+
+    def test_unsubscribe(self):
+        bus = self.make(ack_mode='after')
+        received = []
+        ids = []
+        d = bus.subscribe('a.b',
+                          lambda dest, data: received.append((dest, data)))
+        d.addCallback(ids.append)
+        bus.unsubscribe(ids[0])
+        channel = self.conn.channels[2]
+        self.assertEqual(channel.calls[-2:], [('basic_cancel', 'tag-q1'),
+                                              ('queue_delete', 'q1')])
+        self.assertEqual(bus.queues, {})
+        self.deliver('tag-q1', 'a.b', '"data"', 1)
+        self.assertEqual(received, [])
+
+
+class TestAMQPClient(unittest.TestCase):
+
+    def test_batch(self):
+        import os
+        import txamqp.spec
+        from twisted.test import proto_helpers
+        from txamqp.client import TwistedDelegate
+        from txamqp.content import Content
+        from nowin_core.message_bus import amqp
+        from nowin_core.message_bus.amqp import AMQPClient
+        path = os.path.join(os.path.dirname(amqp.__file__), 'specs',
+                            'standard', 'amqp0-8.xml')
+        client = AMQPClient(delegate=TwistedDelegate(), vhost='/',
+                            spec=txamqp.spec.load(path))
+        transport = proto_helpers.StringTransport()
+        client.makeConnection(transport)
+        channels = []
+        client.channel(1).addCallback(channels.append)
+        channel, = channels
+
+        def publish(count):
+            for i in xrange(count):
+                channel.basic_publish(exchange='x', routing_key='a',
+                                      content=Content('%d' % i))
+
+        writes = client.write_count
+        transport.clear()
+        publish(2)
+        # method, header and body frames are written one by one
+        self.assertEqual(client.write_count - writes, 6)
+        unbatched = transport.value()
+
+        writes = client.write_count
+        transport.clear()
+        client.beginBatch()
+        publish(2)
+        self.assertEqual(transport.value(), '')
+        client.endBatch()
+        self.assertEqual(client.write_count - writes, 1)
+        self.assertEqual(transport.value(), unbatched)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAMQPMessageBus))
+    suite.addTest(unittest.makeSuite(TestAMQPClient))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
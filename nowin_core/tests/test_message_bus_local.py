@@ -0,0 +1,122 @@
+import unittest
+
+from twisted.internet import task
+
+
+class TestLocalMessageBus(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.message_bus.local import LocalBroker
+        self.clock = task.Clock()
+        self.broker = LocalBroker()
+        self.received = []
+
+    def make(self, **kwargs):
+        from nowin_core.message_bus.local import LocalMessageBus
+        bus = LocalMessageBus(broker=self.broker, reactor=self.clock,
+                              **kwargs)
+        bus.connect()
+        return bus
+
+    def callback(self, name):
+        def callback(dest, data):
+            self.received.append((name, dest, data))
+        return callback
+
+    def test_factory(self):
+        from nowin_core.message_bus.factory import create_message_bus
+        from nowin_core.message_bus.local import LocalMessageBus
+        bus = create_message_bus('local', ('localhost', 61613), 'user')
+        self.assert_(isinstance(bus, LocalMessageBus))
+
+    def test_send(self):
+        auths = []
+        from nowin_core.message_bus.local import LocalMessageBus
+        bus1 = LocalMessageBus(broker=self.broker, reactor=self.clock)
+        bus1.auth_event.subscribe(lambda: auths.append(1))
+        bus1.connect()
+        self.assertEqual(auths, [1])
+        bus2 = self.make()
+
+        bus1.subscribe('a.b', self.callback(1))
+        bus2.subscribe('a.*', self.callback(2))
+        bus2.subscribe('#', self.callback(3))
+        bus2.subscribe('a.c', self.callback(4))
+        data = dict(value=1)
+        bus1.send('a.b', data)
+        # delivered in next reactor iteration
+        self.assertEqual(self.received, [])
+        self.clock.advance(0)
+        self.assertEqual(self.received, [
+            (1, 'a.b', data),
+            (2, 'a.b', data),
+            (3, 'a.b', data),
+        ])
+        # not serialized or copied
+        self.assert_(self.received[0][2] is data)
+        self.assertEqual(bus1.getStats(), dict(sent=1, delivered=1,
+                                               subscriptions=1))
+        self.assertEqual(bus2.getStats(), dict(sent=0, delivered=2,
+                                               subscriptions=3))
+
+    def test_copy_on_send(self):
+        bus = self.make(copy_on_send=True)
+        bus.subscribe('a', self.callback(1))
+        data = dict(values=[1])
+        bus.send('a', data)
+        data['values'].append(2)
+        self.clock.advance(0)
+        self.assertEqual(self.received, [(1, 'a', dict(values=[1]))])
+
+    def test_unsubscribe(self):
+        bus = self.make()
+        ids = []
+        bus.subscribe('a', self.callback(1)).addCallback(ids.append)
+        bus.subscribe('a', self.callback(2)).addCallback(ids.append)
+        bus.send('a', 'data1')
+        # unsubscribed before the message is delivered
+        bus.unsubscribe(ids[0])
+        self.clock.advance(0)
+        self.assertEqual(self.received, [(2, 'a', 'data1')])
+
+        bus.close()
+        self.assertEqual(len(self.broker), 0)
+        self.assertTrue(bus.closed)
+        bus.send('a', 'data2')
+        self.clock.advance(0)
+        self.assertEqual(self.received, [(2, 'a', 'data1')])
+
+    def test_callback_error(self):
+        bus = self.make()
+
+        def bad_callback(dest, data):
+            raise ValueError('boom')
+        bus.subscribe('a', bad_callback)
+        bus.subscribe('a', self.callback(1))
+        bus.send('a', 'data')
+        self.clock.advance(0)
+        self.assertEqual(self.received, [(1, 'a', 'data')])
+
+    def test_rpc(self):
+        from nowin_core.message_bus.rpc import RPCClient
+        server = self.make()
+        client = RPCClient(self.make(), reactor=self.clock)
+
+        def echo(dest, data):
+            server.send(data['reply_dest'], data['value'])
+        server.subscribe('rpc.echo', echo)
+        client.start()
+        results = []
+        client.call('rpc.echo', dict(value=5)).addCallback(results.append)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(results, [5])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLocalMessageBus))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
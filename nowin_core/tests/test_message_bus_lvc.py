@@ -0,0 +1,191 @@
+import unittest
+
+from twisted.internet import task
+
+
+class TestLastValueCache(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.message_bus.local import LocalBroker
+        self.clock = task.Clock()
+        self.broker = LocalBroker()
+        self.received = []
+
+    def makeBus(self, connect=True):
+        from nowin_core.message_bus.local import LocalMessageBus
+        bus = LocalMessageBus(broker=self.broker, reactor=self.clock)
+        if connect:
+            bus.connect()
+        return bus
+
+    def make(self, bus=None, **kwargs):
+        from nowin_core.message_bus.lvc import LastValueCache
+        if bus is None:
+            bus = self.makeBus()
+        kwargs.setdefault('state_topics', ['server.*.load'])
+        return LastValueCache(bus, reactor=self.clock, **kwargs)
+
+    def callback(self, name):
+        def callback(dest, data):
+            self.received.append((name, dest, data))
+        return callback
+
+    def pump(self, times=5):
+        for _ in xrange(times):
+            self.clock.advance(0)
+
+    def test_state_topic(self):
+        lvc = self.make()
+        self.assertTrue(lvc.isStateTopic('server.1.load'))
+        self.assertTrue(lvc.isStateTopic('server.*.load'))
+        self.assertFalse(lvc.isStateTopic('server.#'))
+        self.assertFalse(lvc.isStateTopic('server.1.events'))
+
+    def test_suppress(self):
+        bus = self.makeBus()
+        bus.subscribe('#', self.callback(1))
+        lvc = self.make(bus, snapshot_dest=None)
+        lvc.send('server.1.load', dict(value=1))
+        lvc.send('server.1.load', dict(value=1))
+        lvc.send('server.2.load', dict(value=5))
+        lvc.send('server.1.load', dict(value=2))
+        lvc.send('server.1.events', 'start')
+        lvc.send('server.1.events', 'start')
+        self.pump()
+        # superseded value is dropped, values are sent in order of last
+        # change, events are never suppressed
+        self.assertEqual(self.received, [
+            (1, 'server.1.events', 'start'),
+            (1, 'server.1.events', 'start'),
+            (1, 'server.2.load', dict(value=5)),
+            (1, 'server.1.load', dict(value=2)),
+        ])
+        lvc.send('server.1.load', dict(value=2))
+        self.pump()
+        self.assertEqual(len(self.received), 4)
+        self.assertEqual(lvc.getStats(), dict(
+            sent=2, suppressed=2, superseded=1, replayed=0, snapshots=0,
+            outbox=0, cached=0))
+
+    def test_mutated_value(self):
+        lvc = self.make(snapshot_dest=None)
+        lvc.subscribe('server.1.load', self.callback(1))
+        data = dict(value=1)
+        lvc.send('server.1.load', data)
+        self.pump()
+        data = dict(data, value=2)
+        lvc.send('server.1.load', data)
+        self.pump()
+        self.assertEqual([item[2]['value'] for item in self.received], [1, 2])
+
+    def test_replay(self):
+        lvc = self.make(snapshot_dest=None)
+        lvc.subscribe('server.*.load', self.callback(1))
+        lvc.send('server.1.load', 10)
+        lvc.send('server.2.load', 20)
+        self.pump()
+        self.assertEqual(lvc.getValue('server.1.load'), 10)
+        # a late subscriber gets the latest values right away
+        lvc.subscribe('server.2.load', self.callback(2))
+        lvc.subscribe('server.*.load', self.callback(3))
+        self.assertEqual(self.received[2:], [
+            (2, 'server.2.load', 20),
+            (3, 'server.1.load', 10),
+            (3, 'server.2.load', 20),
+        ])
+        lvc.subscribe('server.1.events', self.callback(4))
+        self.assertEqual(lvc.getStats()['replayed'], 3)
+
+    def test_snapshot(self):
+        publisher = self.make()
+        publisher.send('server.1.load', 10)
+        publisher.send('server.2.load', 20)
+        publisher.send('server.3.load', 30)
+        self.pump()
+
+        subscriber = self.make()
+        subscriber.subscribe('server.*.load', self.callback(1))
+        self.pump()
+        self.assertEqual(sorted(self.received), [
+            (1, 'server.1.load', 10),
+            (1, 'server.2.load', 20),
+            (1, 'server.3.load', 30),
+        ])
+        self.assertEqual(publisher.getStats()['snapshots'], 1)
+        self.assertEqual(subscriber.getValue('server.3.load'), 30)
+
+        # live values are not replaced by older snapshots
+        publisher.send('server.1.load', 11)
+        self.pump()
+        subscriber.subscribe('server.1.load', self.callback(2))
+        self.pump()
+        self.assertEqual(subscriber.getValue('server.1.load'), 11)
+        self.assertEqual(self.received[-1], (2, 'server.1.load', 11))
+        self.clock.advance(subscriber.snapshot_timeout)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reconnect(self):
+        bus = self.makeBus(connect=False)
+        lvc = self.make(bus, snapshot_dest=None)
+        self.assertFalse(lvc.ready)
+        self.makeBus().subscribe('#', self.callback(1))
+        lvc.send('server.1.load', 1)
+        lvc.send('server.1.load', 2)
+        self.pump()
+        self.assertEqual(self.received, [])
+        self.assertEqual(lvc.getStats()['outbox'], 1)
+        bus.connect()
+        self.pump()
+        self.assertEqual(self.received, [(1, 'server.1.load', 2)])
+
+        bus.conn_lost_event()
+        lvc.send('server.1.load', 3)
+        self.pump()
+        self.assertEqual(len(self.received), 1)
+        bus.auth_event()
+        self.pump()
+        self.assertEqual(self.received[-1], (1, 'server.1.load', 3))
+
+    def test_router_reconnect(self):
+        from nowin_core.message_bus.router import Router
+        bus = self.makeBus(connect=False)
+        router = Router(bus)
+        lvc = self.make(router, snapshot_dest=None)
+        self.assertFalse(lvc.ready)
+        self.makeBus().subscribe('#', self.callback(1))
+        lvc.subscribe('server.*.load', self.callback(2))
+        lvc.send('server.1.load', 1)
+        self.pump()
+        self.assertEqual(self.received, [])
+        bus.connect()
+        self.pump()
+        self.assertEqual(sorted(self.received), [
+            (1, 'server.1.load', 1),
+            (2, 'server.1.load', 1),
+        ])
+
+        # values are held while disconnected, and subscriptions come back
+        del self.received[:]
+        bus.close()
+        bus.conn_lost_event()
+        self.assertFalse(lvc.ready)
+        lvc.send('server.1.load', 2)
+        lvc.send('server.1.load', 3)
+        self.pump()
+        self.assertEqual(self.received, [])
+        self.assertEqual(lvc.getStats()['outbox'], 1)
+        bus.connect()
+        self.pump()
+        self.assertEqual(sorted(self.received), [
+            (1, 'server.1.load', 3),
+            (2, 'server.1.load', 3),
+        ])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLastValueCache))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,134 @@
+import unittest
+
+
+class MockClient(object):
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, dest, data):
+        self.sent.append((dest, data))
+
+    def close(self):
+        self.closed = True
+
+
+class TestSpool(unittest.TestCase):
+
+    def make(self, **kwargs):
+        from nowin_core.message_bus.stomp import STOMPMessageBus
+        bus = STOMPMessageBus(('localhost', 61613), 'user', **kwargs)
+        self.client = MockClient()
+        bus.client = self.client
+        return bus
+
+    def test_no_spool(self):
+        bus = self.make()
+        bus.send('a', 1)
+        bus.handleAuth()
+        self.assertEqual(self.client.sent, [])
+        bus.send('a', 2)
+        self.assertEqual(self.client.sent, [('a', 2)])
+
+    def test_drop_oldest(self):
+        bus = self.make(spool_size=3)
+        auths = []
+        bus.auth_event.subscribe(lambda: auths.append(list(self.client.sent)))
+        for i in xrange(5):
+            bus.send('a', i)
+        bus.send('b', 5)
+        self.assertEqual(self.client.sent, [])
+        self.assertEqual(bus.getSpoolStats(), dict(spooled=3, dropped=3,
+                                                   flushed=0))
+        bus.handleAuth()
+        # spooled messages are sent before auth event
+        self.assertEqual(auths, [[('a', 3), ('a', 4), ('b', 5)]])
+        self.assertEqual(bus.getSpoolStats(), dict(spooled=0, dropped=3,
+                                                   flushed=3))
+
+        # spooled again after connection lost
+        bus.handleConnLost()
+        self.assertFalse(bus.authorized)
+        bus.send('c', 6)
+        self.assertEqual(bus.getSpoolStats()['spooled'], 1)
+
+    def test_coalesce(self):
+        bus = self.make(spool_size=2, spool_policy='coalesce')
+        bus.send('a', 1)
+        bus.send('b', 2)
+        bus.send('a', 3)
+        bus.send('b', 4)
+        self.assertEqual(bus.getSpoolStats(), dict(spooled=2, dropped=0,
+                                                   flushed=0))
+        # 'a' is updated least recently
+        bus.send('c', 5)
+        self.assertEqual(bus.spool_dropped_count, 1)
+        bus.handleAuth()
+        self.assertEqual(self.client.sent, [('b', 4), ('c', 5)])
+
+
+class MockMsgBus(object):
+
+    def __init__(self):
+        from nowin_core.patterns import observer
+        self.auth_event = observer.Subject()
+        self.conn_lost_event = observer.Subject()
+        self.conn_failed_event = observer.Subject()
+        self.connect_count = 0
+
+    def connect(self):
+        self.connect_count += 1
+
+
+class TestReconnectSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        from twisted.internet import task
+        self.clock = task.Clock()
+        self.msgbus = MockMsgBus()
+
+    def test_fixed_delay(self):
+        from nowin_core.message_bus.supervisors import ReconnectSupervisor
+        ReconnectSupervisor(self.msgbus, delay=2, reactor=self.clock)
+        self.msgbus.conn_lost_event()
+        self.clock.advance(1.9)
+        self.assertEqual(self.msgbus.connect_count, 0)
+        self.clock.advance(0.1)
+        self.assertEqual(self.msgbus.connect_count, 1)
+        self.msgbus.conn_failed_event()
+        self.clock.advance(2)
+        self.assertEqual(self.msgbus.connect_count, 2)
+
+    def test_backoff(self):
+        from nowin_core.message_bus.supervisors import ReconnectSupervisor
+        supervisor = ReconnectSupervisor(self.msgbus, delay=1, max_delay=30,
+                                         reactor=self.clock)
+        supervisor.random.seed(0)
+        delays = []
+        for attempt in xrange(8):
+            self.msgbus.conn_failed_event()
+            call, = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= min(30, 2 ** attempt))
+        # jittered
+        self.assertEqual(len(set(delays)), len(delays))
+        self.assertEqual(supervisor.attempts, 8)
+
+        self.msgbus.auth_event()
+        self.assertEqual(supervisor.attempts, 0)
+        self.msgbus.conn_lost_event()
+        call, = self.clock.getDelayedCalls()
+        self.assertTrue(call.getTime() - self.clock.seconds() <= 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSpool))
+    suite.addTest(unittest.makeSuite(TestReconnectSupervisor))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
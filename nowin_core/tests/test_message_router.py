@@ -0,0 +1,228 @@
+import unittest
+
+from twisted.internet import defer
+
+from nowin_core.patterns import observer
+
+
+class MockMsgBus(object):
+
+    def __init__(self):
+        self.send_calls = []
+        self.sub_calls = []
+        self.unsub_calls = []
+        self.auth_event = observer.Subject()
+
+    def send(self, dest, data):
+        self.send_calls.append((dest, data))
+        return defer.succeed(None)
+
+    def subscribe(self, dest, callback):
+        d = defer.Deferred()
+        self.sub_calls.append((dest, callback, d))
+        return d
+
+    def unsubscribe(self, id):
+        self.unsub_calls.append(id)
+        return defer.succeed(None)
+
+
+class LazyMsgBus(MockMsgBus):
+
+    lazy_payloads = True
+
+    def subscribe(self, dest, callback, lazy=False):
+        self.lazy = lazy
+        return MockMsgBus.subscribe(self, dest, callback)
+
+
+class TestTopicTrie(unittest.TestCase):
+
+    def test_match(self):
+        from nowin_core.message_bus.router import TopicTrie
+        trie = TopicTrie()
+        patterns = ['a.b.c', 'a.*.c', 'a.#', '#', 'a.#.c', '*.b', 'a.b']
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        self.assertEqual(len(trie), len(patterns))
+
+        def match(topic):
+            return sorted(trie.match(topic))
+
+        self.assertEqual(match('a.b.c'),
+                         sorted(['a.b.c', 'a.*.c', 'a.#', '#', 'a.#.c']))
+        self.assertEqual(match('a.b'), sorted(['a.#', '#', '*.b', 'a.b']))
+        self.assertEqual(match('a'), sorted(['a.#', '#']))
+        self.assertEqual(match('a.x.y.c'), sorted(['a.#', '#', 'a.#.c']))
+        self.assertEqual(match('b'), ['#'])
+
+    def test_remove(self):
+        from nowin_core.message_bus.router import TopicTrie
+        trie = TopicTrie()
+        trie.add('a.b', 1)
+        trie.add('a.b', 2)
+        trie.add('a.*', 3)
+        trie.remove('a.b', 1)
+        self.assertEqual(sorted(trie.match('a.b')), [2, 3])
+        trie.remove('a.b', 2)
+        trie.remove('a.*', 3)
+        self.assertEqual(trie.match('a.b'), [])
+        self.assertEqual(len(trie), 0)
+        # empty nodes are pruned
+        self.assertEqual(trie._root.children, {})
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.message_bus.router import Router
+        self.msgbus = MockMsgBus()
+        self.router = Router(self.msgbus)
+        self.received = []
+
+    def callback(self, name):
+        def callback(dest, data):
+            self.received.append((name, dest, data))
+        return callback
+
+    def confirm(self, index, id=None):
+        dest, _, d = self.msgbus.sub_calls[index]
+        d.callback(id or 'id-' + dest)
+
+    def deliver(self, index, dest, data):
+        _, callback, _ = self.msgbus.sub_calls[index]
+        callback(dest, data)
+
+    def test_fan_out(self):
+        ids = []
+        self.router.subscribe('a.b', self.callback(1)).addCallback(ids.append)
+        self.router.subscribe('a.b', self.callback(2)).addCallback(ids.append)
+        self.assertEqual(len(self.msgbus.sub_calls), 1)
+        self.assertEqual(ids, [])
+        self.confirm(0)
+        self.assertEqual(ids, [1, 2])
+
+        self.deliver(0, 'a.b', 'data')
+        self.assertEqual(self.received, [(1, 'a.b', 'data'),
+                                         (2, 'a.b', 'data')])
+        self.assertEqual(self.router.getStats(), dict(
+            broker_subscriptions=1, local_subscriptions=2,
+            delivered=2, dropped=0))
+
+        self.router.unsubscribe(ids[0])
+        self.assertEqual(self.msgbus.unsub_calls, [])
+        self.router.unsubscribe(ids[1])
+        self.assertEqual(self.msgbus.unsub_calls, ['id-a.b'])
+
+        # subscribed already confirmed
+        ids = []
+        self.router.subscribe('a.b', self.callback(3)).addCallback(ids.append)
+        self.confirm(1)
+        self.router.subscribe('a.b', self.callback(4)).addCallback(ids.append)
+        self.assertEqual(ids, [3, 4])
+
+    def test_covered(self):
+        self.router.subscribe('a.*', self.callback(1))
+        self.confirm(0)
+        self.router.subscribe('a.b', self.callback(2))
+        # covered by the wildcard
+        self.assertEqual(len(self.msgbus.sub_calls), 1)
+        self.deliver(0, 'a.b', 'data1')
+        self.deliver(0, 'a.c', 'data2')
+        self.assertEqual(self.received, [
+            (1, 'a.b', 'data1'),
+            (2, 'a.b', 'data1'),
+            (1, 'a.c', 'data2'),
+        ])
+
+    def test_merge(self):
+        self.router.subscribe('a.b', self.callback(1))
+        self.confirm(0)
+        self.router.subscribe('a.#', self.callback(2))
+        self.assertEqual(len(self.msgbus.sub_calls), 2)
+        self.confirm(1)
+        # the exact subscription is merged into wildcard one
+        self.assertEqual(self.msgbus.unsub_calls, ['id-a.b'])
+        self.assertEqual(self.router.getStats()['broker_subscriptions'], 1)
+        self.deliver(0, 'a.b', 'late')
+        self.deliver(1, 'a.b', 'data')
+        self.assertEqual(self.received, [
+            (1, 'a.b', 'data'),
+            (2, 'a.b', 'data'),
+        ])
+        self.assertEqual(self.router.dropped_count, 1)
+
+    def test_unsubscribe_before_confirmed(self):
+        d = self.router.subscribe('a.b', self.callback(1))
+        self.router.unsubscribe(1)
+        self.assertEqual(self.msgbus.unsub_calls, [])
+        self.confirm(0)
+        self.assertEqual(self.msgbus.unsub_calls, ['id-a.b'])
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(results, [1])
+
+    def test_multi_wildcard(self):
+        from nowin_core.message_bus.router import Router
+        router = Router(self.msgbus, multi_wildcard='>')
+        router.subscribe('a.#', self.callback(1))
+        self.assertEqual(self.msgbus.sub_calls[0][0], 'a.>')
+
+    def test_auth(self):
+        self.router.subscribe('a.b', self.callback(1))
+        self.router.subscribe('a.*', self.callback(2))
+        self.confirm(0)
+        self.confirm(1)
+        self.msgbus.auth_event()
+        self.assertEqual(
+            sorted(dest for dest, _, _ in self.msgbus.sub_calls[2:]),
+            ['a.*'])
+
+    def test_callback_error(self):
+        def bad_callback(dest, data):
+            raise ValueError('boom')
+
+        self.router.subscribe('a.b', bad_callback)
+        self.router.subscribe('a.b', self.callback(2))
+        self.confirm(0)
+        self.deliver(0, 'a.b', 'data')
+        self.assertEqual(self.received, [(2, 'a.b', 'data')])
+
+    def test_lazy(self):
+        from nowin_core.message_bus.codec import LazyPayload
+        from nowin_core.message_bus.router import Router
+        self.msgbus = LazyMsgBus()
+        self.router = Router(self.msgbus)
+        self.router.subscribe('a.*', self.callback(1))
+        self.confirm(0)
+        self.router.subscribe('a.b', self.callback(2))
+        self.assertTrue(self.msgbus.lazy)
+
+        payload = LazyPayload('{"value": 1}')
+        self.deliver(0, 'a.b', payload)
+        # decoded once for all callbacks
+        data1, data2 = [data for _, _, data in self.received]
+        self.assertEqual(data1, dict(value=1))
+        self.assertTrue(data1 is data2)
+
+        # a message without local subscriptions is never decoded
+        self.router.unsubscribe(1)
+        payload = LazyPayload('not json')
+        self.deliver(0, 'a.c', payload)
+        self.assertFalse(payload.decoded)
+        self.assertEqual(self.router.getStats()['dropped'], 1)
+
+        # a message fails to decode is dropped
+        self.deliver(0, 'a.b', LazyPayload('not json'))
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(self.router.getStats()['dropped'], 2)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTopicTrie))
+    suite.addTest(unittest.makeSuite(TestRouter))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
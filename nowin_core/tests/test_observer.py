@@ -61,6 +61,57 @@ class TestObserver(unittest.TestCase):
         with self.assertRaises(AssertionError):
             sid_b.unsubscribe()
 
+    def test_order(self):
+        sub = self.make_one()
+        result = []
+        for i in xrange(20):
+            sub.subscribe(lambda i=i: result.append(i))
+        sub()
+        self.assertEqual(result, range(20))
+
+    def test_change_while_notifying(self):
+        sub = self.make_one()
+        result = []
+
+        def func_a():
+            result.append('a')
+            sid_b.unsubscribe()
+            sub.subscribe(lambda: result.append('c'))
+
+        sub.subscribe(func_a)
+        sid_b = sub.subscribe(lambda: result.append('b'))
+        # changes take effect on next notification
+        sub()
+        self.assertEqual(result, ['a', 'b'])
+
+    def test_weak(self):
+        import gc
+        sub = self.make_one()
+        result = []
+
+        class Listener(object):
+
+            def handle(self, data):
+                result.append(data)
+
+        def func(data):
+            result.append(('func', data))
+
+        listener = Listener()
+        sub.subscribe(listener.handle, weak=True)
+        sub.subscribe(func, weak=True)
+        sub('data1')
+        self.assertEqual(result, ['data1', ('func', 'data1')])
+
+        # gone observers are unsubscribed
+        del result[:]
+        del listener
+        del func
+        gc.collect()
+        self.assertEqual(sub.observers, {})
+        sub('data2')
+        self.assertEqual(result, [])
+
 
 def suite():
     suite = unittest.TestSuite()
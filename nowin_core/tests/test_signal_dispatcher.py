@@ -0,0 +1,142 @@
+import unittest
+
+import transaction
+
+
+class FakeReactor(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, func, *args):
+        self.calls.append(('thread', func, args))
+
+    def callInThread(self, func, *args):
+        self.calls.append(('pool', func, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for _, func, args in calls:
+            func(*args)
+
+
+class FailingResource(object):
+
+    def __init__(self, manager):
+        self.transaction_manager = manager
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        raise ValueError('boom')
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'failing'
+
+
+class TestAfterCommitDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.signals.dispatcher import Signal
+        self.manager = transaction.TransactionManager()
+        self.signal = Signal()
+        self.other = Signal()
+        self.fired = []
+        self.signal.subscribe(lambda *args: self.fired.append(args))
+        self.other.subscribe(
+            lambda *args: self.fired.append(('other', ) + args))
+
+    def make(self, **kwargs):
+        from nowin_core.signals.dispatcher import AfterCommitDispatcher
+        dispatcher = AfterCommitDispatcher(transaction_manager=self.manager,
+                                           **kwargs)
+        self.signal.dispatcher = dispatcher
+        self.other.dispatcher = dispatcher
+        return dispatcher
+
+    def test_right_away(self):
+        self.signal(1)
+        self.assertEqual(self.fired, [(1, )])
+
+    def test_after_commit(self):
+        dispatcher = self.make()
+        with self.manager:
+            self.signal(1)
+            self.other(2)
+            self.signal(3)
+            self.assertEqual(self.fired, [])
+        self.assertEqual(self.fired, [(1, ), ('other', 2), (3, )])
+        self.assertEqual(dispatcher.getStats(), dict(
+            recorded=3, delivered=3, dropped=0, batches=1, errors=0))
+
+    def test_abort(self):
+        self.make()
+        self.manager.begin()
+        self.signal(1)
+        self.manager.abort()
+        with self.manager:
+            self.signal(2)
+        self.assertEqual(self.fired, [(2, )])
+
+    def test_failed_commit(self):
+        dispatcher = self.make()
+
+        txn = self.manager.begin()
+        self.signal(1)
+        txn.join(FailingResource(self.manager))
+        self.assertRaises(ValueError, self.manager.commit)
+        self.manager.abort()
+        self.assertEqual(self.fired, [])
+        self.assertEqual(dispatcher.getStats()['dropped'], 1)
+
+    def test_reactor(self):
+        reactor = FakeReactor()
+        self.make(reactor=reactor)
+        with self.manager:
+            self.signal(1)
+            self.signal(2)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(reactor.calls), 1)
+        reactor.run()
+        self.assertEqual(self.fired, [(1, ), (2, )])
+
+    def test_in_thread(self):
+        reactor = FakeReactor()
+        self.make(reactor=reactor, in_thread=True)
+        with self.manager:
+            self.signal(1)
+        reactor.run()
+        self.assertEqual(self.fired, [])
+        self.assertEqual(reactor.calls[0][0], 'pool')
+        reactor.run()
+        self.assertEqual(self.fired, [(1, )])
+
+    def test_error(self):
+        dispatcher = self.make()
+
+        def bad(value):
+            raise ValueError('boom')
+
+        self.signal.subscribe(bad)
+        with self.manager:
+            self.signal(1)
+            self.other(2)
+        # errors don't stop the rest of events
+        self.assertEqual(self.fired, [(1, ), ('other', 2)])
+        self.assertEqual(dispatcher.getStats()['errors'], 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAfterCommitDispatcher))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -37,6 +37,93 @@ class TestFrame(unittest.TestCase):
         resultBody = p.newline.join(lines[i + 1:])
         self.assertEqual(resultBody, body + '\0')
 
+    def test_escape(self):
+        headers = {'destination': 'a:b\\c\nd\re'}
+        p = protocol.Frame('MESSAGE', dict(headers))
+        self.assertEqual(p.pack('1.0').split(p.newline)[1],
+                         'destination:a:b\\c')
+        self.assertEqual(p.pack('1.1').split(p.newline)[1],
+                         'destination:a\\cb\\\\c\\nd\re')
+        self.assertEqual(p.pack('1.2').split(p.newline)[1],
+                         'destination:a\\cb\\\\c\\nd\\re')
+        parser = protocol.Parser()
+        parser.unescapeHeaders = True
+        parser.feed(p.pack('1.2'))
+        self.assertEqual(parser.getFrame().headers, headers)
+        # CONNECT and CONNECTED frames are never escaped
+        p = protocol.Frame('CONNECTED', dict(session='a:b'))
+        self.assertEqual(p.pack('1.2').split(p.newline)[1], 'session:a:b')
+
+
+class TestEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = protocol.Encoder(cache_size=2)
+
+    def parse(self, data):
+        parser = protocol.Parser()
+        parser.feed(data)
+        frame, = parser.getFrames()
+        return frame
+
+    def test_encode(self):
+        body = 'body\0with null'
+        data = self.encoder.encode('SEND', 'abc', body,
+                                   headers=dict(type='stats'),
+                                   extra_headers=dict(receipt='1234'))
+        frame = self.parse(data)
+        self.assertEqual(frame.command, 'SEND')
+        self.assertEqual(frame.headers, {
+            'destination': 'abc',
+            'type': 'stats',
+            'receipt': '1234',
+            'content-length': str(len(body)),
+        })
+        self.assertEqual(frame.body, body)
+
+        seq = self.encoder.encodeSequence('SEND', 'abc', body,
+                                          headers=dict(type='stats'))
+        self.assertEqual(self.parse(''.join(seq)).body, body)
+
+    def test_unicode(self):
+        data = self.encoder.encode('SEND', u'\u6e2c\u8a66', u'\u6e2c')
+        self.assert_(isinstance(data, str))
+        frame = self.parse(data)
+        self.assertEqual(frame.headers['destination'],
+                         u'\u6e2c\u8a66'.encode('utf8'))
+        self.assertEqual(frame.body, u'\u6e2c'.encode('utf8'))
+
+    def test_cache(self):
+        prefix = self.encoder.getPrefix('SEND', 'abc')
+        self.assert_(self.encoder.getPrefix('SEND', 'abc') is prefix)
+        self.assertEqual(prefix, 'SEND\ndestination:abc\n')
+        self.encoder.getPrefix('SEND', 'def', dict(a=1))
+        self.assertEqual(len(self.encoder._prefixes), 2)
+        # cache is cleared when it's full
+        self.encoder.getPrefix('SEND', 'ghi')
+        self.assertEqual(len(self.encoder._prefixes), 1)
+
+    def test_escape(self):
+        parser = protocol.Parser()
+        parser.unescapeHeaders = True
+        data = self.encoder.encode('MESSAGE', 'a:b', 'body',
+                                   headers={'type': 'x\ny'},
+                                   extra_headers={'id': 'c\\d'},
+                                   version='1.2')
+        parser.feed(data)
+        frame, = parser.getFrames()
+        self.assertEqual(frame.headers, {
+            'destination': 'a:b',
+            'type': 'x\ny',
+            'id': 'c\\d',
+            'content-length': '4',
+        })
+        # prefixes are cached by version
+        self.assertEqual(self.encoder.getPrefix('SEND', 'a:b'),
+                         'SEND\ndestination:a:b\n')
+        self.assertEqual(self.encoder.getPrefix('SEND', 'a:b', version='1.1'),
+                         'SEND\ndestination:a\\cb\n')
+
 
 class TestParser(unittest.TestCase):
 
@@ -163,10 +250,82 @@ class TestParser(unittest.TestCase):
         )
         self.assertEqual(frame.body, binary)
 
+    def test_get_frames(self):
+        frame = protocol.Frame('MESSAGE', dict(destination='abc'), 'body')
+        data = frame.pack() * 100
+        self.parser.feed(data + data[:10])
+        frames = self.parser.getFrames()
+        self.assertEqual(len(frames), 100)
+        for frame in frames:
+            self.assertFrame(frame, 'MESSAGE', dict(destination='abc'),
+                             'body')
+        # parsed data is removed from buffer
+        self.assertEqual(str(self.parser.buffer), data[:10])
+        self.assertEqual(self.parser.getFrames(), [])
+
+        self.parser.feed(data[10:])
+        frames = self.parser.getFrames()
+        self.assertEqual(len(frames), 100)
+        self.assertEqual(len(self.parser.buffer), 0)
+
+    def test_content_length_null(self):
+        # body with content-length is complete only with the null character
+        data = 'SEND\n' \
+            'content-length: 3\n' \
+            '\n\0\1\0'
+        self.parser.feed(data)
+        self.assertEqual(self.parser.getFrame(), None)
+        self.parser.feed('\0SEND\n\nabc\0')
+        frame1, frame2 = self.parser.getFrames()
+        self.assertFrame(frame1, 'SEND', {'content-length': '3'}, '\0\1\0')
+        self.assertFrame(frame2, 'SEND', {}, 'abc')
+
+    def test_heartbeat(self):
+        self.parser.feed('\n\r\nSEND\n\nabc\0\n\n')
+        frame, = self.parser.getFrames()
+        self.assertFrame(frame, 'SEND', {}, 'abc')
+        self.assertEqual(self.parser.heartbeat_count, 4)
+        self.parser.feed('\nSEND\n\ndef\0')
+        frame, = self.parser.getFrames()
+        self.assertFrame(frame, 'SEND', {}, 'def')
+
+    def test_crlf(self):
+        data = 'SEND\r\n' \
+            'login:test\r\n' \
+            'passcode:123abc\n' \
+            '\r\nbody\0\r\n' \
+            'SEND\r\n\r\nbody2\0'
+        for size in range(1, len(data)):
+            for j in range(0, len(data), size):
+                self.parser.feed(data[j:j + size])
+                if j + size < data.index('body'):
+                    self.assertEqual(self.parser.getFrame(), None)
+            frame1, frame2 = self.parser.getFrames()
+            self.assertFrame(frame1, 'SEND',
+                             dict(login='test', passcode='123abc'), 'body')
+            self.assertFrame(frame2, 'SEND', {}, 'body2')
+
+    def test_unescape(self):
+        data = 'MESSAGE\n' \
+            'destination:a\\cb\\\\c\\nd\n' \
+            '\n\0'
+        self.parser.feed(data)
+        frame = self.parser.getFrame()
+        self.assertEqual(frame.headers['destination'], 'a\\cb\\\\c\\nd')
+        self.parser.unescapeHeaders = True
+        self.parser.feed(data)
+        frame = self.parser.getFrame()
+        self.assertEqual(frame.headers['destination'], 'a:b\\c\nd')
+        # only the first value of a repeated header is used
+        self.parser.feed('MESSAGE\nid:1\nid:2\n\n\0')
+        frame = self.parser.getFrame()
+        self.assertEqual(frame.headers['id'], '1')
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestFrame))
+    suite.addTest(unittest.makeSuite(TestEncoder))
     suite.addTest(unittest.makeSuite(TestParser))
     return suite
 
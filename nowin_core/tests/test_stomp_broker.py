@@ -0,0 +1,190 @@
+import unittest
+
+from twisted.test import proto_helpers
+
+from nowin_core.stomp import protocol
+
+
+class TestSTOMPBroker(unittest.TestCase):
+
+    def setUp(self):
+        from twisted.internet import task
+        from nowin_core.stomp.broker import STOMPBroker
+        self.clock = task.Clock()
+        self.broker = STOMPBroker(users=dict(user='secret'),
+                                  heartbeat=(1000, 1000),
+                                  reactor=self.clock)
+
+    def connect(self, login='user', passcode='secret', **headers):
+        conn = self.broker.buildProtocol(None)
+        conn.makeConnection(proto_helpers.StringTransport())
+        headers.update(login=login, passcode=passcode)
+        self.feed(conn, 'CONNECT', headers)
+        return conn
+
+    def feed(self, conn, command, headers=None, body=''):
+        conn.dataReceived(protocol.Frame(command, headers, body).pack())
+
+    def get_frames(self, conn):
+        parser = protocol.Parser()
+        parser.feed(conn.transport.value())
+        conn.transport.clear()
+        return parser.getFrames()
+
+    def test_connect(self):
+        conn = self.connect()
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.command, 'CONNECTED')
+        self.assertEqual(frame.headers['session'], conn.session_id)
+
+        conn = self.connect(passcode='wrong')
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.command, 'ERROR')
+        self.assertTrue(conn.transport.disconnecting)
+
+    def test_not_connected(self):
+        conn = self.broker.buildProtocol(None)
+        conn.makeConnection(proto_helpers.StringTransport())
+        self.feed(conn, 'SEND', dict(destination='a'), 'data')
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.command, 'ERROR')
+        self.assertEqual(self.broker.published_count, 0)
+
+    def test_fan_out(self):
+        publisher = self.connect()
+        sub1 = self.connect()
+        sub2 = self.connect()
+        self.feed(sub1, 'SUBSCRIBE', dict(destination='a.b', id='s1'))
+        self.feed(sub1, 'SUBSCRIBE', dict(destination='a.*', id='s2'))
+        self.feed(sub2, 'SUBSCRIBE', dict(destination='a.>'))
+        self.feed(sub2, 'SUBSCRIBE', dict(destination='b.>'))
+        for conn in [publisher, sub1, sub2]:
+            self.get_frames(conn)
+
+        self.feed(publisher, 'SEND', {'destination': 'a.b',
+                                      'content-type': 'application/json',
+                                      'receipt': 'r1'}, '[1]')
+        frame, = self.get_frames(publisher)
+        self.assertEqual(frame.command, 'RECEIPT')
+        self.assertEqual(frame.headers['receipt-id'], 'r1')
+
+        frames = self.get_frames(sub1)
+        self.assertEqual(sorted(frame.headers['subscription']
+                                for frame in frames), ['s1', 's2'])
+        frame, = self.get_frames(sub2)
+        self.assertEqual(frame.command, 'MESSAGE')
+        self.assertEqual(frame.headers['destination'], 'a.b')
+        self.assertEqual(frame.headers['subscription'], 'a.>')
+        self.assertEqual(frame.headers['content-type'], 'application/json')
+        self.assertEqual(frame.body, '[1]')
+        self.assertNotIn('receipt', frame.headers)
+        self.assertEqual(self.broker.getStats(), dict(
+            sessions=3, subscriptions=4, published=1, delivered=3,
+            acked=0, nacked=0))
+
+        # other headers are forwarded
+        self.feed(publisher, 'SEND', {'destination': 'b.c',
+                                      'sent-at': '12.5'}, 'data')
+        frame, = self.get_frames(sub2)
+        self.assertEqual(frame.headers['sent-at'], '12.5')
+
+        self.feed(sub1, 'UNSUBSCRIBE', dict(id='s2'))
+        self.feed(publisher, 'SEND', dict(destination='a.c'), 'data')
+        self.assertEqual(self.get_frames(sub1), [])
+        self.assertEqual(len(self.get_frames(sub2)), 1)
+
+    def test_disconnect(self):
+        conn = self.connect()
+        self.feed(conn, 'SUBSCRIBE', dict(destination='a'))
+        self.feed(conn, 'DISCONNECT', dict(receipt='bye'))
+        frames = self.get_frames(conn)
+        self.assertEqual(frames[-1].command, 'RECEIPT')
+        self.assertTrue(conn.transport.disconnecting)
+        conn.connectionLost(None)
+        self.assertEqual(self.broker.getStats()['sessions'], 0)
+        self.assertEqual(self.broker.getStats()['subscriptions'], 0)
+
+    def test_version(self):
+        conn = self.connect(**{'accept-version': '1.0,1.1,1.2'})
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.headers['version'], '1.2')
+        conn = self.connect(**{'accept-version': '1.1'})
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.headers['version'], '1.1')
+        conn = self.connect(**{'accept-version': '2.0'})
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.command, 'ERROR')
+
+    def test_heartbeat(self):
+        conn = self.connect(**{'heart-beat': '2000,500'})
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.headers['heart-beat'], '1000,1000')
+        self.clock.advance(1)
+        self.assertEqual(conn.transport.value(), '\n')
+        # nothing from client in twice of 2 seconds
+        self.clock.advance(2.5)
+        self.assertFalse(conn.transport.disconnecting)
+        self.clock.advance(0.5)
+        self.assertTrue(conn.transport.disconnecting)
+        conn.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_ack(self):
+        publisher = self.connect()
+        conn = self.connect(**{'accept-version': '1.2'})
+        self.feed(conn, 'SUBSCRIBE', {'destination': 'a', 'id': 's1',
+                                      'ack': 'client-individual',
+                                      'activemq.prefetchSize': '2'})
+        self.get_frames(conn)
+        for i in xrange(5):
+            self.feed(publisher, 'SEND', dict(destination='a'), str(i))
+        frames = self.get_frames(conn)
+        self.assertEqual([frame.body for frame in frames], ['0', '1'])
+        self.feed(conn, 'ACK', dict(id=frames[0].headers['ack']))
+        self.feed(conn, 'NACK', dict(id=frames[1].headers['ack']))
+        frames = self.get_frames(conn)
+        self.assertEqual([frame.body for frame in frames], ['2', '3'])
+        stats = self.broker.getStats()
+        self.assertEqual((stats['acked'], stats['nacked']), (1, 1))
+
+        self.feed(conn, 'ACK', dict(id='unknown'))
+        frame, = self.get_frames(conn)
+        self.assertEqual(frame.command, 'ERROR')
+        conn.connectionLost(None)
+        self.assertEqual(self.broker.getStats()['subscriptions'], 0)
+
+    def test_client(self):
+        from nowin_core.stomp.async_client import STOMPClient
+        conn = self.broker.buildProtocol(None)
+        conn.makeConnection(proto_helpers.StringTransport())
+        client = STOMPClient(stats_interval=None)
+        client.makeConnection(proto_helpers.StringTransport())
+
+        def pump():
+            while client.transport.value() or conn.transport.value():
+                data = client.transport.value()
+                client.transport.clear()
+                conn.dataReceived(data)
+                data = conn.transport.value()
+                conn.transport.clear()
+                client.dataReceived(data)
+
+        logins = []
+        client.login('user', 'secret').addCallback(logins.append)
+        pump()
+        self.assertEqual(logins, [None])
+        received = []
+        client.subscribe('a.>', lambda dest, data: received.append(
+            (dest, data)))
+        client.send('a.b', dict(value=1))
+        pump()
+        self.assertEqual(received, [('a.b', dict(value=1))])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSTOMPBroker))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,505 @@
+import unittest
+
+from twisted.internet import abstract
+from twisted.internet import task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from nowin_core.stomp import protocol
+from nowin_core.stomp.async_client import BufferFullError
+
+
+class FakeDescriptor(abstract.FileDescriptor):
+
+    """Transport writes everything at once without a reactor
+
+    """
+
+    def __init__(self, protocol):
+        abstract.FileDescriptor.__init__(self, reactor=task.Clock())
+        self.protocol = protocol
+        self.connected = 1
+        self.writing = False
+        self.written = []
+
+    def startReading(self):
+        pass
+
+    def stopReading(self):
+        pass
+
+    def startWriting(self):
+        self.writing = True
+
+    def stopWriting(self):
+        self.writing = False
+
+    def writeSomeData(self, data):
+        self.written.append(str(data))
+        return len(data)
+
+    def connectionLost(self, reason):
+        abstract.FileDescriptor.connectionLost(self, reason)
+        self.protocol.connectionLost(reason)
+
+
+class TestSTOMPClient(unittest.TestCase):
+
+    def make_client(self, **kwargs):
+        from nowin_core.stomp.async_client import STOMPClient
+        self.clock = task.Clock()
+        client = STOMPClient(reactor=self.clock, **kwargs)
+        self.transport = proto_helpers.StringTransport()
+        client.makeConnection(self.transport)
+        client.state = client.STATE_CONNECTED
+        return client
+
+    def get_frames(self):
+        parser = protocol.Parser()
+        parser.feed(self.transport.value())
+        self.transport.clear()
+        return parser.getFrames()
+
+    def test_send(self):
+        client = self.make_client()
+        client.send('abc', dict(a=1))
+        client.send('def', [1, 2])
+        frame1, frame2 = self.get_frames()
+        self.assertEqual(frame1.headers['destination'], 'abc')
+        self.assertEqual(frame1.body, '{"a": 1}')
+        self.assertEqual(frame2.headers['destination'], 'def')
+        self.assertEqual(frame2.body, '[1, 2]')
+        self.assertEqual(client.getStats(), dict(
+            sent=2, sent_bytes=14, received=0, writes=2, queued=0,
+            pending=0, pending_bytes=0, dropped=0, coalesced=0, pauses=0))
+
+    def test_codec(self):
+        from nowin_core.message_bus.codec import DeflateCodec
+        client = self.make_client(codec=DeflateCodec())
+        client.send('abc', dict(a=1))
+        frame, = self.get_frames()
+        self.assertEqual(frame.headers['content-type'],
+                         DeflateCodec.content_type)
+        self.assertEqual(DeflateCodec().decode(frame.body), dict(a=1))
+
+        received = []
+        client.callbacks['abc'] = lambda dest, data: received.append(data)
+        frame.command = 'MESSAGE'
+        client.dataReceived(frame.pack())
+        # message without content type is JSON
+        client.dataReceived(protocol.Frame(
+            'MESSAGE', dict(destination='abc'), '[1]').pack())
+        self.assertEqual(received, [dict(a=1), [1]])
+        # so are messages of other producers
+        for content_type in ['application/json; charset=utf-8',
+                             'text/plain']:
+            client.dataReceived(protocol.Frame('MESSAGE', {
+                'destination': 'abc',
+                'content-type': content_type,
+            }, '[2]').pack())
+        self.assertEqual(received, [dict(a=1), [1], [2], [2]])
+
+    def test_lazy(self):
+        client = self.make_client()
+        received = []
+        client.subscribe('a', lambda dest, data: received.append(data),
+                         lazy=True)
+        client.subscribe('b', lambda dest, data: received.append(data))
+        self.get_frames()
+        client.dataReceived(protocol.Frame(
+            'MESSAGE', dict(destination='a'), 'not json').pack())
+        client.dataReceived(protocol.Frame(
+            'MESSAGE', dict(destination='b'), '[1]').pack())
+        payload, data = received
+        # the payload nobody reads is never decoded
+        self.assertFalse(payload.decoded)
+        self.assertEqual(payload.body, 'not json')
+        self.assertEqual(data, [1])
+
+    def test_subscription(self):
+        client = self.make_client()
+        received = []
+        client.subscribe('a.>', lambda dest, data: received.append(dest))
+        frame, = self.get_frames()
+        self.assertEqual(frame.headers, dict(destination='a.>', id='a.>'))
+        # message of wildcard subscription is routed by subscription id
+        client.dataReceived(protocol.Frame(
+            'MESSAGE', dict(destination='a.b', subscription='a.>'),
+            '1').pack())
+        self.assertEqual(received, ['a.b'])
+
+    def test_batch(self):
+        client = self.make_client(batch=True, batch_size=5)
+        for i in range(3):
+            client.send('abc', i)
+        self.assertEqual(self.transport.value(), '')
+        self.assertEqual(client.getStats()['queued'], 3)
+        # flushed in next reactor iteration
+        self.clock.advance(0)
+        frames = self.get_frames()
+        self.assertEqual([frame.body for frame in frames], ['0', '1', '2'])
+        self.assertEqual(client.write_count, 1)
+
+        # flushed when the queue is full
+        for i in range(5):
+            client.send('abc', i)
+        self.assertEqual(len(self.get_frames()), 5)
+        self.assertEqual(client.write_count, 2)
+        self.assertEqual(self.clock.getDelayedCalls()[0].func,
+                         client.logStats)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_batch_interval(self):
+        client = self.make_client(batch=True, batch_interval=0.5)
+        client.send('abc', 1)
+        self.clock.advance(0.4)
+        self.assertEqual(self.transport.value(), '')
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.get_frames()), 1)
+
+    def test_batch_receipt(self):
+        client = self.make_client(batch=True)
+        results = []
+        d = client.send('abc', 1, receipt=True)
+        d.addCallback(results.append)
+        client.send('abc', 2)
+        self.clock.advance(0)
+        frame1, frame2 = self.get_frames()
+        self.assertNotIn('receipt', frame2.headers)
+        rid = frame1.headers['receipt']
+        client.dataReceived(
+            protocol.Frame('RECEIPT', {'receipt-id': rid}).pack())
+        self.assertEqual(results, [1])
+        # timeout is canceled once receipted
+        self.assertEqual(len(client.timer), 0)
+
+    def test_receipt_timeout(self):
+        client = self.make_client()
+        errors = []
+        client.send('abc', 1, receipt=True, timeout=5).addErrback(
+            errors.append)
+        self.clock.advance(4.9)
+        self.assertEqual(errors, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(client.receipts, {})
+
+    def test_telemetry(self):
+        from nowin_core.message_bus.telemetry import Telemetry
+        now = [100.0]
+        telemetry = Telemetry(clock=lambda: now[0])
+        client = self.make_client(telemetry=telemetry)
+        client.send('abc', 1, receipt=True)
+        frame, = self.get_frames()
+        self.assertEqual(frame.headers['sent-at'], '100.000000')
+        self.assertIn('receipt', frame.headers)
+
+        def callback(dest, data):
+            now[0] += 0.5
+        client.subscribe('abc', callback)
+        now[0] += 0.25
+        client.dataReceived(protocol.Frame('MESSAGE', {
+            'destination': 'abc', 'sent-at': frame.headers['sent-at'],
+        }, '1').pack())
+        stats = telemetry.getStats()
+        self.assertEqual(stats['delivery']['abc']['max'], 0.25)
+        self.assertEqual(stats['callback']['abc']['max'], 0.5)
+
+    def test_close(self):
+        client = self.make_client(batch=True)
+        client.send('abc', 1)
+        client.close()
+        frame1, frame2 = self.get_frames()
+        self.assertEqual(frame1.command, 'SEND')
+        self.assertEqual(frame2.command, 'DISCONNECT')
+
+    def test_connection_lost(self):
+        client = self.make_client(batch=True)
+        client.send('abc', 1)
+        client.connectionLost(None)
+        self.assertEqual(client.getStats()['queued'], 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stats(self):
+        client = self.make_client(stats_interval=10)
+        client.send('abc', 1)
+        self.clock.advance(10)
+        self.assertEqual(client._last_counts, (1, 0))
+        call, = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), 20)
+
+    def connected(self, client, **headers):
+        client.state = client.STATE_LOGIN
+        client.login('user', 'password')
+        self.get_frames()
+        headers['session'] = '1'
+        client.dataReceived(protocol.Frame('CONNECTED', headers).pack())
+
+    def test_producer(self):
+        client = self.make_client()
+        self.assertTrue(self.transport.producer is client)
+        self.assertTrue(self.transport.streaming)
+
+    def test_pause(self):
+        client = self.make_client(batch=True, batch_size=10)
+        client.send('a', 1)
+        client.pauseProducing()
+        client.send('b', 2)
+        client.send('a', 3)
+        # messages queued for batching are kept in order
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), '')
+        stats = client.getStats()
+        self.assertEqual((stats['pending'], stats['pauses']), (3, 1))
+        client.resumeProducing()
+        self.assertEqual([frame.body for frame in self.get_frames()],
+                         ['1', '2', '3'])
+        self.assertEqual(client.getStats()['pending_bytes'], 0)
+
+    def frame_size(self, client, dest, data):
+        return len(client.encoder.encode(
+            'SEND', dest, client.codec.encode(data), client._codec_headers))
+
+    def test_overflow_drop(self):
+        client = self.make_client()
+        size = self.frame_size(client, 'a', 1)
+        client.max_pending_bytes = size * 2
+        client.overflow_policy = client.OVERFLOW_DROP
+        client.pauseProducing()
+        for i in xrange(3):
+            self.assertEqual(client.send('a', i), None)
+        errors = []
+        client.send('a', 3, receipt=True).addErrback(errors.append)
+        errors[0].trap(BufferFullError)
+        self.assertEqual(client.getStats()['dropped'], 2)
+        self.assertEqual(client.receipts, {})
+        client.resumeProducing()
+        self.assertEqual([frame.body for frame in self.get_frames()],
+                         ['0', '1'])
+
+    def test_overflow_coalesce(self):
+        client = self.make_client()
+        size = self.frame_size(client, 'a', 1)
+        client.max_pending_bytes = size * 2
+        client.overflow_policy = client.OVERFLOW_COALESCE
+        client.pauseProducing()
+        client.send('a', 1)
+        client.send('b', 2)
+        client.send('a', 3)
+        client.send('c', 4)
+        stats = client.getStats()
+        self.assertEqual((stats['coalesced'], stats['dropped']), (1, 1))
+        self.assertEqual(stats['pending_bytes'], size * 2)
+        client.resumeProducing()
+        self.assertEqual([(frame.headers['destination'], frame.body)
+                          for frame in self.get_frames()],
+                         [('a', '3'), ('b', '2')])
+
+    def test_overflow_coalesce_receipt(self):
+        from nowin_core.stomp.async_client import SupersededError
+        client = self.make_client()
+        size = self.frame_size(client, 'a', 1)
+        # room for one message with receipt header
+        client.max_pending_bytes = size + 60
+        client.overflow_policy = client.OVERFLOW_COALESCE
+        client.pauseProducing()
+        errors = []
+        client.send('a', 1, receipt=True).addErrback(errors.append)
+        d = client.send('a', 2, receipt=True)
+        # the superseded receipt fails right away instead of timing out
+        errors[0].trap(SupersededError)
+        self.assertEqual(list(client.receipts.values()), [d])
+        client.resumeProducing()
+        frame, = self.get_frames()
+        self.assertEqual(frame.body, '2')
+
+    def test_overflow_block(self):
+        client = self.make_client()
+        size = self.frame_size(client, 'a', 1)
+        client.max_pending_bytes = size * 2
+        client.pauseProducing()
+        written = []
+        client.send('a', 1).addCallback(written.append)
+        client.send('a', 2).addCallback(written.append)
+        # messages over the limit are rejected
+        self.assertRaises(BufferFullError, client.send, 'a', 3)
+        self.assertRaises(BufferFullError, client.send, 'a', 3,
+                          receipt=True)
+        self.assertEqual(client.receipts, {})
+        self.assertEqual(client.getStats()['pending_bytes'], size * 2)
+        self.assertEqual(written, [])
+        client.resumeProducing()
+        self.assertEqual(written, [None, None])
+        self.assertEqual(len(self.get_frames()), 2)
+
+        # waiters fail when connection lost
+        client.pauseProducing()
+        errors = []
+        client.send('a', 2).addErrback(errors.append)
+        client.connectionLost(None)
+        errors[0].trap(BufferFullError)
+        self.assertEqual(client.getStats()['pending'], 0)
+
+    def test_default_limit(self):
+        client = self.make_client()
+        self.assertEqual(client.overflow_policy, client.OVERFLOW_BLOCK)
+        self.assertTrue(client.max_pending_bytes is not None)
+        client.pauseProducing()
+        data = 'x' * (client.max_pending_bytes / 4)
+        for i in xrange(3):
+            client.send('a', data)
+        self.assertRaises(BufferFullError, client.send, 'a', data)
+
+    def test_close_paused(self):
+        client = self.make_client()
+        client.pauseProducing()
+        client.send('a', 1)
+        client.close()
+        frame1, frame2 = self.get_frames()
+        self.assertEqual(frame1.command, 'SEND')
+        self.assertEqual(frame2.command, 'DISCONNECT')
+        self.assertTrue(self.transport.producer is None)
+
+    def test_close_paused_by_descriptor(self):
+        from nowin_core.stomp.async_client import STOMPClient
+        client = STOMPClient(reactor=task.Clock())
+        descriptor = FakeDescriptor(client)
+        client.makeConnection(descriptor)
+        client.state = client.STATE_CONNECTED
+        lost = []
+        client.conn_lost_event.subscribe(lambda: lost.append(True))
+        # the transport pauses the client as its buffer is full
+        descriptor.bufferSize = 16
+        client.send('a', 'x' * 32)
+        self.assertTrue(client.paused)
+        self.assertTrue(descriptor.producerPaused)
+        client.close()
+        for _ in xrange(10):
+            if not descriptor.writing:
+                break
+            result = descriptor.doWrite()
+            if result is not None:
+                descriptor.connectionLost(failure.Failure(result))
+        self.assertEqual(lost, [True])
+        frames = protocol.Parser()
+        frames.feed(''.join(descriptor.written))
+        self.assertEqual([frame.command for frame in frames.getFrames()],
+                         ['SEND', 'DISCONNECT'])
+
+    def test_login_headers(self):
+        client = self.make_client(stats_interval=None,
+                                  accept_version='1.1,1.2',
+                                  heartbeat=(1000, 2000))
+        client.state = client.STATE_LOGIN
+        client.login('user', 'password', host='broker')
+        frame, = self.get_frames()
+        self.assertEqual(frame.headers, {
+            'login': 'user',
+            'passcode': 'password',
+            'accept-version': '1.1,1.2',
+            'host': 'broker',
+            'heart-beat': '1000,2000',
+        })
+
+    def test_heartbeat(self):
+        client = self.make_client(stats_interval=None,
+                                  heartbeat=(1000, 2000))
+        self.connected(client, **{'heart-beat': '3000,500'})
+        self.assertEqual(client.heartbeat_send, 1)
+        self.assertEqual(client.heartbeat_receive, 3)
+
+        # nothing written in a second
+        self.clock.advance(1)
+        self.assertEqual(self.transport.value(), '\n')
+        self.transport.clear()
+        # no heart-beat while sending
+        self.clock.advance(0.5)
+        client.send('abc', 1)
+        self.transport.clear()
+        self.clock.advance(0.5)
+        self.assertEqual(self.transport.value(), '')
+        self.clock.advance(0.5)
+        self.assertEqual(self.transport.value(), '\n')
+        self.assertEqual(client.heartbeat_count, 2)
+
+        # heart-beat from server keeps connection
+        client.dataReceived('\n')
+        self.clock.advance(5)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(1)
+        self.assertTrue(self.transport.disconnecting)
+
+        client.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_no_heartbeat(self):
+        client = self.make_client(stats_interval=None,
+                                  heartbeat=(1000, 2000))
+        # server doesn't support heart-beating
+        self.connected(client)
+        self.assertEqual(client.heartbeat_send, 0)
+        self.assertEqual(client.heartbeat_receive, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_ack(self):
+        from twisted.internet import defer
+        client = self.make_client(ack_mode='client-individual', prefetch=10)
+        self.connected(client, version='1.2')
+        pending = []
+
+        def callback(dest, data):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        client.subscribe('abc', callback)
+        frame, = self.get_frames()
+        self.assertEqual(frame.headers, {
+            'destination': 'abc',
+            'id': 'abc',
+            'ack': 'client-individual',
+            'activemq.prefetchSize': '10',
+        })
+        for i in xrange(2):
+            client.dataReceived(protocol.Frame('MESSAGE', {
+                'destination': 'abc',
+                'subscription': 'abc',
+                'message-id': 'm%d' % i,
+                'ack': 'a%d' % i,
+            }, '1').pack())
+        self.assertEqual(self.get_frames(), [])
+        pending[1].callback(None)
+        pending[0].errback(ValueError('boom'))
+        ack, nack = self.get_frames()
+        self.assertEqual(ack.command, 'ACK')
+        self.assertEqual(ack.headers, dict(id='a1'))
+        self.assertEqual(nack.command, 'NACK')
+        self.assertEqual(nack.headers, dict(id='a0'))
+        self.assertEqual((client.ack_count, client.nack_count), (1, 1))
+
+    def test_ack_1_0(self):
+        client = self.make_client(ack_mode='client-individual')
+        self.connected(client)
+
+        def callback(dest, data):
+            if data == 2:
+                raise ValueError('boom')
+        client.subscribe('abc', callback)
+        self.get_frames()
+        for i in xrange(1, 3):
+            client.dataReceived(protocol.Frame('MESSAGE', {
+                'destination': 'abc',
+                'message-id': 'm%d' % i,
+            }, str(i)).pack())
+        # no NACK in 1.0
+        ack, = self.get_frames()
+        self.assertEqual(ack.headers, {'message-id': 'm1',
+                                       'subscription': 'abc'})
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSTOMPClient))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
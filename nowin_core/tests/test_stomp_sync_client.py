@@ -0,0 +1,232 @@
+import socket
+import unittest
+
+from nowin_core.stomp import protocol
+
+
+class PairSocket(object):
+
+    """Socket connected to the other end of a socket pair instead of a host
+
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def connect(self, address):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def make(self, **kwargs):
+        from nowin_core.stomp.client import Client
+        sock, server = socket.socketpair()
+        self.servers.append(server)
+        pair = PairSocket(sock)
+        client = Client('localhost', 61613,
+                        SocketClass=lambda *args: pair, **kwargs)
+        self.reply(server, 'CONNECTED', session=str(len(self.servers)))
+        client.login('user', 'password')
+        self.read(server)
+        return client, server
+
+    def reply(self, server, command, body='', **headers):
+        server.sendall(protocol.Frame(command, headers, body).pack())
+
+    def read(self, server):
+        server.settimeout(1)
+        parser = protocol.Parser()
+        while True:
+            try:
+                data = server.recv(65536)
+            except socket.timeout:
+                break
+            parser.feed(data)
+            server.settimeout(0.01)
+        return parser.getFrames()
+
+    def test_send(self):
+        client, server = self.make()
+        self.assertTrue(client.connected)
+        self.assertEqual(client.session_id, '1')
+        client.send('a', dict(value=1))
+        client.send('b', [1, 2])
+        frames = self.read(server)
+        self.assertEqual([frame.headers['destination'] for frame in frames],
+                         ['a', 'b'])
+        self.assertEqual(frames[0].body, '{"value": 1}')
+        self.assertEqual(client.getStats()['writes'], 2)
+
+    def test_pipeline(self):
+        client, server = self.make(flush_size=1024)
+        for i in xrange(100):
+            client.send('a', i)
+        # written together whenever 1024 bytes are buffered
+        writes = client.getStats()['writes']
+        self.assertTrue(0 < writes < 10)
+        self.assertTrue(client.getStats()['buffered_bytes'] < 1024)
+        # receipt flushes the rest and waits for it
+        self.reply(server, 'RECEIPT', **{'receipt-id': 'receipt-1'})
+        client.send('a', 100, receipt=True)
+        self.assertEqual(client.getStats()['buffered_bytes'], 0)
+        frames = self.read(server)
+        self.assertEqual([frame.body for frame in frames],
+                         [str(i) for i in xrange(101)])
+        self.assertEqual(frames[-1].headers['receipt'], 'receipt-1')
+
+    def test_receipt_dispatch(self):
+        client, server = self.make()
+        received = []
+        client.subscribe('a', lambda dest, data: received.append(data))
+        # messages received before the receipt are dispatched
+        self.reply(server, 'MESSAGE', '1', destination='a')
+        self.reply(server, 'RECEIPT', **{'receipt-id': 'receipt-1'})
+        client.send('b', 0, receipt=True)
+        self.assertEqual(received, [1])
+
+        from nowin_core.stomp.client import StompError
+        server.shutdown(socket.SHUT_WR)
+        self.assertRaises(StompError, client.send, 'b', 0, receipt=True)
+        self.assertFalse(client.connected)
+
+    def test_lazy(self):
+        client, server = self.make()
+        received = []
+        client.subscribe('a', lambda dest, data: received.append(data),
+                         lazy=True)
+        self.reply(server, 'MESSAGE', 'not json', destination='a')
+        server.shutdown(socket.SHUT_WR)
+        client.run()
+        payload, = received
+        self.assertFalse(payload.decoded)
+
+    def test_run(self):
+        client, server = self.make()
+        received = []
+        client.subscribe('a', lambda dest, data: received.append(data))
+        for i in xrange(3):
+            self.reply(server, 'MESSAGE', str(i), destination='a')
+        server.shutdown(socket.SHUT_WR)
+        client.run()
+        self.assertEqual(received, [0, 1, 2])
+        self.assertFalse(client.connected)
+
+    def test_pool(self):
+        from nowin_core.stomp.client import ClientPool
+        clients = [self.make(flush_size=4096) for _ in xrange(3)]
+        pool = ClientPool([client for client, _ in clients])
+        dests = ['d%d' % i for i in xrange(30)]
+        for i in xrange(3):
+            for dest in dests:
+                pool.send(dest, i)
+        self.assertEqual(pool.poll(0), 0)
+        seen = {}
+        for client, server in clients:
+            for frame in self.read(server):
+                dest = frame.headers['destination']
+                # messages of a destination go through one client in order
+                seen.setdefault(dest, (client, []))
+                self.assertTrue(seen[dest][0] is client)
+                seen[dest][1].append(frame.body)
+        self.assertEqual(sorted(seen), sorted(dests))
+        for _, bodies in seen.itervalues():
+            self.assertEqual(bodies, ['0', '1', '2'])
+
+        received = []
+        for i, (client, server) in enumerate(clients):
+            client.subscribe('a', lambda dest, data: received.append(data))
+            self.reply(server, 'MESSAGE', str(i), destination='a')
+        while len(received) < 3:
+            pool.poll(1)
+        self.assertEqual(sorted(received), [0, 1, 2])
+
+        # closed clients are removed
+        clients[0][1].shutdown(socket.SHUT_WR)
+        pool.poll(1)
+        self.assertEqual(len(pool.clients), 2)
+        pool.close()
+        self.assertEqual(pool.clients, [])
+
+    def test_pool_stalled(self):
+        from nowin_core.stomp.client import ClientPool
+        stalled, stalled_server = self.make()
+        other, other_server = self.make()
+        pool = ClientPool([stalled, other])
+        self.assertFalse(stalled.blocking)
+        dests = {}
+        for i in xrange(100):
+            dests.setdefault(pool.getClient('d%d' % i), 'd%d' % i)
+        # the broker of stalled client doesn't read, sending never blocks
+        data = 'x' * 65536
+        while not stalled.wantsWrite():
+            pool.send(dests[stalled], data)
+        pool.send(dests[other], 'hello')
+        pool.poll(0)
+        self.assertTrue(stalled.getStats()['unsent_bytes'] > 0)
+        frame, = self.read(other_server)
+        self.assertEqual(frame.body, '"hello"')
+
+        # data is written as the broker reads
+        count = stalled.sent_count
+        frames = []
+        stalled_server.setblocking(False)
+        parser = protocol.Parser()
+        while len(frames) < count:
+            pool.poll(0.01)
+            try:
+                parser.feed(stalled_server.recv(65536))
+            except socket.error:
+                pass
+            frames.extend(parser.getFrames())
+        self.assertFalse(stalled.wantsWrite())
+        self.assertEqual(len(frames), count)
+
+    def test_pool_buffer_full(self):
+        import errno
+        from nowin_core.stomp.client import BufferFullError
+        from nowin_core.stomp.client import ClientPool
+        client, _ = self.make(max_unsent_bytes=1000)
+        pool = ClientPool([client])
+        sends = []
+
+        def send(data):
+            sends.append(len(data))
+            raise socket.error(errno.EAGAIN, 'would block')
+        # the socket never becomes writable
+        client.socket.send = send
+        count = 0
+        with self.assertRaises(BufferFullError):
+            while True:
+                pool.send('a', 'x' * 100)
+                count += 1
+        # messages are refused once 1000 bytes are kept
+        stats = client.getStats()
+        size = stats['unsent_bytes'] / count
+        self.assertEqual(stats['unsent_bytes'], size * count)
+        self.assertTrue(size * (count - 1) < 1000 <= size * count)
+        self.assertEqual(client.sent_count, count)
+        # kept messages are written with one send call
+        del sends[:]
+        client.handleWrite()
+        self.assertEqual(sends, [stats['unsent_bytes']])
+        self.assertTrue(client.wantsWrite())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestClient))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,290 @@
+import socket
+import unittest
+
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+
+from nowin_core.memory.audio_stream import AudioStream
+from nowin_core.stream import base
+
+
+class MockReactor(object):
+
+    def __init__(self):
+        self.ports = []
+        self.connections = []
+
+    def adoptStreamPort(self, fd, family, factory):
+        self.ports.append((fd, family, factory))
+        return 'port'
+
+    def adoptStreamConnection(self, fd, family, factory):
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        self.connections.append((fd, family, protocol))
+
+
+class MockSocket(object):
+
+    def __init__(self, family=socket.AF_INET):
+        self.family = family
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class MockDescriptor(object):
+
+    """Listening port or connection in reactor
+
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.socket = MockSocket()
+        self.reading = True
+        self.writing = True
+
+    def fileno(self):
+        return self.fd
+
+    def stopReading(self):
+        self.reading = False
+
+    def startReading(self):
+        self.reading = True
+
+    def stopWriting(self):
+        self.writing = False
+
+    def startWriting(self):
+        self.writing = True
+
+
+class MockStreamTransport(MockDescriptor, proto_helpers.StringTransport):
+
+    """Transport buffers data not sent yet as abstract.FileDescriptor does
+
+    """
+
+    def __init__(self, fd):
+        MockDescriptor.__init__(self, fd)
+        proto_helpers.StringTransport.__init__(self)
+        self.dataBuffer = ''
+        self.offset = 0
+        self._tempDataBuffer = []
+
+
+class MockUNIXTransport(proto_helpers.StringTransport):
+
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.fds = []
+
+    def sendFileDescriptor(self, fd):
+        self.fds.append(fd)
+
+
+class TestMigration(unittest.TestCase):
+
+    def make_factory(self):
+        from nowin_core.stream.server import StreamFactory
+        return StreamFactory(lambda: AudioStream(3, 4))
+
+    def make_state(self):
+        factory = self.make_factory()
+        factory.session_no = 10
+        res = factory.add('radio')
+        res.write('1234567890abc')
+        state = factory.getState()
+        state['port'] = dict(family=socket.AF_INET)
+        state['sessions'] = [
+            dict(session_no=3, name='radio', offset=6,
+                 family=socket.AF_INET, pending='\0\1'),
+            dict(session_no=5, name='radio', offset=9,
+                 family=socket.AF_INET6, pending=''),
+        ]
+        return factory, state
+
+    def test_encode(self):
+        from nowin_core.stream import migration
+        _, state = self.make_state()
+        data = migration.encodeState(state)
+        length = migration._length.unpack(data[:4])[0]
+        self.assertEqual(length, len(data) - 4)
+        self.assertEqual(migration.decodeState(data[4:]), state)
+
+    def test_restore(self):
+        from nowin_core.stream.migration import MigrationReceiverFactory
+        old_factory, state = self.make_state()
+        factory = self.make_factory()
+        reactor = MockReactor()
+        receiver = MigrationReceiverFactory(factory, reactor=reactor)
+        counts = []
+        receiver.restored_event.subscribe(counts.append)
+        receiver.restore(state, [7, 8, 9])
+
+        self.assertEqual(counts, [2])
+        # two sessions are built after loading the session number
+        self.assertEqual(factory.session_no, 12)
+        self.assertEqual(reactor.ports, [(7, socket.AF_INET, factory)])
+        self.assertEqual(receiver.port, 'port')
+
+        res = factory.getResource('radio')
+        old_res = old_factory.getResource('radio')
+        self.assertEqual(res.audio_stream.data, old_res.audio_stream.data)
+        self.assertEqual(len(res.streams), 2)
+
+        (fd1, family1, p1), (fd2, family2, p2) = reactor.connections
+        self.assertEqual((fd1, family1), (8, socket.AF_INET))
+        self.assertEqual((fd2, family2), (9, socket.AF_INET6))
+        self.assertEqual((p1.session_no, p1.offset), (3, 6))
+        self.assertEqual((p2.session_no, p2.offset), (5, 9))
+        self.assertTrue(p1.streaming)
+        # pending data is sent before anything else
+        self.assertEqual(p1.transport.value(), '\0\1')
+        p1.resumeProducing()
+        self.assertEqual(p1.transport.value(), '\0\1' + '789')
+
+    def test_receive(self):
+        import os
+        from nowin_core.stream import migration
+        _, state = self.make_state()
+        factory = self.make_factory()
+        reactor = MockReactor()
+        receiver = migration.MigrationReceiverFactory(factory,
+                                                      reactor=reactor)
+        protocol = receiver.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+
+        a, b = socket.socketpair()
+        fds = [os.dup(a.fileno()) for i in range(3)]
+        for fd in fds:
+            protocol.fileDescriptorReceived(fd)
+        data = migration.encodeState(state)
+        protocol.dataReceived(data[:10])
+        self.assertEqual(transport.value(), '')
+        protocol.dataReceived(data[10:])
+        self.assertEqual(transport.value(), migration.ACK)
+        self.assertEqual(len(reactor.connections), 2)
+        # received file descriptors are closed after they are adopted
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        a.close()
+        b.close()
+
+
+class TestMigrationSender(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.stream.server import StreamFactory
+        self.factory = StreamFactory(lambda: AudioStream(3, 4))
+        self.res = self.factory.add('radio')
+        self.res.write('1234567890abc')
+        self.empty = []
+        self.res.empty_event.subscribe(lambda: self.empty.append(True))
+        self.streams = [self.connect(8), self.connect(9)]
+        self.port = MockDescriptor(7)
+
+    def connect(self, fd):
+        protocol = self.factory.buildProtocol(None)
+        transport = MockStreamTransport(fd)
+        protocol.makeConnection(transport)
+        protocol.dataReceived(base.makeHeader(dict(name='radio')))
+        return protocol
+
+    def make_one(self):
+        from nowin_core.stream.migration import MigrationSender
+        sender = MigrationSender(self.factory, self.port)
+        self.results = []
+        sender.deferred.addBoth(self.results.append)
+        sender.makeConnection(MockUNIXTransport())
+        return sender
+
+    def test_send(self):
+        from nowin_core.stream import migration
+        a, b = self.streams
+        a.transport.dataBuffer = 'xx12'
+        a.transport.offset = 2
+        a.transport._tempDataBuffer = ['34']
+        sender = self.make_one()
+        transport = sender.transport
+        # listening port goes first
+        self.assertEqual(transport.fds[0], 7)
+        self.assertEqual(sorted(transport.fds[1:]), [8, 9])
+        self.assertFalse(self.port.reading)
+        state = migration.decodeState(transport.value()[4:])
+        sessions = sorted(state['sessions'],
+                          key=lambda session: session['session_no'])
+        self.assertEqual([(s['session_no'], s['pending'])
+                          for s in sessions], [(0, '1234'), (1, '')])
+        self.assertFalse(a.transport.reading)
+        self.assertFalse(a.transport.writing)
+        # resource is not idle while migrating
+        self.assertEqual(self.res.streams, set())
+        self.assertEqual(self.empty, [])
+
+        sender.dataReceived(migration.ACK)
+        self.assertEqual(self.results, [2])
+        for stream in self.streams:
+            self.assertTrue(stream.is_closed)
+            self.assertTrue(stream.transport.socket.closed)
+        self.assertTrue(self.port.socket.closed)
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(self.empty, [True])
+
+    def test_send_failed(self):
+        sender = self.make_one()
+        sender.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(len(self.results), 1)
+        self.results[0].trap(ConnectionLost)
+        # everything is resumed
+        self.assertEqual(self.res.streams, set(self.streams))
+        for stream in self.streams:
+            self.assertFalse(stream.is_closed)
+            self.assertTrue(stream.transport.reading)
+            self.assertTrue(stream.transport.writing)
+            self.assertFalse(stream.transport.socket.closed)
+        self.assertTrue(self.port.reading)
+        self.assertEqual(self.empty, [])
+
+    def test_split_ack(self):
+        from nowin_core.stream import migration
+        sender = self.make_one()
+        sender.dataReceived(migration.ACK[:1])
+        self.assertFalse(sender.acknowledged)
+        self.assertEqual(self.results, [])
+        sender.dataReceived(migration.ACK[1:])
+        self.assertTrue(sender.acknowledged)
+        self.assertEqual(self.results, [2])
+
+    def test_bad_ack(self):
+        sender = self.make_one()
+        sender.dataReceived('NO')
+        self.assertFalse(sender.acknowledged)
+        # the connection is closed, and connectionLost resumes streams
+        self.assertTrue(sender.transport.disconnecting)
+
+    def test_unknown_transport(self):
+        a, b = self.streams
+        del b.transport.dataBuffer
+        sender = self.make_one()
+        # streams we can't get pending data of stay here
+        self.assertEqual(sender.streams, [a])
+        self.assertEqual(sender.transport.fds, [7, 8])
+        self.assertTrue(b.transport.reading)
+        self.assertEqual(self.res.streams, set([b]))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMigration))
+    suite.addTest(unittest.makeSuite(TestMigrationSender))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
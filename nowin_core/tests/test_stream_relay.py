@@ -0,0 +1,172 @@
+import unittest
+
+from twisted.test import proto_helpers
+
+from nowin_core.memory.audio_stream import AudioStream
+from nowin_core.patterns import observer
+from nowin_core.stream import base
+
+
+class MockConnector(object):
+
+    def __init__(self):
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class MockClient(object):
+
+    instances = []
+
+    def __init__(self, host, port, name, keep_alive_opts=None, reactor=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.started = False
+        self.connector = MockConnector()
+        self.conn_failed_event = observer.Subject()
+        self.conn_lost_event = observer.Subject()
+        self.audio_received_event = observer.Subject()
+        self.streaming_event = observer.Subject()
+        self.instances.append(self)
+
+    def start(self):
+        self.started = True
+
+
+class MockCallID(object):
+
+    def __init__(self, seconds, func, args):
+        self.seconds = seconds
+        self.func = func
+        self.args = args
+        self.canceled = False
+
+    def call(self):
+        self.func(*self.args)
+
+    def cancel(self):
+        self.canceled = True
+
+
+class MockReactor(object):
+
+    def __init__(self):
+        self.call_laters = []
+
+    def callLater(self, seconds, func, *args):
+        callid = MockCallID(seconds, func, args)
+        self.call_laters.append(callid)
+        return callid
+
+
+class TestRelayManager(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.stream.server import StreamFactory
+        from nowin_core.stream.relay import RelayManager
+        del MockClient.instances[:]
+        self.reactor = MockReactor()
+        self.factory = StreamFactory(lambda: AudioStream(3, 4),
+                                     push_producer=True)
+        self.manager = RelayManager(
+            self.factory, 'upstream', 5566,
+            grace_period=10,
+            client_factory=MockClient,
+            reactor=self.reactor
+        )
+
+    def connect(self, name='radio'):
+        protocol = self.factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(base.makeHeader(dict(name=name)))
+        transport.clear()
+        return protocol
+
+    def test_open(self):
+        a = self.connect()
+        b = self.connect()
+        # only one relay for listeners coming while it starts
+        self.assertEqual(len(MockClient.instances), 1)
+        client = MockClient.instances[0]
+        self.assertEqual(client.name, 'radio')
+        self.assertEqual(client.host, 'upstream')
+        self.assertTrue(client.started)
+        self.assertEqual(self.manager.getStats(), dict(
+            starting=1, active=0, idle=0, torn_down=0))
+
+        client.streaming_event()
+        client.audio_received_event('123')
+        self.assertEqual(a.transport.value(), '123')
+        self.assertEqual(b.transport.value(), '123')
+        self.assertEqual(self.manager.getStats(), dict(
+            starting=0, active=1, idle=0, torn_down=0))
+
+    def test_idle(self):
+        a = self.connect()
+        client = MockClient.instances[0]
+        client.streaming_event()
+        a.stopProducing()
+        self.assertEqual(self.manager.getStats()['idle'], 1)
+        # timer started by opening is replaced
+        self.assertTrue(self.reactor.call_laters[0].canceled)
+        idle_call = self.reactor.call_laters[1]
+        self.assertEqual(idle_call.seconds, 10)
+
+        # a listener comes back in the grace period
+        b = self.connect()
+        idle_call.call()
+        self.assertIn('radio', self.factory.resources)
+
+        b.stopProducing()
+        self.reactor.call_laters[2].call()
+        self.assertNotIn('radio', self.factory.resources)
+        self.assertTrue(client.connector.disconnected)
+        self.assertEqual(self.manager.getStats(), dict(
+            starting=0, active=0, idle=0, torn_down=1))
+
+        # open a new relay again
+        self.connect()
+        self.assertEqual(len(MockClient.instances), 2)
+
+    def test_get_resource(self):
+        # looking up a resource never opens a relay
+        self.assertEqual(self.factory.getResource('radio'), None)
+        self.assertEqual(MockClient.instances, [])
+        self.assertNotIn('radio', self.factory.resources)
+
+    def test_never_streamed(self):
+        res = self.factory.getOrOpenResource('radio')
+        self.assertNotEqual(res, None)
+        client = MockClient.instances[0]
+        # nobody ever comes
+        idle_call = self.reactor.call_laters[0]
+        self.assertEqual(idle_call.seconds, 10)
+        idle_call.call()
+        self.assertNotIn('radio', self.factory.resources)
+        self.assertTrue(client.connector.disconnected)
+        self.assertEqual(self.manager.getStats(), dict(
+            starting=0, active=0, idle=0, torn_down=1))
+
+    def test_upstream_failed(self):
+        a = self.connect()
+        client = MockClient.instances[0]
+        client.conn_failed_event()
+        self.assertTrue(a.is_closed)
+        self.assertNotIn('radio', self.factory.resources)
+        self.assertEqual(self.manager.torn_down_count, 1)
+        # following events are ignored
+        client.conn_lost_event()
+        self.assertEqual(self.manager.torn_down_count, 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRelayManager))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
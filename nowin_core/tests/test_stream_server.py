@@ -0,0 +1,150 @@
+import json
+import unittest
+
+from twisted.test import proto_helpers
+
+from nowin_core.memory.audio_stream import AudioStream
+from nowin_core.stream import base
+
+
+class TestStreamProtocol(unittest.TestCase):
+
+    def make_factory(self, push_producer=False):
+        from nowin_core.stream.server import StreamFactory
+        return StreamFactory(lambda: AudioStream(3, 4),
+                             push_producer=push_producer)
+
+    def connect(self, factory, name='radio'):
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(base.makeHeader(dict(name=name)))
+        header, data = transport.value().split(base.end_of_header, 1)
+        return protocol, transport, json.loads(header), data
+
+    def test_not_found(self):
+        factory = self.make_factory()
+        protocol, transport, header, _ = self.connect(factory, 'missing')
+        self.assertEqual(header['result'], 'not_found')
+        self.assertTrue(protocol.is_closed)
+
+    def test_pull(self):
+        factory = self.make_factory()
+        res = factory.add('radio')
+        res.write('123456')
+        protocol, transport, header, data = self.connect(factory)
+        self.assertEqual(header['result'], 'found')
+        self.assertEqual(header['begin_offset'], 3)
+        self.assertEqual(transport.streaming, False)
+        # nothing is sent until the transport asks for it
+        self.assertEqual(data, '')
+
+        transport.clear()
+        protocol.resumeProducing()
+        self.assertEqual(transport.value(), '456')
+        # only one block per resume
+        res.write('789abc')
+        self.assertEqual(transport.value(), '456')
+        protocol.resumeProducing()
+        self.assertEqual(transport.value(), '456789')
+
+    def test_push(self):
+        factory = self.make_factory(push_producer=True)
+        res = factory.add('radio')
+        res.write('123456')
+        protocol, transport, header, data = self.connect(factory)
+        self.assertEqual(header['begin_offset'], 3)
+        self.assertEqual(transport.streaming, True)
+        # the data we have is sent right away
+        self.assertEqual(data, '456')
+
+        transport.clear()
+        res.write('789abc')
+        self.assertEqual(transport.value(), '789abc')
+
+    def test_push_paused(self):
+        factory = self.make_factory(push_producer=True)
+        res = factory.add('radio')
+        res.write('123456')
+        paused, _, _, _ = self.connect(factory)
+        other, other_transport, _, _ = self.connect(factory)
+
+        paused.pauseProducing()
+        paused.transport.clear()
+        other_transport.clear()
+        res.write('789')
+        # paused listener is skipped
+        self.assertEqual(paused.transport.value(), '')
+        self.assertEqual(other_transport.value(), '789')
+
+        res.write('abc')
+        paused.resumeProducing()
+        # resync from the offset of the stream
+        self.assertEqual(paused.transport.value(), '789abc')
+        self.assertEqual(paused.offset, other.offset)
+
+    def test_push_out_of_window(self):
+        factory = self.make_factory(push_producer=True)
+        res = factory.add('radio')
+        res.write('123456')
+        protocol, _, _, _ = self.connect(factory)
+        protocol.pauseProducing()
+        res.write('789abcdefghijklmn')
+        protocol.resumeProducing()
+        self.assertTrue(protocol.is_closed)
+        self.assertEqual(len(res.streams), 0)
+
+    def test_compact(self):
+        factory = self.make_factory()
+        factory.add('radio')
+        protocol, _, _, _ = self.connect(factory)
+        self.assertFalse(hasattr(protocol, '__dict__'))
+        # events are not created until someone subscribes to them
+        self.assertEqual(protocol._conn_lost_event, None)
+        self.assertEqual(protocol._data_write_event, None)
+
+    def test_interfaces(self):
+        from twisted.internet.interfaces import ILoggingContext
+        from twisted.internet.interfaces import IProtocol
+        from twisted.internet.interfaces import IPullProducer
+        from twisted.internet.interfaces import IPushProducer
+        from zope.interface.verify import verifyObject
+        factory = self.make_factory()
+        factory.add('radio')
+        protocol, _, _, _ = self.connect(factory)
+        for iface in [IProtocol, ILoggingContext, IPullProducer,
+                      IPushProducer]:
+            self.assertTrue(verifyObject(iface, protocol))
+
+    def test_events(self):
+        factory = self.make_factory(push_producer=True)
+        res = factory.add('radio')
+        protocol, _, _, _ = self.connect(factory)
+
+        written = []
+        factory.data_write_event.subscribe(written.append)
+        stream_written = []
+        protocol.data_write_event.subscribe(stream_written.append)
+        res.write('123')
+        self.assertEqual(written, ['123'])
+        self.assertEqual(stream_written, ['123'])
+
+        lost = []
+        protocol.conn_lost_event.subscribe(lambda: lost.append(True))
+        protocol.stopProducing()
+        self.assertEqual(lost, [True])
+        self.assertEqual(len(res.streams), 0)
+        self.assertEqual(protocol.resource, None)
+        # the resource is notified only once
+        protocol.close(event=True)
+        self.assertEqual(lost, [True, True])
+        self.assertRaises(KeyError, res.remove, protocol)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestStreamProtocol))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,92 @@
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+
+    def make(self, **kwargs):
+        from nowin_core.message_bus.telemetry import Histogram
+        return Histogram(**kwargs)
+
+    def test_empty(self):
+        histogram = self.make()
+        self.assertEqual(histogram.getStats(), dict(
+            count=0, mean=None, min=None, max=None, p50=None, p90=None,
+            p99=None))
+
+    def test_percentile(self):
+        histogram = self.make(min_value=0.001, growth=2, bucket_count=10)
+        for value in [0.0005, 0.001, 0.003, 0.003, 0.004, 0.01, 0.1, 100]:
+            histogram.record(value)
+        self.assertEqual(histogram.counts,
+                         [2, 0, 3, 0, 1, 0, 0, 1, 0, 1])
+        stats = histogram.getStats()
+        self.assertEqual(stats['count'], 8)
+        self.assertEqual(stats['min'], 0.0005)
+        self.assertEqual(stats['max'], 100)
+        # upper bound of the bucket
+        self.assertEqual(histogram.percentile(50), 0.004)
+        self.assertEqual(histogram.percentile(75), 0.016)
+        self.assertEqual(histogram.percentile(80), 0.128)
+        # not beyond the max
+        self.assertEqual(histogram.percentile(100), 100)
+        self.assertEqual(self.make().percentile(50), None)
+
+    def test_fixed_memory(self):
+        histogram = self.make(bucket_count=20)
+        for i in xrange(10000):
+            histogram.record(i * 0.001)
+        self.assertEqual(len(histogram.counts), 20)
+        self.assertEqual(sum(histogram.counts), 10000)
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.message_bus.telemetry import Telemetry
+        self.now = 1000.0
+        self.telemetry = Telemetry(max_keys=2, clock=lambda: self.now)
+
+    def test_delivery(self):
+        sent_at = self.telemetry.getSentAt()
+        self.assertEqual(sent_at, '1000.000000')
+        self.now += 0.25
+        self.assertEqual(self.telemetry.recordDelivery('a', sent_at), 0.25)
+        self.assertEqual(self.telemetry.recordDelivery('a', 'bad'), None)
+        stats = self.telemetry.getStats()
+        self.assertEqual(stats['delivery']['a']['count'], 1)
+        self.assertEqual(stats['delivery']['a']['max'], 0.25)
+
+    def test_max_keys(self):
+        from nowin_core.message_bus.telemetry import OTHERS_KEY
+        for dest in ['a', 'b', 'c', 'd', 'a']:
+            self.telemetry.recordRoundTrip(dest, 0.1)
+        stats = self.telemetry.getStats()['round_trip']
+        self.assertEqual(sorted(stats), sorted(['a', 'b', OTHERS_KEY]))
+        self.assertEqual(stats['a']['count'], 2)
+        self.assertEqual(stats[OTHERS_KEY]['count'], 2)
+        self.telemetry.reset()
+        self.assertEqual(self.telemetry.getStats()['round_trip'], {})
+
+    def test_measure(self):
+        def callback(dest, data):
+            self.now += data
+            if data > 1:
+                raise ValueError('boom')
+            return data
+
+        measured = self.telemetry.measure('a', callback)
+        self.assertEqual(measured('a', 0.5), 0.5)
+        self.assertRaises(ValueError, measured, 'a', 2)
+        stats = self.telemetry.getStats()['callback']['a']
+        self.assertEqual((stats['count'], stats['min'], stats['max']),
+                         (2, 0.5, 2))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestHistogram))
+    suite.addTest(unittest.makeSuite(TestTelemetry))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,161 @@
+import random
+import unittest
+
+from twisted.internet import error
+from twisted.internet import task
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        from nowin_core.scheduler.wheel import TimerWheel
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(resolution=0.1, slots=8, levels=2,
+                                reactor=self.clock)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.callLater(delay, self.fired.append, name)
+
+    def test_call_later(self):
+        self.schedule(0.25, 'a')
+        self.schedule(0.1, 'b')
+        call = self.schedule(0.2, 'c')
+        self.assertEqual(call.getTime(), 0.2)
+        self.assertTrue(call.active())
+        # only one delayed call on the reactor
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['b', 'c'])
+        self.assertFalse(call.active())
+        self.assertRaises(error.AlreadyCalled, call.cancel)
+        # never fired early
+        self.clock.advance(0.04)
+        self.assertEqual(self.fired, ['b', 'c'])
+        self.clock.advance(0.06)
+        self.assertEqual(self.fired, ['b', 'c', 'a'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        call = self.schedule(1, 'a')
+        self.schedule(2, 'b')
+        call.cancel()
+        self.assertRaises(error.AlreadyCancelled, call.cancel)
+        self.clock.advance(2)
+        self.assertEqual(self.fired, ['b'])
+        # the reactor call is dropped once nothing is pending
+        call = self.schedule(1, 'c')
+        call.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.wheel.getStats(), dict(
+            pending=0, fired=1, cancelled=2, ticks=3))
+
+    def test_levels(self):
+        # 8 ticks in first level, 64 ticks in second level, and overflow
+        delays = [0.5, 0.8, 3, 6.4, 7, 20, 100]
+        for delay in delays:
+            self.schedule(delay, delay)
+        fired_at = {}
+        for i in xrange(1000):
+            self.clock.advance(0.1)
+            for delay in self.fired:
+                fired_at.setdefault(delay, self.clock.seconds())
+        for delay in delays:
+            self.assertAlmostEqual(fired_at[delay], delay)
+
+    def test_random(self):
+        rand = random.Random(1234)
+        calls = []
+        for _ in xrange(500):
+            delay = rand.uniform(0, 20)
+            calls.append((delay, self.schedule(delay, delay)))
+        cancelled = set()
+        for delay, call in rand.sample(calls, 100):
+            call.cancel()
+            cancelled.add(delay)
+        while len(self.wheel):
+            self.clock.advance(rand.uniform(0, 0.5))
+            now = self.clock.seconds()
+            for delay in self.fired:
+                self.assertTrue(delay <= now)
+            # fired at most a tick and an advance late
+            for delay, call in calls:
+                if delay not in cancelled and delay < now - 0.6:
+                    self.assertFalse(call.active())
+        expected = sorted(delay for delay, _ in calls
+                          if delay not in cancelled)
+        self.assertEqual(self.fired, expected)
+
+    def test_catch_up(self):
+        self.schedule(1, 'a')
+        self.clock.advance(1)
+        self.clock.advance(1000)
+        # a new call after idle time doesn't fire early
+        self.schedule(0.3, 'b')
+        self.clock.advance(0.2)
+        self.assertEqual(self.fired, ['a'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['a', 'b'])
+        # only ticks with something to do are processed
+        self.assertEqual(self.wheel.getStats()['ticks'], 3)
+
+    def test_long_delay(self):
+        from nowin_core.scheduler.wheel import TimerWheel
+        wheel = TimerWheel(resolution=0.1, slots=256, levels=3,
+                           reactor=self.clock)
+        wakeups = []
+        callLater = self.clock.callLater
+
+        def countingCallLater(delay, func, *args, **kw):
+            wakeups.append(delay)
+            return callLater(delay, func, *args, **kw)
+        self.clock.callLater = countingCallLater
+        wheel.callLater(100, self.fired.append, 'a')
+        self.clock.pump([1] * 100)
+        self.assertEqual(self.fired, ['a'])
+        # wakes up at cascades of tick 256, 512 and 768, and at tick 1000
+        self.assertEqual(len(wakeups), 4)
+        self.assertEqual(wheel.getStats()['ticks'], 4)
+
+        # an earlier call reschedules the wakeup
+        del wakeups[:]
+        wheel.callLater(20, self.fired.append, 'b')
+        wheel.callLater(0.5, self.fired.append, 'c')
+        self.clock.advance(0.5)
+        self.assertEqual(self.fired, ['a', 'c'])
+        self.clock.pump([0.5] * 39)
+        self.assertEqual(self.fired, ['a', 'c', 'b'])
+        # for tick 1024 and rescheduled for 1005, then 1024 and 1200
+        self.assertEqual(len(wakeups), 4)
+
+    def test_nested(self):
+        calls = {}
+
+        def first():
+            self.fired.append('first')
+            calls['second'].cancel()
+            self.schedule(0, 'third')
+
+        self.wheel.callLater(0.1, first)
+        calls['second'] = self.schedule(0.1, 'second')
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['first'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['first', 'third'])
+
+    def test_shared(self):
+        from nowin_core.scheduler.wheel import getWheel
+        self.assertTrue(getWheel(self.clock) is getWheel(self.clock))
+        self.assertFalse(getWheel(self.clock) is getWheel(task.Clock()))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTimerWheel))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')